@@ -0,0 +1,122 @@
+"""Synthetic data generators for the benchmarks.
+
+Everything is generated from a seeded random.Random so runs are comparable.
+"""
+
+import os.path as pth
+import random
+
+from datetime import date, timedelta
+
+SEED = 20181022
+
+PART_PREFIXES = ['', 'THE ', 'the-', 'AB', 'xo', 'OEM ']
+PART_SEPS = ['', '-', ' ', '/', '.', '_']
+
+
+def part_numbers(count, seed=SEED):
+    """Return a list of messy part numbers like we get from customers."""
+    rng = random.Random(seed)
+    alnum = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    parts = []
+    for _ in range(count):
+        chunks = [
+            ''.join(rng.choice(alnum) for _ in range(rng.randint(2, 6)))
+            for _ in range(rng.randint(1, 4))
+        ]
+        parts.append(rng.choice(PART_PREFIXES) + rng.choice(PART_SEPS).join(chunks))
+    return parts
+
+
+def date_strings(count, seed=SEED):
+    """Return a list of date strings in the formats ds_datetime handles."""
+    rng = random.Random(seed)
+    start = date(1995, 1, 1)
+    fmts = [
+        lambda d: '{}/{}/{}'.format(d.month, d.day, d.year),
+        lambda d: '{:02d}/{:02d}/{:02d}'.format(d.month, d.day, d.year % 100),
+        lambda d: '{}/{}/{} 12:34:56'.format(d.month, d.day, d.year),
+    ]
+    return [
+        rng.choice(fmts)(start + timedelta(days=rng.randint(0, 9000)))
+        for _ in range(count)
+    ]
+
+
+def wide_rows(count, cols, seed=SEED):
+    """Return (col_names, rows) of mixed strings, ints, floats and dates."""
+    rng = random.Random(seed)
+    names = ['Col{:03d}'.format(i) for i in range(cols)]
+    kinds = [i % 4 for i in range(cols)]
+    start = date(2010, 1, 1)
+    rows = []
+    for r in range(count):
+        row = []
+        for k in kinds:
+            if k == 0:
+                row.append('Text {:d}'.format(rng.randint(0, 100000)))
+            elif k == 1:
+                row.append(rng.randint(-100000, 100000))
+            elif k == 2:
+                row.append(rng.random() * 1000.0)
+            else:
+                row.append(start + timedelta(days=r % 3000))
+        rows.append(row)
+    return names, rows
+
+
+def write_xlsx(folder, count, cols, sheet_name='Data', seed=SEED):
+    """Write a workbook with one big sheet and return its file name."""
+    from openpyxl import Workbook
+
+    fn = pth.join(folder, 'bench-{:d}x{:d}.xlsx'.format(count, cols))
+    names, rows = wide_rows(count, cols, seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    ws.append(names)
+    for row in rows:
+        ws.append(row)
+    wb.save(fn)
+    return fn
+
+
+RPT_WIDTHS = [12, 8, 30, 14, 10, 24]
+
+
+def write_rpt(folder, count, seed=SEED):
+    """Write a SQL Server style RPT file and return its file name."""
+    rng = random.Random(seed)
+    names = ['PartNumber', 'Qty', 'Description', 'Price', 'OrderDate', 'Customer']
+    fn = pth.join(folder, 'bench-{:d}.rpt'.format(count))
+
+    def _line(vals):
+        return ' '.join(str(v).ljust(w)[:w] for v, w in zip(vals, RPT_WIDTHS)) + '\n'
+
+    parts = part_numbers(1000, seed)
+    with open(fn, 'w', encoding='utf-8-sig') as outp:
+        outp.write(_line(names))
+        outp.write(' '.join('-' * w for w in RPT_WIDTHS) + '\n')
+        for i in range(count):
+            outp.write(_line([
+                parts[i % len(parts)],
+                rng.randint(1, 500),
+                'Item description {:d}'.format(rng.randint(0, 10 ** 6)),
+                '{:.2f}'.format(rng.random() * 5000.0),
+                '{}/{}/{}'.format(rng.randint(1, 12), rng.randint(1, 28), rng.randint(2000, 2018)),
+                'Customer {:d}'.format(rng.randint(0, 5000)),
+            ]))
+        outp.write('\n')
+        outp.write('({:,d} row(s) affected)\n'.format(count))
+    return fn
+
+
+def cpi_json(first_year=1990, last_year=None, seed=SEED):
+    """Return CPI data in the same shape as the get-cpi JSON file."""
+    rng = random.Random(seed)
+    last_year = last_year or date.today().year + 1
+    cpi, val = [], 130.0
+    for yr in range(first_year, last_year + 1):
+        for mth in range(1, 13):
+            val *= 1.0 + rng.random() * 0.005
+            cpi.append({'Year': yr, 'Month': mth, 'CPI': round(val, 3)})
+    return cpi
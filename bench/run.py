@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the hot paths in datasimple.
+
+Each benchmark builds its synthetic data (see gen.py) and is then timed
+--repeat times; we keep the best and median times. Results are written as
+JSON, and if a baseline JSON file exists we compare against it and fail if
+anything got slower than --threshold allows.
+
+    scripts/bench                      # run everything, compare to baseline
+    scripts/bench --save-baseline      # ...and make this run the new baseline
+    scripts/bench -k rpt -x 4          # just the RPT benchmarks, 4x the data
+
+Baselines are only meaningful on the machine that made them.
+"""
+
+import argparse
+import json
+import os
+import os.path as pth
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from contextlib import closing
+from datetime import datetime
+
+HERE = pth.dirname(pth.abspath(__file__))
+sys.path.insert(0, pth.dirname(HERE))  # Benchmark the working tree
+sys.path.insert(0, HERE)
+
+# Logging is part of what we measure, but not what we want to see
+os.environ.setdefault('LOG_LEVEL', 'NONE')
+
+import gen  # noqa: E402
+
+DEFAULT_BASELINE = pth.join(HERE, 'baseline.json')
+DEFAULT_OUTPUT = pth.join(HERE, 'latest.json')
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Register a benchmark.
+
+    The decorated function gets (ctx, scale) and returns (func, items):
+    func is what we time and items is the number of things it processes."""
+    def _reg(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return _reg
+
+
+class Context(object):
+    """Temp folder plus a cache of generated data shared by benchmarks."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._cache = {}
+
+    def get(self, key, make):
+        if key not in self._cache:
+            self._cache[key] = make()
+        return self._cache[key]
+
+
+def _n(base, scale):
+    return max(1, int(base * scale))
+
+
+@benchmark('core.comppart')
+def _comppart(ctx, scale):
+    from datasimple.core import comppart
+    parts = ctx.get(('parts', scale), lambda: gen.part_numbers(_n(200000, scale)))
+    return lambda: [comppart(p) for p in parts], len(parts)
+
+
+def _sql_table(ctx, scale, name, values):
+    from datasimple.sqlite import connect
+    conn = connect(':memory:')
+    conn.execute('create table {} (v text)'.format(name))
+    conn.executemany('insert into {} values (?)'.format(name), ((v,) for v in values))
+    return conn
+
+
+@benchmark('sqlite.comppart')
+def _sql_comppart(ctx, scale):
+    parts = ctx.get(('parts', scale), lambda: gen.part_numbers(_n(200000, scale)))
+    conn = _sql_table(ctx, scale, 'parts', parts)
+    return lambda: conn.execute('select count(distinct comppart(v)) from parts').fetchall(), len(parts)
+
+
+@benchmark('sqlite.ds_datetime')
+def _sql_datetime(ctx, scale):
+    dates = ctx.get(('dates', scale), lambda: gen.date_strings(_n(200000, scale)))
+    conn = _sql_table(ctx, scale, 'dates', dates)
+    return lambda: conn.execute('select count(distinct ds_datetime(v)) from dates').fetchall(), len(dates)
+
+
+@benchmark('partgroup.group_parts')
+def _group_parts(ctx, scale):
+    from datasimple.partgroup import group_parts
+    parts = ctx.get(('parts', scale), lambda: gen.part_numbers(_n(200000, scale)))
+    rows = [[p, str(i % 13), 'Desc {}'.format(i)] for i, p in enumerate(parts)]
+
+    class _Discard(object):
+        def writerow(self, row):
+            pass
+
+        def writerows(self, rows):
+            pass
+
+    def _run():
+        group_parts(['Part', 'Qty', 'Descr'], iter(rows), 'Part', ['count', 'sum:Qty'], _Discard(),
+                    memory_mb=64, folder=ctx.folder)
+    return _run, len(rows)
+
+
+def _init_cpi():
+    from datasimple.period import Period
+    Period.init_cpi(gen.cpi_json())
+    return Period
+
+
+@benchmark('period.adj_price')
+def _adj_price(ctx, scale):
+    Period = _init_cpi()
+    periods = [Period(y, m) for y in range(1991, 2018) for m in range(1, 13)]
+    count = _n(200000, scale)
+    work = [(periods[i % len(periods)], 10.0 + i % 1000, 'SO' if i % 3 else 'CE') for i in range(count)]
+    return lambda: [p.adj_price(price, so) for p, price, so in work], count
+
+
+@benchmark('sqlite.ds_sum_adj_price')
+def _sql_adj_price(ctx, scale):
+    from datasimple.sqlite import connect
+    _init_cpi()
+    count = _n(200000, scale)
+    conn = connect(':memory:', cpi=True)
+    conn.execute('create table so (yr, mth, price, so_type)')
+    conn.executemany('insert into so values (?, ?, ?, ?)', (
+        (1991 + i % 27, 1 + i % 12, 10.0 + i % 1000, 'SO' if i % 3 else 'CE') for i in range(count)
+    ))
+    return lambda: conn.execute('select ds_sum_adj_price(yr, mth, price, so_type) from so').fetchall(), count
+
+
+@benchmark('sqlite.cached_query')
+def _sql_cached_query(ctx, scale):
+    from datasimple.sqlite import QueryCache, connect
+    count = _n(200000, scale)
+    fn = pth.join(ctx.folder, 'cached.db')
+    conn = connect(fn)
+    with conn:
+        conn.execute('create table t (a, b)')
+        conn.executemany('insert into t values (?, ?)', ((i % 97, float(i)) for i in range(count)))
+    cache = QueryCache(fn + '.qcache.sqlite')
+    sql = 'select a, count(*), sum(b), avg(b) from t group by a order by a'
+    cache.query(conn, sql)  # Timing the hits
+    return lambda: [cache.query(conn, sql) for _ in range(100)], 100
+
+
+@benchmark('period.window')
+def _window(ctx, scale):
+    Period = _init_cpi()
+    count = _n(5000, scale)
+    starts = [Period(1995 + i % 20, 1 + i % 12) for i in range(count)]
+
+    def _run():
+        for p in starts:
+            end = p.window_end()
+            while p != end:
+                p = p.next_period()
+    return _run, count * 12
+
+
+@benchmark('period.init_cpi_file')
+def _init_cpi_file(ctx, scale):
+    from datasimple.period import Period
+
+    def _make():
+        fn = pth.join(ctx.folder, 'cpi.json')
+        with open(fn, 'w') as outp:
+            json.dump(gen.cpi_json(), outp)
+        Period.init_cpi_file(fn)  # Compile the cache once
+        return fn
+    fn = ctx.get('cpi.json', _make)
+    count = _n(500, scale)
+
+    def _run():
+        for _ in range(count):
+            Period.init_cpi_file(fn)
+    return _run, count
+
+
+@benchmark('cli.log')
+def _log(ctx, scale):
+    from datasimple import cli
+    count = _n(50000, scale)
+
+    def _run():
+        old_level, old_err = cli.LOG_LEVEL, sys.stderr
+        cli.LOG_LEVEL = 'INFO'
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            for i in range(count):
+                cli.log('Records: [!g]{:,d}[!/g]', i)
+        finally:
+            sys.stderr.close()
+            cli.LOG_LEVEL, sys.stderr = old_level, old_err
+    return _run, count
+
+
+def _xlsx(ctx, scale):
+    rows, cols = _n(20000, scale), 20
+    return ctx.get(('xlsx', scale), lambda: gen.write_xlsx(ctx.folder, rows, cols)), rows
+
+
+@benchmark('xl.ws_scan')
+def _ws_scan(ctx, scale):
+    from datasimple.xl import ws_scan
+    fn, rows = _xlsx(ctx, scale)
+    return lambda: sum(1 for _ in ws_scan(fn, 'Data', log_on_open=False)), rows
+
+
+@benchmark('xl.XlsxImporter')
+def _importer(ctx, scale):
+    from datasimple.xl import XlsxImporter
+    names, rows = ctx.get(('wide', scale), lambda: gen.wide_rows(_n(5000, scale), 40))
+    out = pth.join(ctx.folder, 'import.xlsx')
+
+    class _Importer(XlsxImporter):
+        def add_args(self, argparser):
+            pass
+
+        def validate_args(self, args):
+            pass
+
+        def get_data(self, args):
+            return names, iter(rows)
+
+    def _run():
+        if pth.exists(out):
+            os.remove(out)
+        _Importer().main(cmdline_args=['-b', out, '-s', 'Data'])
+    return _run, len(rows)
+
+
+def _save_bench(save_profile, inline_strings=False):
+    def _setup(ctx, scale):
+        from datasimple.xlparts import save_workbook
+        from openpyxl import Workbook
+
+        def _make():
+            names, rows = gen.wide_rows(_n(20000, scale), 20)
+            wb = Workbook()
+            wb.active.append(names)
+            for row in rows:
+                wb.active.append(row)
+            return wb, len(rows)
+        wb, count = ctx.get(('save-wb', scale), _make)
+        out = pth.join(ctx.folder, 'save.xlsx')
+        return lambda: save_workbook(wb, out, save_profile, inline_strings), count
+    return _setup
+
+
+benchmark('xl.save.store')(_save_bench('store'))
+benchmark('xl.save.fast')(_save_bench('fast'))
+benchmark('xl.save.default')(_save_bench('default'))
+benchmark('xl.save.max')(_save_bench('max'))
+benchmark('xl.save.fast.inline')(_save_bench('fast', True))
+
+
+@benchmark('xl.write_workbook')
+def _write_workbook(ctx, scale):
+    from functools import partial
+    from datasimple.xlwriter import SheetSource, write_workbook
+    count, sheets = _n(5000, scale), 4
+    out = pth.join(ctx.folder, 'write.xlsx')
+    sources = [
+        SheetSource('Data{}'.format(i), partial(gen.wide_rows, count, 40, gen.SEED + i))
+        for i in range(sheets)
+    ]
+    return lambda: write_workbook(out, sources), count * sheets
+
+
+def _rpt(ctx, scale):
+    count = _n(300000, scale)
+    return ctx.get(('rpt', scale), lambda: gen.write_rpt(ctx.folder, count)), count
+
+
+def _rpt_bench(processes, fast):
+    def _setup(ctx, scale):
+        from datasimple.rpt import CsvSink, process_rpt
+        fn, count = _rpt(ctx, scale)
+        out = pth.join(ctx.folder, 'rpt.csv')
+
+        def _run():
+            with closing(CsvSink(out)) as sink:
+                process_rpt(fn, sink, processes=processes, fast=fast)
+        return _run, count
+    return _setup
+
+
+benchmark('rpt.export.text')(_rpt_bench(1, False))
+benchmark('rpt.export.fast')(_rpt_bench(1, True))
+benchmark('rpt.export.pool')(_rpt_bench(max(2, os.cpu_count() or 1), True))
+
+
+def run(names, scale, repeat):
+    """Run the named benchmarks and return our results dict."""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='ds-bench-') as folder:
+        ctx = Context(folder)
+        for name, setup in BENCHMARKS:
+            if name not in names:
+                continue
+            func, items = setup(ctx, scale)
+            times = []
+            for _ in range(repeat):
+                began = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - began)
+            best = min(times)
+            results[name] = {
+                'best': best,
+                'median': statistics.median(times),
+                'repeat': repeat,
+                'items': items,
+                'items_per_sec': items / best if best else 0.0,
+            }
+            sys.stderr.write('{:24s} {:10.4f}s {:14,.0f}/s\n'.format(name, best, items / best if best else 0.0))
+            sys.stderr.flush()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Log a comparison table and return the names that regressed."""
+    from datasimple.cli import log_table
+
+    rows = [['Benchmark', 'Baseline (s)', 'Current (s)', 'Ratio', '']]
+    regressed = []
+    for name, res in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            rows.append([name, '', '{:.4f}'.format(res['best']), '', 'NEW'])
+            continue
+        ratio = res['best'] / base['best'] if base['best'] else 0.0
+        flag = ''
+        if ratio > threshold:
+            flag = '[!r]SLOWER[!/r]'
+            regressed.append(name)
+        elif ratio < 1.0 / threshold:
+            flag = '[!g]FASTER[!/g]'
+        rows.append([name, '{:.4f}'.format(base['best']), '{:.4f}'.format(res['best']), '{:.2f}'.format(ratio), flag])
+
+    log_table('Benchmarks vs baseline', rows, inplace_color=True, justify_columns={1: 'right', 2: 'right', 3: 'right'})
+    return regressed
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description='Run datasimple benchmarks')
+    parser.add_argument('-k', '--only', action='append', default=[], help='only run benchmarks whose name contains this (repeatable)')
+    parser.add_argument('-x', '--scale', type=float, default=1.0, help='multiply the synthetic data sizes by this')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='times to run each benchmark')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT, help='JSON file for results')
+    parser.add_argument('-b', '--baseline', default=DEFAULT_BASELINE, help='JSON baseline to compare against')
+    parser.add_argument('-t', '--threshold', type=float, default=1.25, help='fail if best time / baseline is above this')
+    parser.add_argument('-s', '--save-baseline', action='store_true', default=False, help='save these results as the baseline')
+    parser.add_argument('-l', '--list', action='store_true', default=False, help='list benchmark names and exit')
+    args = parser.parse_args()
+
+    names = [name for name, _ in BENCHMARKS]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+    if args.only:
+        names = [n for n in names if any(o in n for o in args.only)]
+    if args.repeat < 1:
+        raise ValueError('repeat must be >= 1')
+
+    results = run(names, args.scale, args.repeat)
+    doc = {
+        'meta': {
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'scale': args.scale,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as outp:
+        json.dump(doc, outp, indent=2, sort_keys=True)
+
+    regressed = []
+    if pth.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as inp:
+            base = json.load(inp)
+        if base.get('meta', {}).get('scale') != args.scale:
+            sys.stderr.write('Baseline used a different --scale: not comparing\n')
+        else:
+            regressed = compare(results, base.get('results', {}), args.threshold)
+
+    if args.save_baseline:
+        # Keep baseline entries for benchmarks we didn't run this time
+        base = {'results': {}}
+        if pth.isfile(args.baseline):
+            with open(args.baseline) as inp:
+                base = json.load(inp)
+        base['meta'] = doc['meta']
+        base.setdefault('results', {}).update(results)
+        with open(args.baseline, 'w') as outp:
+            json.dump(base, outp, indent=2, sort_keys=True)
+        sys.stderr.write('Saved baseline {}\n'.format(args.baseline))
+
+    if regressed:
+        sys.stderr.write('REGRESSIONS: {}\n'.format(', '.join(regressed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 
+"""Export a SQL Server RPT file to CSV, a SQLite table, an XLSX sheet, or typed
+numpy columns.
+
+Everything happens in a single pass over the RPT file.
+"""
+
 import argparse
 import os.path as path
-import re
 import sys
-import csv
+
+from contextlib import closing
 
 from datasimple.cli import log
 from datasimple.core import panic
+from datasimple.rpt import CHUNK_BYTES, RptReader, CsvSink, NpySink, SqliteSink
+from datasimple.xl import XlsxImporter
 
 
 if sys.version_info[0] < 3:
@@ -20,92 +28,73 @@ def _err(msg, *args):
     raise ValueError(msg)
 
 
-class ReportProcessor(object):
-    """Process RPT files."""
-
-    def __init__(self, hdrs, delims, writer):
-        self.writer = writer
-        self.count = 0
-        self.rejects = [
-            re.compile(r'^\([0-9,]+ row\(s\) affected\)$'),
-        ]
-
-        delim_flds = delims.split()
-        assert len(delim_flds) > 1, 'Could not parse delimiters'
-
-        start = 0
-        self.space_map = list()
-
-        for s in delim_flds:
-            assert len(s.strip('-')) == 0, 'Invalid delimiter spec found'
-
-            ln = len(s)
-            assert ln > 0, 'Empty field makes no sense'
-            assert len(s) == ln, 'Field creation bug'
-
-            self.space_map.append((start, ln))
-            start += (ln + 1)
-
-        if start != len(delims):
-            _err('Expected final pos to be {} but was {}', len(delims), start)
-
-        if not self._write_line(hdrs):
-            _err('Column name output failed')
-
-    def _write_line(self, line):
-        chk = str(line).strip()
-        if not chk:
-            log('[!r]Skipping blank line[!/r]')
-            return False
-        for r in self.rejects:
-            m = r.match(chk)
-            if m:
-                log('[!r]Skipping line[!/r]: found [!y]{}[!/y]', m.group(0))
-                return False
+class RptImporter(XlsxImporter):
+    """Feed the RPT rows straight to XlsxImporter."""
 
-        self.writer.writerow([
-            line[st:st+ln].strip() for st, ln in self.space_map
-        ])
-        return True
+    def __init__(self, reader):
+        super().__init__()
+        self.reader = reader
 
-    def process(self, line):
-        """Parse and write out the given line."""
-        if not self._write_line(line):
-            return
+    def add_args(self, argparser):
+        pass
 
-        self.count += 1
-        if self.count % 100000 == 0:
-            log('            Working: wrote [!g]{:,d}[!/g]', self.count)
+    def validate_args(self, args):
+        pass
 
-    def done(self):
-        """Do any final processing."""
-        log('Processing complete: wrote [!g]{:,d}[!/g]', self.count)
+    def get_data(self, args):
+        return self.reader.columns_and_rows()
 
 
 def main():
     """Entry point."""
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', help='RPT file to read', required=True)
-    parser.add_argument('-o', '--output', help='CSV file to write', required=True)
+    parser.add_argument('-o', '--output', help='CSV, SQLite or XLSX file to write (or directory for npy)', required=True)
     parser.add_argument('-e', '--encoding', help='Encoding to read (default utf-8-sig)', default='utf-8-sig')
+    parser.add_argument('-k', '--sink', help='Output type (default csv)', choices=['csv', 'sqlite', 'xlsx', 'npy'], default='csv')
+    parser.add_argument('-t', '--table', help='Table (sqlite) or sheet (xlsx) to create: defaults to input base name', default='')
+    parser.add_argument('-n', '--sample-rows', help='Rows used to infer column types for npy (default 1000)', type=int, default=1000)
+    parser.add_argument('-j', '--jobs', help='Worker processes for chunked mode (default 1: no chunking)', type=int, default=1)
+    parser.add_argument('-s', '--slow', help='Use the line-by-line text path instead of mmap/byte slicing', action='store_true', default=False)
+    parser.add_argument('-c', '--chunk-mb', help='Size in MB of chunks in chunked mode', type=int, default=CHUNK_BYTES // (1024 * 1024))
     args = parser.parse_args()
 
     if not path.isfile(args.input):
         _err('{} does not exist', args.input)
+    if args.jobs < 1:
+        _err('jobs={} but must be >= 1', args.jobs)
+    if args.chunk_mb < 1:
+        _err('chunk-mb={} but must be >= 1', args.chunk_mb)
+    table = args.table or path.splitext(path.basename(args.input))[0]
 
     log('Opening [!c]{}[!/c]', args.input)
-    with open(args.input, encoding='utf-8-sig') as inp:
-        hdrs = next(inp)
-        delims = next(inp)
-        assert hdrs.strip(), 'Missing headers'
-        assert delims.strip(), 'Missing delimiters'
-
-        log('Creating [!c]{}[!/c]', args.output)
-        with open(args.output, 'w') as outp:
-            processor = ReportProcessor(hdrs, delims, csv.writer(outp, quoting=csv.QUOTE_ALL))
-            for line in inp:
-                processor.process(line)
-            processor.done()
+    reader = RptReader(
+        args.input,
+        encoding=args.encoding,
+        processes=args.jobs,
+        chunk_bytes=args.chunk_mb * 1024 * 1024,
+        fast=not args.slow
+    )
+
+    if args.sink == 'xlsx':
+        RptImporter(reader).main(cmdline_args=['-b', args.output, '-s', table])
+        return
+
+    batches = reader.batches()
+    header = next(batches)
+
+    log('Creating [!c]{}[!/c]', args.output)
+    if args.sink == 'sqlite':
+        sink = SqliteSink(args.output, table)
+    elif args.sink == 'npy':
+        widths = [ln for _, ln in reader.processor.space_map]
+        sink = NpySink(args.output, sample_rows=args.sample_rows, str_widths=widths)
+    else:
+        sink = CsvSink(args.output)
+    with closing(sink):
+        sink.writerows(header)
+        for rows in batches:
+            sink.writerows(rows)
 
 
 if __name__ == '__main__':
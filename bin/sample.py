@@ -3,20 +3,43 @@
 """Given a file name, randomly sample lines and output them to stdout.
 
 You can optionally specify head and tail counts to output before/after sampling
-begins.
+begins. Lines are sampled at a rate (each line is output with probability
+--sample) or, with --count, exactly that many lines are chosen uniformly with
+reservoir sampling. Either way the output is in file order.
+
+We never look at lines we don't output if we can help it: the tail is found by
+seeking backwards from the end of the file, and sampling jumps over unselected
+lines using geometrically distributed skip counts.
+
+For really big files, --jobs splits everything between the head and tail into
+byte ranges (on line boundaries) that are sampled by worker processes, each
+with its own random stream derived from --seed. Output is still in file order.
 """
 
 import argparse
+import math
+import multiprocessing
+import os
 import os.path as path
 import random
 import sys
+import tempfile
 import traceback
 
+from itertools import islice
+
 
 if sys.version_info[0] < 3:
     raise ValueError('Python 3, please')
 
 
+# Block size used when reading backwards for the tail
+TAIL_BLOCK = 64 * 1024
+
+# Block size used when reading forwards through lines
+READ_BLOCK = 1024 * 1024
+
+
 def log(msg, *args):
     if args:
         msg = msg.format(*args)
@@ -30,6 +53,231 @@ def _err(msg, *args):
     raise ValueError(msg)
 
 
+def tail_start(fh, count, size=None):
+    """Return the byte offset where the last count lines of fh start.
+
+    Reads backwards from EOF a block at a time, so the cost only depends on the
+    size of the tail."""
+    if size is None:
+        size = os.fstat(fh.fileno()).st_size
+    if count <= 0 or size == 0:
+        return size
+
+    # A final newline just ends the last line: it doesn't start a new one
+    fh.seek(size - 1)
+    need = count + (1 if fh.read(1) == b'\n' else 0)
+
+    end = size
+    while end > 0:
+        start = max(0, end - TAIL_BLOCK)
+        fh.seek(start)
+        block = fh.read(end - start)
+        pos = len(block)
+        while need > 0:
+            pos = block.rfind(b'\n', 0, pos)
+            if pos < 0:
+                break
+            need -= 1
+        if need == 0:
+            return start + pos + 1
+        end = start
+
+    return 0  # Fewer than count lines
+
+
+class _LineReader(object):
+    """Lines from fh's current position up to the byte offset stop.
+
+    Skipped lines are only counted (with bytes.count on whole blocks) and are
+    never split out into line objects. lines is the number of lines passed
+    so far, skipped or not."""
+
+    def __init__(self, fh, stop):
+        self.fh = fh
+        self.remain = stop - fh.tell()
+        self.buf = b''
+        self.pos = 0
+        self.lines = 0
+
+    def _fill(self):
+        """Read another block: False at stop or EOF."""
+        if self.remain <= 0:
+            return False
+        block = self.fh.read(min(READ_BLOCK, self.remain))
+        if not block:
+            self.remain = 0
+            return False
+        self.remain -= len(block)
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def _line(self):
+        while True:
+            end = self.buf.find(b'\n', self.pos)
+            if end >= 0:
+                line, self.pos = self.buf[self.pos:end + 1], end + 1
+                break
+            if not self._fill():
+                if self.pos >= len(self.buf):
+                    return None
+                line, self.pos = self.buf[self.pos:], len(self.buf)  # No final newline
+                break
+        self.lines += 1
+        return line
+
+    def next_after(self, skip):
+        """Skip skip lines and return the next one, or None at stop or EOF."""
+        while skip > 0:
+            found = self.buf.count(b'\n', self.pos)
+            if found >= skip:
+                for _ in range(skip):
+                    self.pos = self.buf.index(b'\n', self.pos) + 1
+                self.lines += skip
+                break
+            skip -= found
+            self.lines += found
+            if found:
+                self.pos = self.buf.rindex(b'\n') + 1
+            if not self._fill():
+                if self.pos < len(self.buf):
+                    self.lines += 1  # Skipped a final line with no newline
+                    self.pos = len(self.buf)
+                return None
+        return self._line()
+
+
+def sample_rate(fh, stop, rate, rng, write):
+    """Write each line from the current position to stop with probability rate.
+
+    Rather than testing every line, we draw the number of lines to skip before
+    the next selected line from the geometric distribution."""
+    reader = _LineReader(fh, stop)
+    log_q = math.log1p(-rate)
+    count = 0
+    while True:
+        skip = int(math.log(1.0 - rng.random()) / log_q)
+        line = reader.next_after(skip)
+        if line is None:
+            return count
+        write(line)
+        count += 1
+
+
+def sample_count(fh, stop, k, rng):
+    """Return (line count, k lines chosen uniformly) from the current position to stop.
+
+    Reservoir sampling with Li's "Algorithm L", so that we skip over lines
+    instead of drawing a random number for each one. Lines are returned in
+    file order, and the count is every line in the range."""
+    reader = _LineReader(fh, stop)
+    reservoir = []
+    while len(reservoir) < k:
+        line = reader.next_after(0)
+        if line is None:
+            return reader.lines, [ln for _, ln in reservoir]
+        reservoir.append((reader.lines - 1, line))
+
+    w = math.exp(math.log(1.0 - rng.random()) / k)
+    while True:
+        skip = int(math.log(1.0 - rng.random()) / math.log1p(-w))
+        line = reader.next_after(skip)
+        if line is None:
+            break
+        reservoir[rng.randrange(k)] = (reader.lines - 1, line)
+        w *= math.exp(math.log(1.0 - rng.random()) / k)
+
+    return reader.lines, [ln for _, ln in sorted(reservoir)]
+
+
+def chunk_ranges(fh, start, stop, chunk_bytes):
+    """Return (start, end) byte ranges covering start to stop, split on newlines."""
+    ranges = []
+    pos = start
+    while pos < stop:
+        end = pos + chunk_bytes
+        if end < stop:
+            fh.seek(end)
+            fh.readline()
+            end = fh.tell()
+        end = min(end, stop)
+        ranges.append((pos, end))
+        pos = end
+    return ranges
+
+
+def _chunk_rng(seed, idx):
+    return random.Random('{}:{}'.format(seed, idx))
+
+
+def _rate_worker(job):
+    """Sample one byte range at a rate, returning the name of a temp file."""
+    input_file, idx, start, end, rate, seed = job
+    fd, tmp_name = tempfile.mkstemp(prefix='sample-{:06d}-'.format(idx))
+    with open(input_file, 'rb') as fh, os.fdopen(fd, 'wb') as outp:
+        fh.seek(start)
+        sample_rate(fh, end, rate, _chunk_rng(seed, idx), outp.write)
+    return tmp_name
+
+
+def _count_worker(job):
+    """Reservoir sample one byte range, returning (line count, lines)."""
+    input_file, idx, start, end, k, seed = job
+    with open(input_file, 'rb') as fh:
+        fh.seek(start)
+        return sample_count(fh, end, k, _chunk_rng(seed, idx))
+
+
+def parallel_sample(input_file, ranges, processes, seed, write, rate=None, k=None):
+    """Sample the byte ranges in a process pool and write the results in order.
+
+    For a rate every range is sampled independently. For an exact count every
+    range returns a reservoir of up to k lines and its line count; we then
+    decide how many lines each range contributes (a multivariate
+    hypergeometric draw, which keeps the overall sample uniform) and take
+    that many from each reservoir."""
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+
+    with multiprocessing.Pool(processes) as pool:
+        if k is None:
+            jobs = [(input_file, idx, st, end, rate, seed) for idx, (st, end) in enumerate(ranges)]
+            tmp_names = []
+            try:
+                for tmp_name in pool.imap(_rate_worker, jobs):
+                    tmp_names.append(tmp_name)
+                    with open(tmp_name, 'rb') as inp:
+                        for block in iter(lambda: inp.read(READ_BLOCK), b''):
+                            write(block)
+                    os.remove(tmp_name)
+            finally:
+                for tmp_name in tmp_names:
+                    if path.exists(tmp_name):
+                        os.remove(tmp_name)
+            return
+
+        jobs = [(input_file, idx, st, end, k, seed) for idx, (st, end) in enumerate(ranges)]
+        results = pool.map(_count_worker, jobs)
+
+    rng = _chunk_rng(seed, 'merge')
+    remain = [n for n, _ in results]
+    take = [0] * len(results)
+    total = sum(remain)
+    for _ in range(min(k, total)):
+        r = rng.randrange(total)
+        for idx, n in enumerate(remain):
+            if r < n:
+                break
+            r -= n
+        take[idx] += 1
+        remain[idx] -= 1
+        total -= 1
+
+    for (_, lines), m in zip(results, take):
+        for pos in sorted(rng.sample(range(len(lines)), m)):
+            write(lines[pos])
+
+
 def main():
     """Entry point."""
     parser = argparse.ArgumentParser(add_help=False)
@@ -38,6 +286,10 @@ def main():
     parser.add_argument('-h', '--head', help='number of starting lines to output', type=int, default=0)
     parser.add_argument('-t', '--tail', help='number of ending lines to output', type=int, default=0)
     parser.add_argument('-s', '--sample', help='sample rate for lines to output (0.0-1.0)', type=float, default=0.10)
+    parser.add_argument('-k', '--count', help='output exactly this many sampled lines (instead of --sample)', type=int, default=0)
+    parser.add_argument('-r', '--seed', help='random seed for reproducible samples', type=int, default=None)
+    parser.add_argument('-j', '--jobs', help='worker processes for parallel sampling (default 1)', type=int, default=1)
+    parser.add_argument('-c', '--chunk-mb', help='size in MB of byte ranges for parallel sampling', type=int, default=256)
     args = parser.parse_args()
 
     if not path.isfile(args.input):
@@ -46,35 +298,49 @@ def main():
         _err('head={} but must be >= 0', args.head)
     if args.tail < 0:
         _err('tail={} but must be >= 0', args.tail)
-    if args.sample <= 0.0 or args.sample >= 1.0:
-        _err('sample={} but must be 0.0-1.0 (exclusive)', args.rate)
-
-    if args.tail > 0:
-        log('Pre-reading {}', args.input)
-        line_count = 0
-        with open(args.input) as inp:
-            for _ in inp:
-                line_count += 1
-        tail_thresh = line_count - args.tail
-        log('Done: found {:,d}', line_count)
-    else:
-        tail_thresh = -1
-
-    curr = 0
-    with open(args.input) as inp:
-        for line in inp:
-            output = False
-            curr += 1  # 1-based counting for users
-
-            if curr < args.head:
-                output = True
-            elif tail_thresh > 0 and curr > tail_thresh:
-                output = True
-            elif random.random() < args.sample:
-                output = True
-
-            if output:
-                sys.stdout.write(line)
+    if args.count < 0:
+        _err('count={} but must be >= 0', args.count)
+    if not args.count and (args.sample <= 0.0 or args.sample >= 1.0):
+        _err('sample={} but must be 0.0-1.0 (exclusive)', args.sample)
+    if args.jobs < 1:
+        _err('jobs={} but must be >= 1', args.jobs)
+    if args.chunk_mb < 1:
+        _err('chunk-mb={} but must be >= 1', args.chunk_mb)
+
+    rng = random.Random(args.seed)
+    write = sys.stdout.buffer.write
+
+    with open(args.input, 'rb') as fh:
+        stop = tail_start(fh, args.tail)
+        fh.seek(0)
+
+        for line in islice(fh, args.head):
+            if fh.tell() > stop:
+                break  # Head ran into the tail
+            write(line)
+        if fh.tell() > stop:
+            fh.seek(stop)
+
+        if args.jobs > 1:
+            ranges = chunk_ranges(fh, fh.tell(), stop, args.chunk_mb * 1024 * 1024)
+            log('Sampling {:,d} ranges with {:d} processes', len(ranges), args.jobs)
+            sys.stdout.flush()
+            parallel_sample(
+                args.input, ranges, args.jobs, args.seed, write,
+                rate=None if args.count else args.sample,
+                k=args.count or None
+            )
+        elif args.count:
+            for line in sample_count(fh, stop, args.count, rng)[1]:
+                write(line)
+        else:
+            sample_rate(fh, stop, args.sample, rng, write)
+
+        fh.seek(stop)
+        for line in fh:
+            write(line)
+
+    sys.stdout.flush()
 
 
 if __name__ == '__main__':
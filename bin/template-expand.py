@@ -11,33 +11,198 @@ For example:
     echo "{A:} {B:}" | A=Hello B=World ./template-expand.py B=You
 
 would output "Hello You"
+
+Batch mode: any command line arguments that aren't NAME=VALUE are template
+files. They're all expanded with the same variables, in parallel with --jobs,
+and written to --outdir (a trailing .tmpl or .template is dropped from the
+name) or to stdout in the order given.
+
+Each distinct template is parsed once into a compiled form that is reused
+for every copy of the same text. Large templates are streamed a chunk of lines
+at a time instead, so output may be partially written before an error later
+in the template is found.
 """
 
+import argparse
+import multiprocessing
 import os
+import os.path as path
+import shutil
 import sys
+import tempfile
+
+from collections import ChainMap
+from functools import lru_cache
+from string import Formatter
+
+# Templates at least this long (in characters) are streamed
+CHUNK_CHARS = 1024 * 1024
+
+TEMPLATE_EXTS = ('.tmpl', '.template')
+
+# Our options: they're never template variables
+OPTION_NAMES = ('-j', '--jobs', '-o', '--outdir')
+
+_FORMATTER = Formatter()
+
+
+def split_argv(argv):
+    """(NAME=VALUE items, everything else) from argv.
 
+    As always, anything with an = is a variable, even if it looks like an
+    option (like -x=1 or --x=y). The exceptions are our own options."""
+    var_items, rest = [], []
+    for a in argv:
+        if '=' in a and a.split('=')[0] not in OPTION_NAMES:
+            var_items.append(a)
+        else:
+            rest.append(a)
+    return var_items, rest
 
-def parse_args():
-    for a in sys.argv[1:]:
+
+def parse_args(args=None):
+    for a in (sys.argv[1:] if args is None else args):
         comps = a.split('=')
         if len(comps) > 1:
             yield comps[0], '='.join(comps[1:])
 
 
+def compile_template(text):
+    """Parse text into a tuple of (literal, field, spec, conversion) tuples.
+
+    Raises ValueError for malformed templates just like str.format."""
+    return tuple(tuple(p) for p in _FORMATTER.parse(text))
+
+
+# Compiled small templates, keyed by their text
+load_compiled = lru_cache(maxsize=256)(compile_template)
+
+
+def render(compiled, template_vars, write):
+    """Write the compiled template formatted with template_vars."""
+    fmt = _FORMATTER
+    for literal, field, spec, conv in compiled:
+        if literal:
+            write(literal)
+        if field is None:
+            continue
+        obj, _ = fmt.get_field(field, (), template_vars)
+        if conv:
+            obj = fmt.convert_field(obj, conv)
+        if spec and '{' in spec:
+            spec = spec.format_map(template_vars)
+        write(fmt.format_field(obj, spec))
+
+
+def expand_stream(inp, template_vars, write, chunk_chars=CHUNK_CHARS):
+    """Expand the template read from inp, writing the result with write.
+
+    Small templates are compiled once (see load_compiled). Large templates are
+    compiled and rendered up to the last newline of each chunk: if a field
+    spans that cut the parse fails, so we read more and try again."""
+    buf = inp.read(chunk_chars)
+    if len(buf) < chunk_chars:
+        render(load_compiled(buf), template_vars, write)
+        return
+
+    eof = False
+    while not eof:
+        cut = buf.rfind('\n') + 1
+        if cut:
+            try:
+                compiled = compile_template(buf[:cut])
+            except ValueError:
+                compiled = None
+            if compiled is not None:
+                render(compiled, template_vars, write)
+                buf = buf[cut:]
+        more = inp.read(chunk_chars)
+        eof = not more
+        buf += more
+
+    render(compile_template(buf), template_vars, write)
+
+
+def output_name(template_file):
+    """Name of the expanded output for template_file."""
+    name = path.basename(template_file)
+    base, ext = path.splitext(name)
+    return base if ext.lower() in TEMPLATE_EXTS else name
+
+
+def _expand_file(job):
+    """Expand one template file (worker entry point)."""
+    template_file, output_file, cmdline_vars = job
+    template_vars = ChainMap(cmdline_vars, os.environ)
+    with open(template_file) as inp, open(output_file, 'w') as outp:
+        expand_stream(inp, template_vars, outp.write)
+    return output_file
+
+
+def expand_files(template_files, cmdline_vars, outdir=None, jobs=1):
+    """Expand every template file into outdir (or stdout, in order)."""
+    to_stdout = not outdir
+    if to_stdout:
+        outputs = []
+        for _ in template_files:
+            fd, tmp_name = tempfile.mkstemp(prefix='template-expand-')
+            os.close(fd)
+            outputs.append(tmp_name)
+    else:
+        os.makedirs(outdir, exist_ok=True)
+        outputs = [path.join(outdir, output_name(t)) for t in template_files]
+        for t, o in zip(template_files, outputs):
+            if path.abspath(t) == path.abspath(o):
+                raise ValueError('Output would overwrite template {}'.format(t))
+        if len(set(outputs)) != len(outputs):
+            raise ValueError('Duplicate output names in {}'.format(outdir))
+
+    jobs_list = [(t, o, cmdline_vars) for t, o in zip(template_files, outputs)]
+    try:
+        if jobs > 1 and len(jobs_list) > 1:
+            with multiprocessing.Pool(min(jobs, len(jobs_list))) as pool:
+                done = pool.imap(_expand_file, jobs_list)
+                _finish(done, to_stdout)
+        else:
+            _finish(map(_expand_file, jobs_list), to_stdout)
+    finally:
+        if to_stdout:
+            for tmp_name in outputs:
+                if path.exists(tmp_name):
+                    os.remove(tmp_name)
+
+
+def _finish(done, to_stdout):
+    for output_file in done:
+        if to_stdout:
+            with open(output_file) as inp:
+                shutil.copyfileobj(inp, sys.stdout)
+            os.remove(output_file)
+
+
 def main():
-    template_vars = {
-        **dict(os.environ),
-        **dict(parse_args())
-    }
+    parser = argparse.ArgumentParser(description='Expand Python string format templates')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='worker processes for batch mode')
+    parser.add_argument('-o', '--outdir', default='', help='batch mode: write expanded templates here (instead of stdout)')
+    parser.add_argument('templates', nargs='*', metavar='NAME=VALUE|TEMPLATE', help='template variables and template files')
+    var_items, rest = split_argv(sys.argv[1:])
+    args = parser.parse_args(rest)
+
+    cmdline_vars = dict(parse_args(var_items))
+    template_files = args.templates
+
+    # Environment is looked up as needed: no need to copy it
+    template_vars = ChainMap(cmdline_vars, os.environ)
 
     if template_vars.get('verbose', False):
         sys.stderr.write('Writing template vars to stderr...\n')
         for k, v in sorted(template_vars.items()):
             sys.stderr.write(' {} ==> "{}"\n'.format(k, v))
 
-    sys.stdout.write(
-        sys.stdin.read().format(**template_vars)
-    )
+    if template_files:
+        expand_files(template_files, cmdline_vars, args.outdir, args.jobs)
+    else:
+        expand_stream(sys.stdin, template_vars, sys.stdout.write)
     sys.stdout.flush()
 
 
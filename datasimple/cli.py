@@ -12,15 +12,37 @@ You have been warned.
 import os
 import re
 import sys
+import time
+
+from functools import lru_cache
+
+# colorclass and terminaltables are only imported (and colorclass configured)
+# the first time we actually need them: lots of short-lived scripts import
+# this module and never output color or a table.
+_COLORCLASS = None
+
+
+def _colorclass():
+    """Return the colorclass module, importing and configuring it on first use."""
+    global _COLORCLASS
+    if _COLORCLASS is None:
+        import colorclass
+        if os.name == 'nt':
+            colorclass.Windows.enable(auto_colors=True)
+        else:
+            colorclass.set_dark_background()
+        _COLORCLASS = colorclass
+    return _COLORCLASS
 
-import colorclass
-if os.name == 'nt':
-    colorclass.Windows.enable(auto_colors=True)
-else:
-    colorclass.set_dark_background()
 
-import terminaltables
-Table = terminaltables.AsciiTable
+def __getattr__(name):
+    # Table is still terminaltables.AsciiTable (so it can be subclassed and
+    # used with isinstance), but only imported when someone asks for it
+    if name == 'Table':
+        import terminaltables
+        globals()['Table'] = terminaltables.AsciiTable
+        return terminaltables.AsciiTable
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
 
 
 def clr(s, *args, **kwrds):
@@ -28,7 +50,7 @@ def clr(s, *args, **kwrds):
     if args:
         s = s.format(*args, **kwrds)
     color = kwrds.get('color', 'autogreen')
-    return colorclass.Color('{%s}%s{/%s}' % (color, s, color))
+    return _colorclass().Color('{%s}%s{/%s}' % (color, s, color))
 
 
 CLR_ABBREVS = {
@@ -53,25 +75,43 @@ CLR_ABBREVS = {
 CLR_ABBREVS.update([('/'+k, '/'+v) for k, v in CLR_ABBREVS.items()])
 
 
+# Note the 3 groups: the opening bracket, the color, and the closing bracket
+_CLR_RE = re.compile(r'(\[!)(/?[A-Za-z]+)(\])')
+
+
+@lru_cache(maxsize=None)
+def _clr_code(val):
+    """Return the ANSI codes for one of our color tags (e.g. g or /g).
+
+    Unknown colors are left as a colorclass-style {tag} just like before."""
+    tag = '{%s}' % CLR_ABBREVS.get(val, val)
+    return str(_colorclass().Color(tag))
+
+
 def _matchclr(match):
-    """Handle match replacement for clrfmt below.
+    """Handle match replacement for _CLR_RE."""
+    return _clr_code(match.group(2))
+
+
+def _matchclr_escaped(match):
+    """Like _matchclr, but the result is safe to pass through str.format."""
+    return _clr_code(match.group(2)).replace('{', '{{').replace('}', '}}')
 
-    We only know how to handle matches with three groups: the opening
-    bracket, the color, and the closing bracket.
-    """
-    assert match
-    try:
-        pre, val, post = match.group(1, 2, 3)
-        if not pre or not post:
-            raise ValueError('Malformed clrfmt string')
-        parts = [
-            pre.replace('[!', '{'),
-            CLR_ABBREVS.get(val, val),
-            post.replace(']', '}')
-        ]
-        return ''.join(parts)
-    except IndexError:
-        return match.group(0)
+
+@lru_cache(maxsize=1024)
+def _clr_template(s, escape):
+    """Convert the color tags in s once per format string."""
+    return _CLR_RE.sub(_matchclr_escaped if escape else _matchclr, s)
+
+
+def _clrfmt_str(s, args, kwrds):
+    """The work behind clrfmt: returns a plain str with ANSI color codes."""
+    if not (args or kwrds):
+        return _clr_template(s, False)
+    s = _clr_template(s, True).format(*args, **kwrds)
+    if '[!' in s:
+        s = _CLR_RE.sub(_matchclr, s)  # Color tags in the formatted values
+    return s
 
 
 def clrfmt(s, *args, **kwrds):
@@ -79,11 +119,7 @@ def clrfmt(s, *args, **kwrds):
 
     e.g. [!g]Hello World[!/g] becomes {autogreen}Hello World{/autogreen}
     """
-    if args or kwrds:
-        s = s.format(*args, **kwrds)
-    # Note the 3 groups
-    s = re.sub(r'(\[!)(/?[A-Za-z]+)(\])', _matchclr, s)
-    return colorclass.Color(s)
+    return _colorclass().Color(_clrfmt_str(s, args, kwrds))
 
 
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARN').upper().strip()
@@ -99,6 +135,12 @@ def _log_is_warn():
 def _log_is_none():
     return LOG_LEVEL == 'NONE'
 
+def log_enabled():
+    """Return True if log would output anything.
+
+    Useful for skipping expensive work that only feeds a log message."""
+    return LOG_LEVEL != 'NONE'
+
 
 COLOR_DEFAULT = os.environ.get('COLOR_DEFAULT', 'YES').upper()
 if COLOR_DEFAULT:
@@ -115,7 +157,7 @@ def warn(msg, *args, **kwrds):
     The message is formatted and colored red with clr, then written via the
     log function.
     """
-    if _log_is_warn():
+    if LOG_LEVEL == 'WARN':
         log(clr(msg, *args, color='autored', **kwrds))
 
 
@@ -177,50 +219,258 @@ def use_dynamic_log_prefix(xtra_hdr=None):
     log_prefix = _new_log_prefix
 
 
-def log(msg, *args, docolor=None, **kwrds):
+def log(msg, *args, docolor=None, flush=True, **kwrds):
     """Log the given message.
 
-    Outputs to stderr IFF the log level is NOT NONE.
+    Outputs to stderr IFF the log level is NOT NONE. Nothing is formatted if
+    the message would be suppressed.
 
     If docolor is None (the default), it is set from the environment
     variable COLOR_DEFAULT. If True then the msg is formatted with clrfmt.
-    If False then msg.format(*args) is used.
+    If False then msg.format(*args) is used. Only the message is formatted:
+    the log prefix is used as-is.
     """
-    if _log_is_none():
+    if LOG_LEVEL == 'NONE':
         return  # no logging
 
     if docolor is None:
         docolor = COLOR_DEFAULT
 
     prefix = log_prefix()
-    if prefix:
-        msg = prefix + msg
-
     if docolor:
-        msg = clrfmt(msg, *args, **kwrds)
+        if prefix:
+            prefix = _CLR_RE.sub(_matchclr, prefix)
+        msg = _clrfmt_str(msg, args, kwrds)
     elif args or kwrds:
         msg = msg.format(*args, **kwrds)
 
-    sys.stderr.write(msg + '\n')
-    sys.stderr.flush()
+    sys.stderr.write(prefix + msg + '\n')
+    if flush:
+        sys.stderr.flush()
+
+
+# Default minimum number of seconds between ProgressLog messages
+PROGRESS_SECS = float(os.environ.get('LOG_PROGRESS_SECS', '2.0'))
+
+
+class ProgressLog(object):
+    """Rate-limited logging for progress messages in hot loops.
+
+    Calling an instance logs the message (just like log) at most once every
+    interval seconds - anything in between is dropped without formatting.
+    Messages aren't flushed: call flush when you're done (or just log
+    something normally)."""
 
+    def __init__(self, interval=None):
+        self.interval = PROGRESS_SECS if interval is None else interval
+        self.last = time.monotonic()
 
-def log_table(table_name, table_rows, inplace_color=False, justify_columns=None):
-    """Using the logging system and terminaltables to output a formatted table.
+    def due(self):
+        """Return True if a message logged right now would be output."""
+        return LOG_LEVEL != 'NONE' and time.monotonic() - self.last >= self.interval
 
-    If inplace_color then do color formatting on any string-valued cells. Changes
-    are made in-place SO BE SURE."""
+    def __call__(self, msg, *args, force=False, **kwrds):
+        """Log msg if due (or force is True). Returns True if it was logged."""
+        if not (force or self.due()):
+            return False
+        self.last = time.monotonic()
+        log(msg, *args, flush=False, **kwrds)
+        return True
+
+    def flush(self):
+        """Flush any progress messages we've written."""
+        sys.stderr.flush()
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB.
+
+    Returns None where we can't tell (the resource module is Unix only)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB but macOS reports bytes
+    return rss / (1048576.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def _hms(secs):
+    secs = int(secs)
+    return '{:d}:{:02d}:{:02d}'.format(secs // 3600, secs // 60 % 60, secs % 60)
+
+
+class ProgressMeter(object):
+    """Track rows, bytes and elapsed time, and log throughput as we go.
+
+    Call update as work gets done. At most every interval seconds (see
+    ProgressLog) we log rows, rows/sec, MB/sec (if we're counting bytes), an
+    ETA (if total_bytes or total_rows is known) and peak RSS. Call done at the
+    end for a final summary.
+
+    status returns a short color string, so you can put live numbers in every
+    log line with use_dynamic_log_prefix(meter.status)."""
+
+    def __init__(self, name='Rows', total_rows=None, total_bytes=None, interval=None):
+        self.name = name
+        self.total_rows = total_rows
+        self.total_bytes = total_bytes
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._log = ProgressLog(interval)
+
+    def update(self, rows=1, nbytes=0):
+        """Count rows and bytes done, logging our progress if it's time."""
+        self.rows += rows
+        self.bytes += nbytes
+        if self._log.due():
+            self.report()
+
+    def stats(self):
+        """Return a dict of our current numbers."""
+        elapsed = time.monotonic() - self.started
+        secs = max(elapsed, 1e-9)
+
+        eta = None
+        if self.total_bytes and self.bytes:
+            eta = secs * (self.total_bytes - self.bytes) / self.bytes
+        elif self.total_rows and self.rows:
+            eta = secs * (self.total_rows - self.rows) / self.rows
+
+        return {
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'elapsed': elapsed,
+            'rows_per_sec': self.rows / secs,
+            'mb_per_sec': self.bytes / 1048576.0 / secs,
+            'eta': None if eta is None else max(eta, 0.0),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    def message(self, final=False):
+        """Return our current progress as a color log message."""
+        st = self.stats()
+        msg = '{}: [!g]{:,d}[!/g] ([!g]{:,.0f}[!/g] rows/s'.format(self.name, st['rows'], st['rows_per_sec'])
+        if self.bytes:
+            msg += ', [!g]{:,.1f}[!/g] MB/s'.format(st['mb_per_sec'])
+        msg += ')'
+        if final:
+            msg += ' in [!c]{}[!/c]'.format(_hms(st['elapsed']))
+        elif st['eta'] is not None:
+            msg += ' ETA [!c]{}[!/c]'.format(_hms(st['eta']))
+        if st['peak_rss_mb'] is not None:
+            msg += ' peak RSS [!y]{:,.0f}[!/y] MB'.format(st['peak_rss_mb'])
+        return msg
+
+    def status(self):
+        """Short status for a dynamic log prefix."""
+        secs = max(time.monotonic() - self.started, 1e-9)
+        return '[!c]{:,d} {} {:,.0f}/s[!/c]'.format(self.rows, self.name, self.rows / secs)
+
+    def report(self):
+        """Log our progress right now."""
+        self._log('{}', self.message(), force=True)
+
+    def done(self):
+        """Log the final summary."""
+        log('{}', self.message(final=True))
+
+
+# Same as terminaltables uses for measuring visible widths
+_ANSI_RE = re.compile(r'(\033\[[\d;]+m)')
+
+
+def _plain_code(val):
+    code = _clr_code(val)
+    return '' if not code or code.startswith('\033') else code
+
+
+def _strip_clr(s):
+    """Remove our color tags from s (leaving unknown tags just like clrfmt)."""
+    return _CLR_RE.sub(lambda m: _plain_code(m.group(2)), s)
+
+
+def _visible_width(s):
+    """Terminal width of s, ignoring ANSI codes and counting wide chars as 2."""
+    if '\033' in s:
+        s = _ANSI_RE.sub('', s)
+    if s.isascii():
+        return len(s)
+    from unicodedata import east_asian_width
+    return sum(2 if east_asian_width(c) in ('F', 'W') else 1 for c in s)
+
+
+def log_table(table_name, table_rows, inplace_color=False, justify_columns=None, max_rows=None):
+    """Using the logging system to output a formatted table.
+
+    The table looks just like a terminaltables AsciiTable, but column widths
+    are computed in one pass over the plain text, colors are applied as each
+    line is written, and lines are streamed to stderr.
+
+    If inplace_color then do color formatting on any string-valued cells.
+    (table_rows are no longer changed in-place.) justify_columns maps column
+    index to left, right or center. If there are more than max_rows data rows
+    then only the first and last few are output with a count of the rest."""
     log('[!bc][!k]TABLE: {}[!/k][!/bc]', table_name)
-    if inplace_color:
-        for row in table_rows:
-            for idx, cell in enumerate(row):
-                if type(cell) is str:
-                    row[idx] = clrfmt(cell)
-    table = Table(table_rows)
-    if justify_columns:
-        table.justify_columns.update(justify_columns)
-    sys.stderr.write(table.table)
-    sys.stderr.write('\n')
+
+    rows = table_rows if isinstance(table_rows, list) else list(table_rows)
+    if max_rows is not None and len(rows) - 1 > max_rows:
+        tail = max_rows // 2
+        hidden = len(rows) - 1 - max_rows
+        rows = (
+            rows[:1 + max_rows - tail] +
+            [['... {:,d} more rows ...'.format(hidden)]] +
+            (rows[len(rows) - tail:] if tail else [])
+        )
+
+    # One pass: split cells into lines and measure them
+    ncols = max((len(r) for r in rows), default=0)
+    widths = [0] * ncols
+    grid = []
+    for row in rows:
+        cells = []
+        height = 0
+        for idx, cell in enumerate(row):
+            color = inplace_color and type(cell) is str
+            if not isinstance(cell, str):
+                cell = str(cell)
+            lines = cell.splitlines() or ['']
+            if cell.endswith('\n'):
+                lines.append('')
+            vis = [_visible_width(_strip_clr(ln) if color else ln) for ln in lines]
+            if cell:
+                height = max(height, cell.count('\n') + 1)
+                widths[idx] = max(widths[idx], *vis)
+            cells.append((lines, vis, color))
+        grid.append((cells, height))
+
+    justify = justify_columns or {}
+    border = '+' + '+'.join('-' * (w + 2) for w in widths) + '+\n'
+    blank = ([''], [0], False)
+    write = sys.stderr.write
+
+    write(border)
+    for ridx, (cells, height) in enumerate(grid):
+        cells = cells + [blank] * (ncols - len(cells))
+        for lidx in range(max(height, 1)):
+            parts = []
+            for cidx, (lines, vis, color) in enumerate(cells):
+                line, w = (lines[lidx], vis[lidx]) if lidx < len(lines) else ('', 0)
+                if color:
+                    line = _clr_template(line, False)
+                width = widths[cidx] + len(line) - w
+                align = justify.get(cidx, 'left')
+                if align == 'right':
+                    parts.append(line.rjust(width))
+                elif align == 'center':
+                    parts.append(line.center(width))
+                else:
+                    parts.append(line.ljust(width))
+            write('| ' + ' | '.join(parts) + ' |\n')
+        if ridx == 0 and len(grid) > 1:
+            write(border)
+    write(border)
     sys.stderr.flush()
 
 
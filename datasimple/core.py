@@ -1,9 +1,13 @@
 """Simple or fundamental helpers."""
 
+import os
 import re
 import sys
 import traceback
 
+from datetime import datetime
+from types import MappingProxyType
+
 from .cli import log
 
 
@@ -83,6 +87,32 @@ def norm_ws(s):
     return ' '.join(s.strip().split())
 
 
+def parse_date(s):
+    """Parse m/d/y or m/y dates (ignoring any time), or None for other formats.
+
+    Two digit years are taken to be 20xx. Raises ValueError if the parts
+    aren't valid numbers or don't make a valid date."""
+    s = norm_ws(s).split(' ')[0]  # Only up to first space (no time)
+    flds = s.split('/')
+    if len(flds) == 3:
+        mth, day, yr = flds  # m/d/y
+    elif len(flds) == 2:
+        mth, yr = flds  # m/y
+        day = '1'
+    else:
+        return None
+
+    # We go ahead and fail if we can't get our components into int's
+    mth, day, yr = (int(f.lstrip('0')) for f in [mth, day, yr])
+
+    # y2k
+    if yr < 100:
+        yr += 2000
+
+    # Finally done
+    return datetime(yr, mth, day)
+
+
 # Used by xl.ValueMapper and test by xl tests
 def read_config(cfg_text):
     """Given the contents of config file, use configparser to return a dict."""
@@ -103,6 +133,66 @@ def read_config(cfg_text):
     return config.as_dict()
 
 
+# abs path => ((mtime_ns, size), config)
+_CONFIG_CACHE = {}
+
+
+def read_config_file(config_file):
+    """Return read_config for the contents of config_file, cached.
+
+    The result is a read-only mapping of section name to read-only mapping of
+    key/values. It is cached by path and only re-read if the file's mtime or
+    size change, so repeated calls for the same file are (almost) free."""
+    key = os.path.abspath(config_file)
+    st = os.stat(key)
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    cached = _CONFIG_CACHE.get(key)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    with open(key) as inp:
+        cfg_text = str(inp.read()).strip()
+    config = MappingProxyType(dict(
+        (name, MappingProxyType(sect)) for name, sect in read_config(cfg_text).items()
+    ))
+    _CONFIG_CACHE[key] = (stamp, config)
+    return config
+
+
+def file_fingerprint(file_name, content=True):
+    """Return a string identifying the contents of file_name.
+
+    By default this is a SHA-1 of the bytes, so a file that is touched or
+    re-written with the same data keeps its fingerprint. With content False
+    it's just the path, size and mtime (cheap for huge files)."""
+    if not content:
+        st = os.stat(file_name)
+        return '{}:{:d}:{:d}'.format(os.path.abspath(file_name), st.st_size, st.st_mtime_ns)
+
+    import hashlib
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as inp:
+        for block in iter(lambda: inp.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_dir(*parts):
+    """Return (and create) our cache folder, or a sub-folder of it.
+
+    The cache lives in $DS_CACHE_DIR if that's set, otherwise in
+    datasimple under $XDG_CACHE_HOME (default ~/.cache). Anything in it can
+    be deleted at any time."""
+    base = os.environ.get('DS_CACHE_DIR', '').strip()
+    if not base:
+        xdg = os.environ.get('XDG_CACHE_HOME', '').strip() or os.path.join(os.path.expanduser('~'), '.cache')
+        base = os.path.join(xdg, 'datasimple')
+    folder = os.path.join(base, *parts)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
 def panic(excep):
     """Given an exception, print some info and do a tradition panic."""
     exc_args = sys.exc_info()
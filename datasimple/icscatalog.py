@@ -0,0 +1,200 @@
+"""Index the parameters of ICS batch reports in SQLite.
+
+Finding the reports run with some parameter used to mean opening every
+report. update_catalog scans a folder once (in parallel, reading just each
+report's cover sheet with xl.ics_cover_parms) and stores the parameters in
+a SQLite database. Later updates only re-read reports that are new or whose
+mtime or size changed, and forget reports that are gone.
+
+    update_catalog('reports.db', 'reports/')
+    find_reports(conn, Customer='ACME', Year='2018')
+
+The tables are:
+
+    ics_reports (path, mtime_ns, size, error)
+    ics_params  (path, name, value, seq)
+
+seq numbers the values of multi-value parameters in the order they appear.
+"""
+
+import glob
+import os
+import os.path as pth
+
+from .cli import log, ProgressMeter
+from .sqlite import connect
+from .xl import ics_report_params
+from . import profile
+
+SCHEMA = """
+create table if not exists ics_reports (
+    path text primary key,
+    mtime_ns integer not null,
+    size integer not null,
+    error text
+);
+create table if not exists ics_params (
+    path text not null references ics_reports (path),
+    name text not null,
+    value text,
+    seq integer not null
+);
+create index if not exists ics_params_name on ics_params (name, value);
+create index if not exists ics_params_path on ics_params (path);
+"""
+
+
+def open_catalog(db_file):
+    """Connect to the catalog in db_file (with our schema created)."""
+    conn = connect(db_file)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _stamp(fn):
+    st = os.stat(fn)
+    return st.st_mtime_ns, st.st_size
+
+
+def _scan(job):
+    """Read one report's parameters (worker entry point)."""
+    fn, sheet_name = job
+    try:
+        return fn, ics_report_params(fn, sheet_name), None
+    except Exception as e:
+        return fn, {}, '{}: {}'.format(type(e).__name__, e)
+
+
+def find_files(folder, pattern='*.xlsx', recursive=False):
+    """Sorted absolute paths of the reports in folder."""
+    if recursive:
+        found = glob.glob(pth.join(folder, '**', pattern), recursive=True)
+    else:
+        found = glob.glob(pth.join(folder, pattern))
+    # Skip Excel's lock files
+    return sorted(pth.abspath(fn) for fn in found if pth.isfile(fn) and not pth.basename(fn).startswith('~$'))
+
+
+def update_catalog(db_file, folder, pattern='*.xlsx', recursive=False, sheet_name='Cover', processes=None):
+    """Bring the catalog in db_file up to date with the reports in folder.
+
+    Returns a dict with counts of reports added, updated, removed,
+    unchanged and failed (failed reports are recorded with their error and
+    retried once they change)."""
+    files = find_files(folder, pattern, recursive)
+    conn = open_catalog(db_file)
+    try:
+        prefix = pth.join(pth.abspath(folder), '')
+        known = dict(
+            (path, (mtime_ns, size))
+            for path, mtime_ns, size in conn.execute('select path, mtime_ns, size from ics_reports')
+            if path.startswith(prefix)
+        )
+
+        stamps = {}
+        for fn in files:
+            try:
+                stamps[fn] = _stamp(fn)
+            except OSError:
+                continue  # Gone while we looked
+        todo = [fn for fn, stamp in stamps.items() if known.get(fn) != stamp]
+        removed = [path for path in known if path not in stamps]
+        if not recursive:
+            removed = [path for path in removed if pth.dirname(path) == pth.dirname(prefix)]
+
+        counts = {
+            'added': sum(1 for fn in todo if fn not in known),
+            'updated': sum(1 for fn in todo if fn in known),
+            'removed': len(removed),
+            'unchanged': len(stamps) - len(todo),
+            'failed': 0,
+        }
+        log(
+            'Catalog [!y]{:s}[!/y]: [!g]{:,d}[!/g] to scan, [!c]{:,d}[!/c] unchanged, [!r]{:,d}[!/r] removed',
+            db_file, len(todo), counts['unchanged'], len(removed)
+        )
+
+        with conn:
+            for path in removed:
+                _forget(conn, path)
+
+        processes = max(1, min(processes or os.cpu_count() or 1, len(todo)))
+        jobs = [(fn, sheet_name) for fn in todo]
+        meter = ProgressMeter('Reports', total_rows=len(todo))
+        with profile.span('icscatalog.scan'):
+            if processes > 1:
+                import multiprocessing
+                with multiprocessing.Pool(processes) as pool:
+                    _store(conn, pool.imap_unordered(_scan, jobs, chunksize=16), stamps, meter, counts)
+            else:
+                _store(conn, map(_scan, jobs), stamps, meter, counts)
+        meter.done()
+        return counts
+    finally:
+        conn.close()
+
+
+def _forget(conn, path):
+    conn.execute('delete from ics_params where path = ?', (path,))
+    conn.execute('delete from ics_reports where path = ?', (path,))
+
+
+def _store(conn, results, stamps, meter, counts, batch=500):
+    """Save scan results, committing every batch reports."""
+    pending = 0
+    try:
+        for fn, parms, error in results:
+            _forget(conn, fn)
+            mtime_ns, size = stamps[fn]
+            conn.execute(
+                'insert into ics_reports (path, mtime_ns, size, error) values (?, ?, ?, ?)',
+                (fn, mtime_ns, size, error)
+            )
+            rows = []
+            for name, vals in parms.items():
+                if type(vals) is not list:
+                    vals = [vals]
+                rows.extend((fn, name, v, seq) for seq, v in enumerate(vals))
+            conn.executemany('insert into ics_params (path, name, value, seq) values (?, ?, ?, ?)', rows)
+
+            if error:
+                counts['failed'] += 1
+                log('[!r]Could not read[!/r] {:s}: {:s}', fn, error)
+            meter.update()
+            pending += 1
+            if pending >= batch:
+                conn.commit()
+                pending = 0
+    finally:
+        conn.commit()
+
+
+def find_reports(conn, **params):
+    """Paths of reports that have every given parameter name = value.
+
+    A value of None matches any report with that parameter. Multi-value
+    parameters match if any of their values do."""
+    sql = ['select path from ics_reports where error is null']
+    args = []
+    for name, value in sorted(params.items()):
+        if value is None:
+            sql.append('and path in (select path from ics_params where name = ?)')
+            args.append(name)
+        else:
+            sql.append('and path in (select path from ics_params where name = ? and value = ?)')
+            args.extend([name, value])
+    sql.append('order by path')
+    return [row[0] for row in conn.execute(' '.join(sql), args)]
+
+
+def report_params(conn, path):
+    """Parameters stored for the report at path (like xl.ics_report_params)."""
+    parms = dict()
+    for name, value in conn.execute('select name, value from ics_params where path = ? order by name, seq', (path,)):
+        if name in parms:
+            if type(parms[name]) is not list:
+                parms[name] = [parms[name]]
+            parms[name].append(value)
+        else:
+            parms[name] = value
+    return parms
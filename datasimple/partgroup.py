@@ -0,0 +1,290 @@
+"""Dedupe and group rows by compressed part number, out of core.
+
+Part lists are often much bigger than memory, so group_parts never holds
+more than one hash partition of them at a time:
+
+1. Every row is keyed by core.comppart of its key column and appended to
+   one of several spill files picked by the crc32 of that key, so all rows
+   of a part land in the same file.
+2. Each spill file is aggregated in memory by a worker process and its
+   groups written, in first-seen order, to a result file.
+3. The result files are merged back into first-seen order as they are
+   written out.
+
+The number of partitions comes from memory_mb and the input size, so that
+each worker's partition should fit in its share of memory_mb.
+
+    cols, rows = read_source('parts.rpt')
+    group_parts(cols, rows, 'PartNo', ['count', 'sum:Qty'], csv.writer(sys.stdout))
+"""
+
+import csv
+import heapq
+import math
+import os
+import os.path as pth
+import pickle
+import tempfile
+import zlib
+
+from .cli import log, ProgressMeter
+from .core import comppart
+from . import profile
+
+AGG_FUNCS = ('count', 'first', 'last', 'sum', 'min', 'max')
+
+# Rows pickled at a time to spill and result files
+SPILL_BATCH_ROWS = 5000
+
+# Rough size of a row in memory (Python objects) relative to pickled
+MEMORY_FACTOR = 4
+
+MAX_PARTITIONS = 4096
+
+
+def read_source(input_file, sheet_name=None, encoding='utf-8-sig', processes=1):
+    """(cols, rows) for a CSV, RPT or XLSX file, picked by extension.
+
+    XLSX sheets are read with xl.ws_scan_raw and need sheet_name; RPT files
+    are parsed by rpt.RptReader (with processes)."""
+    ext = pth.splitext(input_file)[1].lower()
+    if ext in ('.xlsx', '.xlsm'):
+        from .xl import ws_scan_raw
+        if not sheet_name:
+            raise ValueError('A sheet name is required for {}'.format(input_file))
+        rows = ws_scan_raw(input_file, sheet_name)
+    elif ext == '.rpt':
+        from .rpt import RptReader
+        rows = iter(RptReader(input_file, encoding, processes=processes))
+    else:
+        rows = _csv_rows(input_file, encoding)
+
+    cols = next(rows, None)
+    if not cols:
+        raise ValueError('No header row in {}'.format(input_file))
+    return list(cols), rows
+
+
+def _csv_rows(input_file, encoding):
+    with open(input_file, newline='', encoding=encoding) as inp:
+        yield from csv.reader(inp)
+
+
+def parse_aggs(specs, cols):
+    """Parse aggregate specs like 'count' or 'sum:Qty' against cols.
+
+    Returns a list of (func, column index, output name). No specs means
+    dedupe: the first value of every column."""
+    if not specs:
+        return [('first', idx, c) for idx, c in enumerate(cols)]
+
+    aggs = []
+    for spec in specs:
+        func, _, col = (s.strip() for s in spec.partition(':'))
+        func = func.lower()
+        if func not in AGG_FUNCS:
+            raise ValueError('Unknown aggregate {} (use one of {})'.format(func, ', '.join(AGG_FUNCS)))
+        if func == 'count' and not col:
+            aggs.append((func, -1, 'count'))
+            continue
+        if col not in cols:
+            raise ValueError('Unknown column {} in {}'.format(col, spec))
+        aggs.append((func, cols.index(col), '{}({})'.format(func, col)))
+    return aggs
+
+
+def _num(v):
+    """Number for a cell value, or None if it's blank."""
+    if v is None or isinstance(v, (int, float)):
+        return v
+    v = str(v).strip().replace(',', '')
+    if not v:
+        return None
+    try:
+        return int(v)
+    except ValueError:
+        try:
+            return float(v)
+        except ValueError:
+            raise ValueError('Not a number: {!r}'.format(v))
+
+
+def _update(state, aggs, row):
+    nrow = len(row)
+    for i, (func, idx, _) in enumerate(aggs):
+        if func == 'count':
+            if idx < 0 or (idx < nrow and row[idx] not in (None, '')):
+                state[i] += 1
+            continue
+
+        v = row[idx] if idx < nrow else None
+        if func == 'first' or func == 'last':
+            if func == 'last' or state[i] is None:
+                state[i] = v
+            continue
+
+        v = _num(v)
+        if v is None:
+            continue
+        old = state[i]
+        if old is None:
+            state[i] = v
+        elif func == 'sum':
+            state[i] = old + v
+        elif func == 'min':
+            if v < old:
+                state[i] = v
+        elif v > old:
+            state[i] = v
+
+
+def _read_batches(file_name):
+    with open(file_name, 'rb') as inp:
+        while True:
+            try:
+                yield pickle.load(inp)
+            except EOFError:
+                return
+
+
+def _aggregate(job):
+    """Group one spill file into a result file (worker entry point)."""
+    spill_file, result_file, aggs = job
+    init = [0 if func == 'count' else None for func, _, _ in aggs]
+    groups = {}
+    rows = 0
+    for batch in _read_batches(spill_file):
+        rows += len(batch)
+        for seq, cp, row in batch:
+            found = groups.get(cp)
+            if found is None:
+                found = groups[cp] = (seq, list(init))
+            _update(found[1], aggs, row)
+    os.remove(spill_file)
+
+    results = sorted((seq, cp, state) for cp, (seq, state) in groups.items())
+    with open(result_file, 'wb') as outp:
+        for start in range(0, len(results), SPILL_BATCH_ROWS):
+            pickle.dump(results[start:start + SPILL_BATCH_ROWS], outp, protocol=pickle.HIGHEST_PROTOCOL)
+    return result_file, rows, len(results)
+
+
+def _results(result_file):
+    for batch in _read_batches(result_file):
+        yield from batch
+
+
+def _partition_count(memory_bytes, processes, input_bytes):
+    if not input_bytes:
+        return processes * 4
+    # Every worker gets its share of memory for one partition at a time
+    wanted = math.ceil(input_bytes * MEMORY_FACTOR * processes / max(memory_bytes, 1))
+    return max(processes, min(wanted, MAX_PARTITIONS))
+
+
+class _Spiller(object):
+    """Buffer rows by partition and append them to spill files."""
+
+    def __init__(self, folder, partitions, memory_bytes):
+        self.files = [pth.join(folder, 'spill-{:05d}.pkl'.format(i)) for i in range(partitions)]
+        self.buffers = [[] for _ in range(partitions)]
+        self.memory_bytes = memory_bytes
+        self.flush_rows = None
+        self.buffered = 0
+
+    def add(self, part, item):
+        self.buffers[part].append(item)
+        self.buffered += 1
+        if self.flush_rows is None:
+            if self.buffered >= 1000:
+                # Size the buffers from what rows look like so far
+                sample = [i for b in self.buffers for i in b]
+                row_bytes = len(pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL)) / len(sample)
+                self.flush_rows = max(1000, int(self.memory_bytes / 4 / (row_bytes * MEMORY_FACTOR)))
+        elif self.buffered >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        for fn, buf in zip(self.files, self.buffers):
+            if buf:
+                with open(fn, 'ab') as outp:
+                    for start in range(0, len(buf), SPILL_BATCH_ROWS):
+                        pickle.dump(buf[start:start + SPILL_BATCH_ROWS], outp, protocol=pickle.HIGHEST_PROTOCOL)
+                buf.clear()
+        self.buffered = 0
+
+
+def group_parts(
+    cols, rows, key, aggs, writer,
+    memory_mb=512, processes=None, partitions=None, input_bytes=None, folder=None
+):
+    """Group rows by comppart of the column key and write one row per part.
+
+    aggs is a list of specs for parse_aggs (empty to dedupe). The header and
+    rows written to writer (anything with writerow/writerows, like a
+    csv.writer or rpt.CsvSink) are CompPart followed by the aggregates, in
+    the order each part was first seen. Rows with a blank part are skipped.
+
+    memory_mb is the memory to aim for. With input_bytes (the input file
+    size) we pick enough partitions for a partition to fit each of the
+    processes worker processes (default one per CPU); or give partitions.
+    Spill files go in a temporary folder under folder.
+
+    Returns a dict with the rows read, blank rows skipped and groups
+    written."""
+    cols = list(cols)
+    if key not in cols:
+        raise ValueError('Key column {} is not one of {}'.format(key, cols))
+    key_idx = cols.index(key)
+    aggs = parse_aggs(aggs, cols)
+    processes = processes or os.cpu_count() or 1
+    memory_bytes = memory_mb * 1024 * 1024
+    partitions = partitions or _partition_count(memory_bytes, processes, input_bytes)
+
+    counts = {'rows': 0, 'blank': 0, 'groups': 0}
+    with tempfile.TemporaryDirectory(prefix='partgroup-', dir=folder) as tmp:
+        log('Grouping on [!c]{:s}[!/c] with [!c]{:,d}[!/c] partitions', key, partitions)
+        spiller = _Spiller(tmp, partitions, memory_bytes)
+        meter = ProgressMeter('Rows', total_bytes=input_bytes)
+        with profile.span('partgroup.spill'):
+            for seq, row in enumerate(rows):
+                cp = comppart(row[key_idx]) if key_idx < len(row) and row[key_idx] is not None else ''
+                if not cp:
+                    counts['blank'] += 1
+                    continue
+                spiller.add(zlib.crc32(cp.encode('utf-8')) % partitions, (seq, cp, row))
+                meter.update()
+            spiller.flush()
+        meter.done()
+        counts['rows'] = meter.rows + counts['blank']
+
+        jobs = [
+            (fn, pth.join(tmp, 'result-{:05d}.pkl'.format(i)), aggs)
+            for i, fn in enumerate(spiller.files) if pth.isfile(fn)
+        ]
+        with profile.span('partgroup.aggregate'):
+            if processes > 1 and len(jobs) > 1:
+                import multiprocessing
+                with multiprocessing.Pool(min(processes, len(jobs))) as pool:
+                    done = list(pool.imap_unordered(_aggregate, jobs))
+            else:
+                done = [_aggregate(job) for job in jobs]
+
+        with profile.span('partgroup.merge'):
+            writer.writerow(['CompPart'] + [name for _, _, name in aggs])
+            merged = heapq.merge(*(_results(result_file) for result_file, _, _ in done))
+            batch = []
+            for _, cp, state in merged:
+                batch.append([cp] + state)
+                if len(batch) >= SPILL_BATCH_ROWS:
+                    writer.writerows(batch)
+                    counts['groups'] += len(batch)
+                    batch = []
+            writer.writerows(batch)
+            counts['groups'] += len(batch)
+
+    log(
+        'Rows: [!g]{:,d}[!/g], blank parts: [!y]{:,d}[!/y], parts: [!g]{:,d}[!/g]',
+        counts['rows'], counts['blank'], counts['groups']
+    )
+    return counts
@@ -3,15 +3,136 @@
 Our main contribution is the Period class for working with Period ranges and
 adjusting prices with ICS rules and CPI."""
 
+import json
+import math
+import mmap
+import os
+import struct
+import tempfile
+
 from collections import namedtuple
 from datetime import datetime, timedelta
 
+from .profile import timed
+
+
+# Compiled CPI cache layout: a fixed header followed by one little-endian
+# double per month, indexed by month ordinal (year * 12 + month - 1) relative
+# to the first month in the file. Months missing from the source are NaN.
+CPI_CACHE_SUFFIX = '.cpicache'
+_CPI_MAGIC = b'DSCPI001'
+_CPI_HDR = struct.Struct('<8sqqqq')  # magic, src mtime_ns, src size, first ordinal, count
+
+
+def _month_ordinal(year, month):
+    return int(year) * 12 + int(month) - 1
+
+
+def _cpi_ref_from_json(cpi_json):
+    """Validate the parsed CPI JSON list and return a Period => CPI dict."""
+    cpi_ref = dict()
+    for rec in cpi_json:
+        y = int(rec['Year'])
+        m = int(rec['Month'])
+        cpi = float(rec['CPI'])
+        assert cpi > 0.0, 'Non-positive CPI found!'
+
+        p = Period(y, m)
+        assert p not in cpi_ref, 'Duplicate Period found!'
+        cpi_ref[p] = cpi
+    return cpi_ref
+
+
+def compile_cpi(json_file, cache_file=None):
+    """Compile the CPI JSON file created by get-cpi into our binary cache format.
+
+    The cache is written next to the source (json_file + CPI_CACHE_SUFFIX) unless
+    cache_file is given. The header records the source mtime and size so that
+    stale caches can be detected. Returns the name of the cache file."""
+    if not cache_file:
+        cache_file = json_file + CPI_CACHE_SUFFIX
+
+    st = os.stat(json_file)
+    with open(json_file) as inp:
+        cpi_ref = _cpi_ref_from_json(json.load(inp))
+    assert cpi_ref, 'No CPI records found'
+
+    ordinals = dict((_month_ordinal(*p), cpi) for p, cpi in cpi_ref.items())
+    first, last = min(ordinals), max(ordinals)
+    values = [ordinals.get(o, float('nan')) for o in range(first, last + 1)]
+
+    hdr = _CPI_HDR.pack(_CPI_MAGIC, st.st_mtime_ns, st.st_size, first, len(values))
+    body = struct.pack('<%dd' % len(values), *values)
+
+    # Write to a temp file and rename so that readers never see a partial cache
+    cache_dir = os.path.dirname(os.path.abspath(cache_file))
+    fd, tmp_name = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outp:
+            outp.write(hdr)
+            outp.write(body)
+        os.replace(tmp_name, cache_file)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+    return cache_file
+
+
+class _CpiBuffer(object):
+    """Read-only Period => CPI mapping backed by a memory-mapped CPI cache."""
+
+    def __init__(self, cache_file):
+        with open(cache_file, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.src_mtime_ns, self.src_size, self.first, count = _CPI_HDR.unpack_from(self._mm)
+        if magic != _CPI_MAGIC:
+            raise ValueError('{} is not a CPI cache file'.format(cache_file))
+        if len(self._mm) != _CPI_HDR.size + count * 8:
+            raise ValueError('{} is truncated'.format(cache_file))
+        self._vals = memoryview(self._mm)[_CPI_HDR.size:].cast('d')
+
+    def is_current(self, json_file):
+        """Return True if this cache was compiled from json_file as it is now."""
+        st = os.stat(json_file)
+        return st.st_mtime_ns == self.src_mtime_ns and st.st_size == self.src_size
+
+    def get(self, period, default=None):
+        idx = _month_ordinal(period[0], period[1]) - self.first
+        if idx < 0 or idx >= len(self._vals):
+            return default
+        v = self._vals[idx]
+        return default if math.isnan(v) else v
+
+    def __getitem__(self, period):
+        v = self.get(period)
+        if v is None:
+            raise KeyError(period)
+        return v
+
+    def __contains__(self, period):
+        return self.get(period) is not None
+
+    def items(self):
+        for idx, v in enumerate(self._vals):
+            if not math.isnan(v):
+                yr, mth = divmod(self.first + idx, 12)
+                yield Period(yr, mth + 1), v
+
+    def __bool__(self):
+        return len(self._vals) > 0
+
+    def __len__(self):
+        return sum(1 for v in self._vals if not math.isnan(v))
+
 
 class Period(namedtuple('PeriodBase', ['year', 'month'])):
     """Year/month period tuple that can calculate price with CPI and exch adj.
 
     NOTE that before you call cpi or adj_price, you MUST call Period.init_cpi with
     parse result of reading our CPI JSON file that is generated by get_cpi.py.
+    Short-lived processes should prefer Period.init_cpi_file, which memory-maps
+    a compiled copy of the same file.
 
     Exchange SO's are assumed to be fees calculated at EXCH_FEE_RATE of outright
     price. Change the default at your peril."""
@@ -28,17 +149,36 @@ class Period(namedtuple('PeriodBase', ['year', 'month'])):
     @classmethod
     def init_cpi(cls, cpi_json):
         """One time init for CPI lookup from a JSON list."""
-        cpi_ref = dict()
-        for rec in cpi_json:
-            y = int(rec['Year'])
-            m = int(rec['Month'])
-            cpi = float(rec['CPI'])
-            assert cpi > 0.0, 'Non-positive CPI found!'
+        cls._set_cpi_ref(_cpi_ref_from_json(cpi_json))
 
-            p = Period(y, m)
-            assert p not in cpi_ref, 'Duplicate Period found!'
-            cpi_ref[p] = cpi
+    @classmethod
+    def init_cpi_file(cls, json_file):
+        """One time init for CPI lookup from the CPI JSON file.
+
+        The JSON is compiled once into a binary cache next to the source (see
+        compile_cpi) and later calls just memory-map that cache. The cache is
+        rebuilt whenever the source file's mtime or size changes. If the cache
+        can not be written we fall back to parsing the JSON."""
+        cache_file = json_file + CPI_CACHE_SUFFIX
+        cpi_ref = None
+        try:
+            cpi_ref = _CpiBuffer(cache_file)
+            if not cpi_ref.is_current(json_file):
+                cpi_ref = None
+        except (OSError, ValueError, struct.error):
+            cpi_ref = None
+
+        if cpi_ref is None:
+            try:
+                cpi_ref = _CpiBuffer(compile_cpi(json_file, cache_file))
+            except OSError:
+                with open(json_file) as inp:
+                    return cls.init_cpi(json.load(inp))
+
+        cls._set_cpi_ref(cpi_ref)
 
+    @classmethod
+    def _set_cpi_ref(cls, cpi_ref):
         cls.CURR_PERIOD = Period.from_dt(datetime.now())
         assert cls.CURR_PERIOD in cpi_ref, 'CPI reference does not have current period'
 
@@ -77,6 +217,7 @@ class Period(namedtuple('PeriodBase', ['year', 'month'])):
         assert self.CPI_REF, 'BUG: CPI reference not initialized'
         return self.CPI_REF[self]
 
+    @timed('period.Period.adj_price')
     def adj_price(self, price, so_type):
         """Give a final adjusted price for the period relative to CURR_PERIOD."""
         price = float(price)
@@ -0,0 +1,169 @@
+"""Lightweight timing spans and counters.
+
+Profiling is controlled by the DS_PROFILE environment variable (just like
+LOG_LEVEL in cli):
+
+    NONE  - the default: everything here is a no-op
+    TABLE - at exit, log a summary table with cli.log_table
+    JSON  - at exit, write a JSON summary to DS_PROFILE_FILE (or stderr)
+
+Use span as a context manager, timed as a decorator, and count for simple
+counters:
+
+    with span('xl.load'):
+        wb = load_workbook(...)
+
+    @timed('period.adj_price')
+    def adj_price(...):
+
+timed decides at decoration time, so a function decorated while profiling is
+off is returned untouched and costs nothing at all.
+"""
+
+import atexit
+import os
+import sys
+import time
+
+from functools import wraps
+
+PROFILE = os.environ.get('DS_PROFILE', 'NONE').upper().strip()
+ALLOWED_PROFILES = ('NONE', 'TABLE', 'JSON')
+if PROFILE not in ALLOWED_PROFILES:
+    raise ValueError('Only supported DS_PROFILE values are: ' + ','.join(ALLOWED_PROFILES))
+
+PROFILE_FILE = os.environ.get('DS_PROFILE_FILE', '')
+
+ENABLED = PROFILE != 'NONE'
+
+# name => [calls, total secs, max secs]
+_SPANS = {}
+# name => count
+_COUNTERS = {}
+
+_clock = time.perf_counter
+
+
+def record(name, secs):
+    """Add a timing of secs to the span name."""
+    st = _SPANS.get(name)
+    if st is None:
+        _SPANS[name] = [1, secs, secs]
+    else:
+        st[0] += 1
+        st[1] += secs
+        if secs > st[2]:
+            st[2] = secs
+
+
+def count(name, n=1):
+    """Add n to the counter name."""
+    if ENABLED:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + n
+
+
+class _Span(object):
+    __slots__ = ('name', 'began')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.began = _clock()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, _clock() - self.began)
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    """Context manager timing the enclosed block as name."""
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def timed(name=None):
+    """Decorator timing every call to the function (as name if given)."""
+    def _decorate(func):
+        if not ENABLED:
+            return func
+        span_name = name or func.__module__ + '.' + func.__qualname__
+
+        @wraps(func)
+        def _timed(*args, **kwrds):
+            began = _clock()
+            try:
+                return func(*args, **kwrds)
+            finally:
+                record(span_name, _clock() - began)
+        return _timed
+    return _decorate
+
+
+def summary():
+    """Return our spans and counters as a dict (sorted by total time)."""
+    spans = sorted(_SPANS.items(), key=lambda kv: kv[1][1], reverse=True)
+    return {
+        'spans': [
+            {'name': name, 'calls': calls, 'total': total, 'mean': total / calls, 'max': mx}
+            for name, (calls, total, mx) in spans
+        ],
+        'counters': dict(sorted(_COUNTERS.items())),
+    }
+
+
+def reset():
+    """Forget everything recorded so far."""
+    _SPANS.clear()
+    _COUNTERS.clear()
+
+
+def dump(mode=None):
+    """Output our summary as a table (with cli.log_table) or JSON."""
+    mode = mode or PROFILE
+    if mode == 'NONE' or not (_SPANS or _COUNTERS):
+        return
+    smry = summary()
+
+    if mode == 'JSON':
+        import json
+        if PROFILE_FILE:
+            with open(PROFILE_FILE, 'w') as fh:
+                json.dump(smry, fh, indent=2)
+        else:
+            json.dump(smry, sys.stderr, indent=2)
+            sys.stderr.write('\n')
+        return
+
+    from .cli import log_table
+    rows = [['Span', 'Calls', 'Total (s)', 'Mean (ms)', 'Max (ms)']]
+    for s in smry['spans']:
+        rows.append([
+            s['name'],
+            '{:,d}'.format(s['calls']),
+            '{:,.3f}'.format(s['total']),
+            '{:,.3f}'.format(s['mean'] * 1000.0),
+            '{:,.3f}'.format(s['max'] * 1000.0),
+        ])
+    for name, n in smry['counters'].items():
+        rows.append([name, '{:,d}'.format(n), '', '', ''])
+    log_table('Profile', rows, justify_columns={1: 'right', 2: 'right', 3: 'right', 4: 'right'})
+
+
+if ENABLED:
+    atexit.register(dump)
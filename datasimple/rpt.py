@@ -0,0 +1,783 @@
+"""Helpers for SQL Server RPT (fixed-width text report) files.
+
+An RPT file starts with a line of column names and a line of dashes that gives
+the width of every column. Everything after that is fixed-width data with the
+occasional "(N row(s) affected)" line mixed in.
+"""
+
+import csv
+import io
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+
+from array import array
+from collections import deque
+from datetime import datetime, timedelta
+from itertools import chain
+
+from .cli import log, ProgressMeter
+
+
+# Default size of the byte ranges handed to worker processes
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# Bytes of lines decoded and handed to the writer at a time by the byte-level path
+BLOCK_BYTES = 1024 * 1024
+
+# Rows handed to the writer at a time by the line-by-line text path
+TEXT_BATCH_ROWS = 10000
+
+# Rows inserted per executemany call by SqliteSink
+SQLITE_BATCH_ROWS = 10000
+
+# ASCII chars that str.strip() treats as whitespace but bytes.strip() doesn't
+_ODD_WS = (b'\x1c', b'\x1d', b'\x1e', b'\x1f')
+
+
+def _err(msg, *args):
+    if args:
+        msg = msg.format(*args)
+    raise ValueError(msg)
+
+
+class _RowList(list):
+    """Minimal writer that just collects rows."""
+    writerow = list.append
+    writerows = list.extend
+
+
+class ReportProcessor(object):
+    """Process RPT files."""
+
+    def __init__(self, hdrs, delims, writer, write_header=True):
+        self.writer = writer
+        self.count = 0
+        self.rejected = 0
+        self.scanned = 0
+        self.meter = ProgressMeter('RPT rows')
+        self.rejects = [
+            re.compile(r'^\([0-9,]+ row\(s\) affected\)$'),
+        ]
+
+        delim_flds = delims.split()
+        assert len(delim_flds) > 1, 'Could not parse delimiters'
+
+        start = 0
+        self.space_map = list()
+
+        for s in delim_flds:
+            assert len(s.strip('-')) == 0, 'Invalid delimiter spec found'
+
+            ln = len(s)
+            assert ln > 0, 'Empty field makes no sense'
+            assert len(s) == ln, 'Field creation bug'
+
+            self.space_map.append((start, ln))
+            start += (ln + 1)
+
+        if start != len(delims):
+            _err('Expected final pos to be {} but was {}', len(delims), start)
+
+        # Byte-level field extractor for ASCII lines: fields are fixed width
+        # with a single separator byte between them
+        fmt, pos = ['='], 0
+        for st, ln in self.space_map:
+            fmt.append('{:d}x{:d}s'.format(st - pos, ln) if st > pos else '{:d}s'.format(ln))
+            pos = st + ln
+        self.field_struct = struct.Struct(''.join(fmt))
+
+        if write_header and not self._write_line(hdrs):
+            _err('Column name output failed')
+
+    def _reject(self, chk):
+        """Return True (after logging) if the stripped line should be skipped."""
+        if not chk:
+            log('[!r]Skipping blank line[!/r]')
+            return True
+        for r in self.rejects:
+            m = r.match(chk)
+            if m:
+                log('[!r]Skipping line[!/r]: found [!y]{}[!/y]', m.group(0))
+                return True
+        return False
+
+    def _parse_line(self, line):
+        """Return the list of fields in line, or None if it's rejected."""
+        if self._reject(str(line).strip()):
+            return None
+        return [line[st:st + ln].strip() for st, ln in self.space_map]
+
+    def _write_line(self, line):
+        flds = self._parse_line(line)
+        if flds is None:
+            return False
+        self.writer.writerow(flds)
+        return True
+
+    def _special_lines(self):
+        """Return a multi-line bytes regex matching every line we would reject.
+
+        Only works if every reject pattern is anchored at both ends (like ours).
+        Returns None if we can't build one."""
+        ws = rb'[ \t\r\x0b\x0c\x1c-\x1f]*'
+        alts = [b'']
+        for r in self.rejects:
+            p = r.pattern
+            if not p.startswith('^') or not p.endswith('$'):
+                return None
+            alts.append(b'(?:' + p[1:-1].encode('ascii') + b')')
+        return re.compile(b'^' + ws + b'(?:' + b'|'.join(alts) + b')' + ws + b'$', re.MULTILINE)
+
+    def _decode_fields(self, flat):
+        """Decode a flat list of ASCII field bytes into rows of stripped str's."""
+        ncols = len(self.space_map)
+        flat = list(map(bytes.strip, flat))
+        # One decode call for the whole batch: fields can't contain NUL unless
+        # the file is very strange, and we check for that
+        vals = b'\x00'.join(flat).decode('ascii').split('\x00')
+        if len(vals) != len(flat):
+            vals = [f.decode('ascii') for f in flat]
+        return list(map(list, zip(*[iter(vals)] * ncols)))
+
+    def _scan_ascii(self, seg, flat):
+        """Add fields from every line in the ASCII segment seg to flat.
+
+        seg has no rejected lines. If every line is the same length we let
+        struct do all the work; otherwise we go line by line."""
+        if not seg:
+            return
+        width = self.field_struct.size
+        reclen = seg.find(b'\n') + 1
+        nrecs = len(seg) // reclen if reclen else 0
+        if (
+            nrecs and reclen >= width + 1 and len(seg) % reclen == 0 and
+            seg.count(b'\n') == nrecs and seg[reclen - 1::reclen].count(b'\n') == nrecs
+        ):
+            fmt = self.field_struct.format
+            if isinstance(fmt, bytes):
+                fmt = fmt.decode('ascii')
+            rec = struct.Struct(fmt + '{:d}x'.format(reclen - width))
+            flat.extend(chain.from_iterable(rec.iter_unpack(seg)))
+            return
+
+        unpack_from = self.field_struct.unpack_from
+        for line in seg.split(b'\n'):
+            if len(line) < width:
+                if not line:
+                    continue  # After the final newline
+                line = line.ljust(width)
+            flat.extend(unpack_from(line))
+
+    def _scan_block(self, block, encoding, special):
+        """Return the rows in block (which is a whole number of lines)."""
+        ascii_lines = (
+            block.isascii() and
+            block.count(b'\r') == block.count(b'\r\n') and
+            not any(c in block for c in _ODD_WS)
+        )
+        if special is None or not ascii_lines:
+            # Multi-byte chars (byte offsets are no longer char offsets), bare
+            # CR's (text mode treats them as newlines), or control chars that
+            # only str.strip removes: do it like the text path
+            rows = []
+            for line in io.StringIO(block.decode(encoding), newline=None):
+                flds = self._parse_line(line)
+                if flds is None:
+                    self.rejected += 1
+                else:
+                    rows.append(flds)
+            return rows
+
+        flat, pos = [], 0
+        for m in special.finditer(block):
+            if m.start() >= len(block):
+                break  # Empty "line" after the final newline
+            self._scan_ascii(block[pos:m.start()], flat)
+            self._reject(m.group(0).decode('ascii').strip())
+            self.rejected += 1
+            pos = m.end() + 1
+        self._scan_ascii(block[pos:], flat)
+        return self._decode_fields(flat)
+
+    def scan_bytes(self, buf, start, end, encoding, block_bytes=BLOCK_BYTES):
+        """Generator yielding lists of rows parsed from buf[start:end].
+
+        buf is any bytes-like object (we use an mmap of the RPT file) and start
+        must be at the beginning of a line. encoding must be ASCII compatible.
+
+        We work a block of lines at a time. ASCII blocks are sliced as bytes
+        with field_struct and decoded once per block; blocks containing
+        anything else are decoded and handled like the text path. Rejected
+        lines are counted in self.rejected but nothing is written."""
+        special = self._special_lines()
+        pos = start
+        while pos < end:
+            blk_end = pos + block_bytes
+            if blk_end < end:
+                nl = buf.find(b'\n', blk_end - 1, end)
+                blk_end = nl + 1 if nl >= 0 else end
+            blk_end = min(blk_end, end)
+            rows = self._scan_block(bytes(buf[pos:blk_end]), encoding, special)
+            self.scanned += blk_end - pos
+            if rows:
+                yield rows
+            pos = blk_end
+
+    def process(self, line):
+        """Parse and write out the given line."""
+        if not self._write_line(line):
+            self.rejected += 1
+            return
+
+        self.count += 1
+        if self.count % 1000 == 0:
+            self.meter.update(1000)
+
+    def done(self):
+        """Do any final processing."""
+        log('Processing complete: wrote [!g]{:,d}[!/g], skipped [!y]{:,d}[!/y]', self.count, self.rejected)
+        self.meter.rows = self.count
+        self.meter.done()
+
+
+def _ascii_compatible(encoding):
+    """Return True if ASCII text (including newlines) is stored as-is in encoding.
+
+    We check decoding rather than encoding so that utf-8-sig passes."""
+    ascii_bytes = bytes(range(128))
+    try:
+        return ascii_bytes.decode(encoding) == ascii_bytes.decode('ascii')
+    except (LookupError, UnicodeError):
+        return False
+
+
+def _read_header(input_file, encoding):
+    """Return (hdrs, delims, data_start) for input_file.
+
+    The header lines are read as bytes so we know where the data starts, then
+    decoded exactly like text mode would (including dropping any BOM)."""
+    with open(input_file, 'rb') as inp:
+        hdr_bytes = inp.readline() + inp.readline()
+        data_start = inp.tell()
+    hdr_inp = io.TextIOWrapper(io.BytesIO(hdr_bytes), encoding=encoding)
+    hdrs = hdr_inp.readline()
+    delims = hdr_inp.readline()
+    assert hdrs.strip(), 'Missing headers'
+    assert delims.strip(), 'Missing delimiters'
+    return hdrs, delims, data_start
+
+
+def _chunk_ranges(input_file, start, chunk_bytes):
+    """Yield (start, end) byte ranges from start to EOF ending on line boundaries."""
+    size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as fh:
+        pos = start
+        while pos < size:
+            end = pos + chunk_bytes
+            if end < size:
+                fh.seek(end)
+                fh.readline()
+                end = fh.tell()
+            end = min(end, size)
+            yield pos, end
+            pos = end
+
+
+def _process_chunk(job):
+    """Worker entry point: parse one byte range of an RPT file."""
+    input_file, encoding, hdrs, delims, start, end = job
+    began = time.time()
+
+    rows = []
+    processor = ReportProcessor(hdrs, delims, None, write_header=False)
+    with open(input_file, 'rb') as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for batch in processor.scan_bytes(mm, start, end, encoding):
+                rows.extend(batch)
+
+    return rows, processor.rejected, end - start, time.time() - began
+
+
+class RptReader(object):
+    """Read the rows of an RPT file, header row first.
+
+    Iterate over the reader for single rows, or call batches() for lists of
+    rows. After iteration, processor holds the ReportProcessor used (for count
+    and rejected) and chunks is the number of byte ranges the pool parsed.
+
+    If fast then the file is memory-mapped and parsed a block at a time with
+    ReportProcessor.scan_bytes. If processes > 1 then the data is also split
+    into byte ranges on line boundaries and parsed by a process pool. Rows
+    are still returned in file order. Encodings that aren't ASCII compatible
+    (like utf-16) always use the original line-by-line text path."""
+
+    def __init__(self, input_file, encoding='utf-8-sig', processes=1, chunk_bytes=CHUNK_BYTES, fast=True):
+        if not _ascii_compatible(encoding):
+            if processes > 1 or fast:
+                log('[!y]Encoding {} requires line-by-line processing: using 1 process[!/y]', encoding)
+            processes, fast = 1, False
+        if processes > 1:
+            fast = True
+
+        self.input_file = input_file
+        self.encoding = encoding
+        self.processes = processes
+        self.chunk_bytes = chunk_bytes
+        self.fast = fast
+        self.processor = None
+        self.chunks = 0
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def columns_and_rows(self):
+        """Return (cols, rows) just like XlsxImporter.get_data expects."""
+        rows = iter(self)
+        return next(rows), rows
+
+    def batches(self):
+        """Generator yielding lists of rows. The first list is just the header."""
+        if not self.fast:
+            yield from self._text_batches()
+        elif self.processes <= 1:
+            yield from self._mmap_batches()
+        else:
+            yield from self._pool_batches()
+        self.processor.done()
+
+    def _counted(self, rows, nbytes):
+        self.processor.count += len(rows)
+        self.processor.meter.update(len(rows), nbytes)
+        return rows
+
+    def _text_batches(self):
+        with open(self.input_file, encoding=self.encoding) as inp:
+            hdrs = next(inp)
+            delims = next(inp)
+            assert hdrs.strip(), 'Missing headers'
+            assert delims.strip(), 'Missing delimiters'
+
+            rows = _RowList()
+            self.processor = processor = ReportProcessor(hdrs, delims, rows)
+            yield rows
+
+            processor.writer = rows = _RowList()
+            for line in inp:
+                processor.process(line)
+                if len(rows) >= TEXT_BATCH_ROWS:
+                    yield rows
+                    processor.writer = rows = _RowList()
+            if rows:
+                yield rows
+
+    def _header(self):
+        hdrs, delims, data_start = _read_header(self.input_file, self.encoding)
+        rows = _RowList()
+        self.processor = ReportProcessor(hdrs, delims, rows)
+        self.processor.meter.total_bytes = os.path.getsize(self.input_file) - data_start
+        return hdrs, delims, data_start, rows
+
+    def _mmap_batches(self):
+        hdrs, delims, data_start, header = self._header()
+        yield header
+
+        processor = self.processor
+        with open(self.input_file, 'rb') as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                done = 0
+                for rows in processor.scan_bytes(mm, data_start, len(mm), self.encoding):
+                    yield self._counted(rows, processor.scanned - done)
+                    done = processor.scanned
+
+    def _pool_batches(self):
+        hdrs, delims, data_start, header = self._header()
+        yield header
+
+        processor = self.processor
+
+        def _finish(idx, result):
+            rows, rejected, nbytes, elapsed = result
+            self._counted(rows, nbytes)
+            self.chunks += 1
+            processor.rejected += rejected
+            log(
+                'Chunk [!c]{:,d}[!/c]: [!g]{:,d}[!/g] rows, [!g]{:.1f}[!/g] MB in {:.2f}s ([!g]{:,.0f}[!/g] rows/s)',
+                idx, len(rows), nbytes / 1048576.0, elapsed, len(rows) / max(elapsed, 1e-6)
+            )
+            return rows
+
+        import multiprocessing
+        with multiprocessing.Pool(self.processes) as pool:
+            # Keep a bounded window of outstanding chunks so that a slow
+            # consumer doesn't let parsed rows pile up in memory
+            pending = deque()
+            ranges = _chunk_ranges(self.input_file, data_start, self.chunk_bytes)
+            for idx, (start, end) in enumerate(ranges):
+                job = (self.input_file, self.encoding, hdrs, delims, start, end)
+                pending.append((idx, pool.apply_async(_process_chunk, (job,))))
+                if len(pending) >= self.processes * 2:
+                    i, res = pending.popleft()
+                    yield _finish(i, res.get())
+            while pending:
+                i, res = pending.popleft()
+                yield _finish(i, res.get())
+
+
+def process_rpt(input_file, writer, encoding='utf-8-sig', processes=1, chunk_bytes=CHUNK_BYTES, fast=True):
+    """Parse input_file and write the header and all data rows to writer.
+
+    writer needs writerows, so a csv.writer or any of our sinks work. See
+    RptReader for the other parameters.
+
+    Returns the ReportProcessor used (for count and rejected)."""
+    reader = RptReader(input_file, encoding, processes, chunk_bytes, fast)
+    for rows in reader.batches():
+        writer.writerows(rows)
+    return reader.processor
+
+
+class CsvSink(object):
+    """Sink writing rows to a CSV file, quoting every field."""
+
+    def __init__(self, output_file):
+        self.fh = open(output_file, 'w', buffering=1024 * 1024)
+        self.writer = csv.writer(self.fh, quoting=csv.QUOTE_ALL)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.fh.close()
+
+
+class SqliteSink(object):
+    """Sink inserting rows into a (re-created) table in a SQLite database.
+
+    The first row written must be the column names. Rows are inserted with
+    executemany in batches of batch_rows and everything is committed on
+    close."""
+
+    def __init__(self, db_file, table, batch_rows=SQLITE_BATCH_ROWS):
+        from .sqlite import connect
+        self.conn = connect(db_file)
+        self.table = table
+        self.batch_rows = batch_rows
+        self.insert_sql = None
+        self.pending = []
+        self.count = 0
+
+    def _create(self, cols):
+        names, seen = [], set()
+        for idx, c in enumerate(cols):
+            c = str(c).strip() or 'col{:d}'.format(idx + 1)
+            name, dup = c, 1
+            while name.lower() in seen:
+                dup += 1
+                name = '{}_{:d}'.format(c, dup)
+            seen.add(name.lower())
+            names.append(name)
+
+        from .sqlite import quote_name
+        tab = quote_name(self.table)
+        self.conn.execute('DROP TABLE IF EXISTS {}'.format(tab))
+        self.conn.execute('CREATE TABLE {} ({})'.format(tab, ', '.join(quote_name(n) for n in names)))
+        self.insert_sql = 'INSERT INTO {} VALUES ({})'.format(tab, ', '.join('?' * len(names)))
+        log('Created table [!c]{}[!/c] with [!g]{:d}[!/g] columns', self.table, len(names))
+
+    def _flush(self):
+        if self.pending:
+            self.conn.executemany(self.insert_sql, self.pending)
+            self.count += len(self.pending)
+            self.pending = []
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        rows = iter(rows)
+        if self.insert_sql is None:
+            cols = next(rows, None)
+            if cols is None:
+                return
+            self._create(cols)
+        self.pending.extend(rows)
+        if len(self.pending) >= self.batch_rows:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self.conn.commit()
+        self.conn.close()
+
+
+# Numpy .npy details for NpySink: we write version 1.0 files ourselves so
+# that numpy is only needed by whoever reads them
+_NPY_MAGIC = b'\x93NUMPY\x01\x00'
+_NPY_HDR_LEN = 128  # Total header size (magic and all), leaving room for any shape
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+_INT_NA = -2 ** 63  # Also numpy's NaT for datetime64
+
+NPY_TYPES = {
+    'int': '<i8',
+    'float': '<f8',
+    'date': '<M8[D]',
+    'datetime': '<M8[ms]',
+}
+
+# Zero padded codes (like part numbers) and things like 1_000 aren't numbers
+# to us, even though Python would parse them
+_NOT_NUMBER_RE = re.compile(r'^\s*[-+]?0[0-9]|_')
+
+_ISO_DATE_RE = re.compile(r'([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})')
+
+# A time after a date: SQL Server writes 12:34:56.000 (datetime2 has up to
+# 7 fractional digits, but we keep milliseconds)
+_TIME_RE = re.compile(r'([0-9]{1,2}):([0-9]{2})(?::([0-9]{2})(?:\.([0-9]{1,7}))?)?')
+
+
+def _parse_int(v):
+    if _NOT_NUMBER_RE.search(v):
+        raise ValueError('Not an int: {!r}'.format(v))
+    return int(v)
+
+
+def _parse_float(v):
+    if _NOT_NUMBER_RE.search(v):
+        raise ValueError('Not a float: {!r}'.format(v))
+    return float(v)
+
+
+def _parse_when(v):
+    """(datetime, whether there was a time) for all of v.
+
+    v is a date (m/d/y or m/y like ds_datetime, or ISO), optionally followed
+    by a space and a time. Anything else raises ValueError."""
+    from .core import parse_date
+    day, _, tm = v.strip().partition(' ')
+    d = parse_date(day) if day else None
+    if d is None:
+        m = _ISO_DATE_RE.fullmatch(day)
+        if not m:
+            raise ValueError('Not a date: {!r}'.format(v))
+        d = datetime(*map(int, m.groups()))
+
+    tm = tm.strip()
+    if not tm:
+        return d, False
+    m = _TIME_RE.fullmatch(tm)
+    if not m:
+        raise ValueError('Not a time: {!r}'.format(v))
+    hour, minute, sec, frac = m.groups()
+    usec = int((frac or '0')[:3].ljust(6, '0'))
+    return d.replace(hour=int(hour), minute=int(minute), second=int(sec or 0), microsecond=usec), True
+
+
+def _parse_date(v):
+    """Days since 1970-01-01 for v: values with a time aren't dates."""
+    d, has_time = _parse_when(v)
+    if has_time:
+        raise ValueError('Not just a date: {!r}'.format(v))
+    return d.toordinal() - _EPOCH_ORDINAL
+
+
+def _parse_datetime(v):
+    """Milliseconds since 1970-01-01 for v (a date, or a date and time)."""
+    d, _ = _parse_when(v)
+    return (d - _EPOCH) // timedelta(milliseconds=1)
+
+
+_PARSERS = [
+    ('int', _parse_int), ('float', _parse_float), ('date', _parse_date), ('datetime', _parse_datetime),
+]
+
+
+def infer_type(vals):
+    """Return 'int', 'float', 'date', 'datetime' or 'str' for the sample vals.
+
+    Empty values are ignored, except that an int column with empty values is
+    returned as float (so they can be NaN). No values at all gives str."""
+    present = [v for v in vals if v != '']
+    if not present:
+        return 'str'
+    for name, parse in _PARSERS:
+        try:
+            for v in present:
+                parse(v)
+        except (ValueError, TypeError, OverflowError):
+            continue
+        if name == 'int' and len(present) < len(vals):
+            return 'float'
+        return name
+    return 'str'
+
+
+def _npy_header(descr, count):
+    hdr = "{{'descr': '{}', 'fortran_order': False, 'shape': ({:d},), }}".format(descr, count)
+    hdr = hdr.ljust(_NPY_HDR_LEN - len(_NPY_MAGIC) - 3) + '\n'
+    return _NPY_MAGIC + struct.pack('<H', len(hdr)) + hdr.encode('ascii')
+
+
+class _NpyColumn(object):
+    """One column being written to a .npy file."""
+
+    def __init__(self, name, file_name, typ, str_width):
+        self.name = name
+        self.file_name = file_name
+        self.typ = typ
+        self.count = 0
+        self.failed = 0
+        if typ == 'str':
+            self.str_width = max(str_width, 1)
+            self.descr = '<U{:d}'.format(self.str_width)
+        else:
+            self.descr = NPY_TYPES[typ]
+        self.fh = open(file_name, 'wb')
+        self.fh.write(_npy_header(self.descr, 0))
+
+    def _convert(self, v, parse, na):
+        if v == '':
+            return na
+        try:
+            return parse(v)
+        except (ValueError, TypeError, OverflowError):
+            self.failed += 1
+            return na
+
+    def write(self, vals):
+        if self.typ == 'str':
+            width = self.str_width
+            data = []
+            for v in vals:
+                if len(v) > width:
+                    self.failed += 1
+                    v = v[:width]
+                data.append(v.encode('utf-32-le').ljust(width * 4, b'\x00'))
+            self.fh.write(b''.join(data))
+        else:
+            if self.typ == 'float':
+                arr = array('d', [self._convert(v, _parse_float, float('nan')) for v in vals])
+            elif self.typ == 'int':
+                arr = array('q', [self._convert(v, _parse_int, _INT_NA) for v in vals])
+            else:
+                parse = _parse_date if self.typ == 'date' else _parse_datetime
+                arr = array('q', [self._convert(v, parse, _INT_NA) for v in vals])
+            if sys.byteorder != 'little':
+                arr.byteswap()
+            arr.tofile(self.fh)
+        self.count += len(vals)
+
+    def close(self):
+        self.fh.seek(0)
+        self.fh.write(_npy_header(self.descr, self.count))
+        self.fh.close()
+
+
+class NpySink(object):
+    """Sink writing typed columns: one numpy .npy file per column.
+
+    The first row written must be the column names. Column types are inferred
+    from the first sample_rows rows (see infer_type): ints are int64, floats
+    are float64 (NaN for missing), dates are datetime64[D] and dates with
+    times datetime64[ms] (NaT for missing), and everything else is a fixed-width unicode string. str_widths (like the
+    RPT field widths) sets the string widths; otherwise we use the longest
+    value in the sample. Values that don't fit their column's type later on
+    are stored as missing/truncated and counted.
+
+    output_dir gets the .npy files and schema.json describing them, so
+    consumers can numpy.load(..., mmap_mode='r') instead of parsing CSV."""
+
+    def __init__(self, output_dir, sample_rows=1000, str_widths=None):
+        self.output_dir = output_dir
+        self.sample_rows = sample_rows
+        self.str_widths = str_widths
+        self.cols = None
+        self.sample = []
+        self.columns = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _start(self):
+        self.columns = []
+        for idx, name in enumerate(self.cols):
+            vals = [r[idx] if idx < len(r) else '' for r in self.sample]
+            typ = infer_type(vals)
+            if self.str_widths:
+                width = self.str_widths[idx]
+            else:
+                width = max([len(v) for v in vals] + [1])
+            safe = re.sub(r'[^0-9A-Za-z_]+', '_', str(name)).strip('_')
+            file_name = os.path.join(self.output_dir, 'c{:03d}_{}.npy'.format(idx, safe))
+            self.columns.append(_NpyColumn(str(name), file_name, typ, width))
+            log('Column [!c]{}[!/c] => [!g]{}[!/g]', name, typ)
+
+        sample, self.sample = self.sample, None
+        self._write(sample)
+
+    def _write(self, rows):
+        if not rows:
+            return
+        ncols = len(self.columns)
+        if any(len(r) > ncols for r in rows):
+            raise ValueError('Found a row with more than {} fields'.format(ncols))
+        for idx, col in enumerate(self.columns):
+            col.write([r[idx] if idx < len(r) else '' for r in rows])
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        rows = iter(rows)
+        if self.cols is None:
+            self.cols = next(rows, None)
+            if self.cols is None:
+                return
+        if self.columns is None:
+            self.sample.extend(rows)
+            if len(self.sample) >= self.sample_rows:
+                self._start()
+        else:
+            self._write(list(rows))
+
+    def close(self):
+        if self.cols is None:
+            self.cols = []
+        if self.columns is None:
+            self._start()
+
+        schema = []
+        for col in self.columns:
+            col.close()
+            if col.failed:
+                log('[!y]Column {} had {:,d} values not stored as {}[!/y]', col.name, col.failed, col.typ)
+            schema.append({
+                'name': col.name,
+                'file': os.path.basename(col.file_name),
+                'type': col.typ,
+                'dtype': col.descr,
+                'count': col.count,
+                'failed': col.failed,
+            })
+        with open(os.path.join(self.output_dir, 'schema.json'), 'w') as outp:
+            json.dump({'columns': schema}, outp, indent=2)
+
+
+def load_npy_columns(output_dir, mmap_mode='r'):
+    """Return an ordered list of (name, numpy array) from an NpySink directory.
+
+    Requires numpy (which datasimple itself does not)."""
+    import numpy
+    with open(os.path.join(output_dir, 'schema.json')) as inp:
+        schema = json.load(inp)
+    return [
+        (col['name'], numpy.load(os.path.join(output_dir, col['file']), mmap_mode=mmap_mode))
+        for col in schema['columns']
+    ]
@@ -5,14 +5,20 @@ This is meant to be imported as: `import datasimple.sqlite as sqlite3`
 Important: we're only implementing things as we need them.
 """
 
+import os
+import re
 import sqlite3
 import sys
+import time
 
+from contextlib import closing
 from datetime import datetime
 
-from .core import norm_ws, comppart
+from .core import comppart, cache_dir, parse_date
+from .profile import span, timed
 
 
+@timed('sqlite.udf.comppart')
 def _db_comppart(p):
     # Swallow exceptions for a sqlite function
     try:
@@ -21,29 +27,7 @@ def _db_comppart(p):
         sys.stderr.write('Error with user function:' + repr(e) + '\n')
 
 
-def _db_customdate_parse(s):
-    # manually parse strange date formats
-    s = norm_ws(s).split(' ')[0]  # Only up to first space (no time)
-    flds = s.split('/')
-    if len(flds) == 3:
-        mth, day, yr = flds  # m/d/y
-    elif len(flds) == 2:
-        mth, yr = flds  # m/y
-        day = 1
-    else:
-        return None
-
-    # We go ahead and fail if we can't get our components into int's
-    mth, day, yr = (int(f.lstrip('0')) for f in [mth, day, yr])
-
-    # y2k
-    if yr < 100:
-        yr += 2000
-
-    # Finally done
-    return datetime(yr, mth, day)
-
-
+@timed('sqlite.udf.ds_datetime')
 def _db_datetime(s):
     try:
         if not s:
@@ -52,7 +36,7 @@ def _db_datetime(s):
         if not s:
             return None
         try:
-            return _db_customdate_parse(s).strftime('%Y-%m-%d')
+            return parse_date(s).strftime('%Y-%m-%d')
         except ValueError as ve:
             return s  # Malformed string - just return the string
     except Exception as e:
@@ -60,14 +44,458 @@ def _db_datetime(s):
         sys.stderr.write('Error with user function:' + repr(e) + '\n')
 
 
-def connect(path):
-    """Replace connect that injects our comppart function."""
-    conn = sqlite3.connect(path)
+# (CPI reference, current period, lookup) for the last reference we saw
+_CPI_LOOKUP = (None, None, None)
+
+
+def _cpi_lookup():
+    """(year, month) => (CPI, adjustment factor) for Period's CPI reference.
+
+    Built once per Period.init_cpi/init_cpi_file: the factor is the same
+    now CPI / period CPI ratio that Period.adj_price calculates every call."""
+    global _CPI_LOOKUP
+    from .period import Period
+
+    cpi_ref, curr = Period.CPI_REF, Period.CURR_PERIOD
+    if not cpi_ref:
+        raise ValueError('CPI reference not initialized: call Period.init_cpi or Period.init_cpi_file')
+    if _CPI_LOOKUP[0] is not cpi_ref or _CPI_LOOKUP[1] != curr:
+        now_cpi = cpi_ref[curr]
+        lookup = dict(((int(y), int(m)), (cpi, now_cpi / cpi)) for (y, m), cpi in cpi_ref.items())
+        _CPI_LOOKUP = (cpi_ref, curr, lookup)
+    return _CPI_LOOKUP[2]
+
+
+def _register_cpi(conn, cpi):
+    """Add ds_cpi, ds_adj_price and ds_sum_adj_price to conn."""
+    from .period import Period
+
+    if type(cpi) is str:
+        Period.init_cpi_file(cpi)
+    elif type(cpi) is list:
+        Period.init_cpi(cpi)
+    lookup = _cpi_lookup()
+    exch_rate = Period.EXCH_FEE_RATE
+
+    def _adj_price(year, month, price, so_type):
+        if year is None or month is None or price is None:
+            return None
+        price = float(price)
+        if price <= 0.0:
+            raise ValueError('Price must be positive: {!r}'.format(price))
+        so_type = str(so_type).strip().upper()
+        if so_type in {'CE', 'FE'}:
+            price /= exch_rate
+        elif so_type not in {'SO'}:
+            raise ValueError('Unknown SO Type {}'.format(so_type))
+        return price * lookup[(int(year), int(month))][1]
+
+    @timed('sqlite.udf.ds_cpi')
+    def _db_cpi(year, month):
+        try:
+            found = lookup.get((int(year), int(month)))
+            return found[0] if found else None
+        except Exception as e:
+            sys.stderr.write('Error with user function:' + repr(e) + '\n')
+
+    @timed('sqlite.udf.ds_adj_price')
+    def _db_adj_price(year, month, price, so_type):
+        try:
+            return _adj_price(year, month, price, so_type)
+        except Exception as e:
+            sys.stderr.write('Error with user function:' + repr(e) + '\n')
+
+    class _SumAdjPrice(object):
+        def __init__(self):
+            self.total = None
+
+        def step(self, year, month, price, so_type):
+            v = _db_adj_price(year, month, price, so_type)
+            if v is not None:
+                self.total = v if self.total is None else self.total + v
+
+        def finalize(self):
+            return self.total
+
+    try:
+        conn.create_function('ds_cpi', 2, _db_cpi, deterministic=True)
+        conn.create_function('ds_adj_price', 4, _db_adj_price, deterministic=True)
+    except (TypeError, sqlite3.NotSupportedError):
+        # deterministic needs Python 3.8 and SQLite 3.8.3
+        conn.create_function('ds_cpi', 2, _db_cpi)
+        conn.create_function('ds_adj_price', 4, _db_adj_price)
+    conn.create_aggregate('ds_sum_adj_price', 4, _SumAdjPrice)
+
+
+def connect(path, cpi=None, read_only=False):
+    """Replace connect that injects our comppart function.
+
+    With read_only the database file is opened read-only (it must exist).
+    If cpi is given we also add CPI functions that work like
+    period.Period: ds_cpi(year, month), ds_adj_price(year, month, price,
+    so_type) and the aggregate ds_sum_adj_price with the same arguments.
+    cpi is True to use the CPI reference Period already has, a CPI JSON
+    file name (for Period.init_cpi_file) or the parsed JSON list (for
+    Period.init_cpi). Bad input gives NULL, like our other functions."""
+    if read_only:
+        from urllib.request import pathname2url
+        conn = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(path))), uri=True)
+    else:
+        conn = sqlite3.connect(path)
     conn.create_function('comppart', 1, _db_comppart)
     conn.create_function('ds_datetime', 1, _db_datetime)
+    if cpi:
+        _register_cpi(conn, cpi)
     return conn
 
 
+# Rows per executemany when materializing a sheet
+XLSX_BATCH = 5000
+
+
+def quote_name(name):
+    """name quoted as an SQL identifier."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _cell(v):
+    if v == '':
+        return None
+    if isinstance(v, datetime):
+        return v.isoformat(' ')
+    return v
+
+
+def _xlsx_stamp(cache_file):
+    """(path, sheet, mtime_ns, size) the cache file was built from, or None."""
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        conn = sqlite3.connect(cache_file)
+        try:
+            return tuple(conn.execute('select path, sheet, mtime_ns, size from xlsx_source').fetchone())
+        finally:
+            conn.close()
+    except (sqlite3.Error, TypeError):
+        return None
+
+
+def _xlsx_build(cache_file, xlsx_file, sheet_name, stamp):
+    """Materialize the sheet into a new cache_file (replaced atomically)."""
+    import tempfile
+    from .xl import ws_scan_raw
+
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix='.tmp')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(tmp_name)
+        try:
+            conn.execute('pragma journal_mode = off')
+            conn.execute('pragma synchronous = off')
+            rows = ws_scan_raw(xlsx_file, sheet_name)
+            header = next(rows, [])
+
+            # Like ws_scan: no header means no column, and the last of a
+            # duplicated header wins (SQLite column names ignore case)
+            cols = {}
+            for idx, k in enumerate(header):
+                k = str(k)
+                if k:
+                    cols[k.lower()] = (k, idx)
+            names, idxs = zip(*cols.values()) if cols else (('_empty',), ())
+            conn.execute('create table sheet ({})'.format(', '.join(quote_name(n) for n in names)))
+            insert = 'insert into sheet values ({})'.format(', '.join('?' * len(names)))
+
+            count = 0
+            batch = []
+            for vals in rows:
+                nvals = len(vals)
+                batch.append([_cell(vals[i]) if i < nvals else None for i in idxs] or [None])
+                if len(batch) >= XLSX_BATCH:
+                    conn.executemany(insert, batch)
+                    count += len(batch)
+                    batch = []
+            conn.executemany(insert, batch)
+            count += len(batch)
+
+            conn.execute('create table xlsx_source (path, sheet, mtime_ns, size, rows)')
+            conn.execute('insert into xlsx_source values (?, ?, ?, ?, ?)', stamp + (count,))
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(tmp_name, cache_file)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+
+def attach_xlsx(conn, xlsx_file, sheet_name, name=None):
+    """Make sheet_name in xlsx_file a table (really a temp view) in conn.
+
+    The first row is the header, as with xl.ws_scan, and empty cells are
+    NULL. The sheet is read once into a SQLite file in cache_dir('xlsx')
+    keyed by the workbook's path and sheet name, and rebuilt only when the
+    workbook's mtime or size change, so later calls (from any process) just
+    attach the cached copy. name defaults to the sheet name with anything
+    but letters, digits and _ replaced by _. Returns name."""
+    if name is None:
+        name = re.sub(r'\W', '_', sheet_name)
+    if not re.match(r'^[A-Za-z_]\w*$', name):
+        raise ValueError('Invalid table name {}'.format(name))
+
+    import hashlib
+    path = os.path.abspath(xlsx_file)
+    st = os.stat(path)
+    stamp = (path, sheet_name, st.st_mtime_ns, st.st_size)
+    key = hashlib.sha1('{}\0{}'.format(path, sheet_name).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(cache_dir('xlsx'), key + '.sqlite')
+
+    if _xlsx_stamp(cache_file) != stamp:
+        with span('sqlite.attach_xlsx.build'):
+            _xlsx_build(cache_file, xlsx_file, sheet_name, stamp)
+
+    schema = 'xlsx_' + name
+    if any(row[1] == schema for row in conn.execute('pragma database_list')):
+        conn.execute('drop view if exists temp.{}'.format(quote_name(name)))
+        conn.execute('detach database {}'.format(quote_name(schema)))
+    conn.execute('attach database ? as {}'.format(quote_name(schema)), (cache_file,))
+    conn.execute('create temp view {} as select * from {}.sheet'.format(quote_name(name), quote_name(schema)))
+    return name
+
+
+QCACHE_SUFFIX = '.qcache.sqlite'
+QCACHE_MAX_BYTES = 256 * 1024 * 1024
+
+QCACHE_SCHEMA = """
+create table if not exists results (
+    key text primary key,
+    sql text not null,
+    rows blob not null,
+    bytes integer not null,
+    last_used real not null,
+    hits integer not null default 0
+);
+create index if not exists results_lru on results (last_used);
+create table if not exists stats (name text primary key, value integer not null);
+"""
+
+# Quoted strings and identifiers (kept as-is) or runs of whitespace
+_SQL_TOKENS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])|\s+""")
+
+
+def normalize_sql(sql):
+    """SQL with whitespace outside of quotes collapsed and no trailing ;"""
+    sql = _SQL_TOKENS.sub(lambda m: m.group(1) or ' ', sql).strip()
+    return sql.rstrip(';').rstrip()
+
+
+# Header bytes that change with the content: the file change counter of a
+# database file, and the checkpoint sequence and salts of a -wal file
+_DB_HDR_STAMP = slice(24, 28)
+_WAL_HDR_STAMP = slice(12, 24)
+
+
+def _source_stamps(conn):
+    """(schema, file, mtime_ns, size, header stamp) for every database conn reads.
+
+    mtime and size alone can miss a change: a page rewritten in place within
+    the mtime resolution of the file system leaves both alone. So we also
+    keep the bytes of the file header that SQLite changes on every commit.
+
+    None if some data isn't in a file (in-memory databases, temp tables or
+    uncommitted changes), since then we can't tell when it changes."""
+    if conn.in_transaction:
+        return None
+    stamps = []
+    for _, schema, file_name in conn.execute('pragma database_list'):
+        if schema == 'temp':
+            tables = conn.execute("select count(*) from temp.sqlite_master where type = 'table'").fetchone()[0]
+            if tables:
+                return None
+            continue
+        if not file_name:
+            return None
+        for fn, hdr in ((file_name, _DB_HDR_STAMP), (file_name + '-wal', _WAL_HDR_STAMP)):
+            try:
+                with open(fn, 'rb') as fh:
+                    st = os.fstat(fh.fileno())
+                    stamp = fh.read(hdr.stop)[hdr]
+            except FileNotFoundError:
+                continue
+            stamps.append((schema, fn, st.st_mtime_ns, st.st_size, stamp))
+    return stamps
+
+
+class QueryCache(object):
+    """Cache of query results in a sidecar SQLite file.
+
+    Results are keyed by normalized SQL, parameters and the mtime, size and
+    change counters of every database file the connection has attached, so
+    a result is reused until one of those files changes. Once the cache holds more than
+    max_bytes of results the least recently used are dropped. Hit and miss
+    counts are kept in the cache file (see stats).
+
+    Results are pickled, so only use cache files you created."""
+
+    def __init__(self, cache_file, max_bytes=QCACHE_MAX_BYTES):
+        self.cache_file = cache_file
+        self.max_bytes = max_bytes
+        self._conn = sqlite3.connect(cache_file, timeout=30)
+        self._conn.executescript(QCACHE_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _count(self, name, n=1):
+        # Not an upsert, which needs SQLite 3.24
+        self._conn.execute('insert or ignore into stats (name, value) values (?, 0)', (name,))
+        self._conn.execute('update stats set value = value + ? where name = ?', (n, name))
+
+    def query(self, conn, sql, params=()):
+        """Return conn.execute(sql, params).fetchall(), from the cache if we can."""
+        import hashlib
+        import pickle
+        stamps = _source_stamps(conn)
+        if stamps is None:
+            with self._conn:
+                self._count('uncacheable')
+            return conn.execute(sql, params).fetchall()
+
+        sql = normalize_sql(sql)
+        args = sorted(params.items()) if isinstance(params, dict) else list(params)
+        key = hashlib.sha1(pickle.dumps((sql, args, stamps), protocol=4)).hexdigest()
+        found = self._conn.execute('select rows from results where key = ?', (key,)).fetchone()
+        if found:
+            with self._conn:
+                self._conn.execute(
+                    'update results set last_used = ?, hits = hits + 1 where key = ?', (time.time(), key)
+                )
+                self._count('hits')
+            return pickle.loads(found[0])
+
+        with span('sqlite.cached_query.miss'):
+            rows = conn.execute(sql, params).fetchall()
+        data = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._conn:
+            self._count('misses')
+            if len(data) <= self.max_bytes:
+                self._conn.execute(
+                    'insert or replace into results (key, sql, rows, bytes, last_used) values (?, ?, ?, ?, ?)',
+                    (key, sql, data, len(data), time.time())
+                )
+                self._evict()
+        return rows
+
+    def _evict(self):
+        total = self._conn.execute('select coalesce(sum(bytes), 0) from results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for key, nbytes in self._conn.execute('select key, bytes from results order by last_used'):
+            victims.append((key,))
+            total -= nbytes
+            if total <= self.max_bytes:
+                break
+        self._conn.executemany('delete from results where key = ?', victims)
+        self._count('evictions', len(victims))
+
+    def stats(self):
+        """Dict of hits, misses, uncacheable, evictions, entries and bytes."""
+        found = dict(self._conn.execute('select name, value from stats'))
+        entries, nbytes = self._conn.execute('select count(*), coalesce(sum(bytes), 0) from results').fetchone()
+        return {
+            'hits': found.get('hits', 0),
+            'misses': found.get('misses', 0),
+            'uncacheable': found.get('uncacheable', 0),
+            'evictions': found.get('evictions', 0),
+            'entries': entries,
+            'bytes': nbytes,
+        }
+
+    def clear(self):
+        """Forget every result and reset the stats."""
+        with self._conn:
+            self._conn.execute('delete from results')
+            self._conn.execute('delete from stats')
+
+
+def cached_query(conn, sql, params=(), cache_file=None, max_bytes=QCACHE_MAX_BYTES):
+    """QueryCache.query with the cache next to conn's main database.
+
+    cache_file defaults to the main database file + QCACHE_SUFFIX. For
+    in-memory databases the query just runs."""
+    if not cache_file:
+        main = [fn for _, schema, fn in conn.execute('pragma database_list') if schema == 'main']
+        if not main or not main[0]:
+            return conn.execute(sql, params).fetchall()
+        cache_file = main[0] + QCACHE_SUFFIX
+    with QueryCache(cache_file, max_bytes) as cache:
+        return cache.query(conn, sql, params)
+
+
+def _partition_conn(db_file, table, lo, hi, cpi):
+    """Read-only connection where table only has rowids lo <= rowid < hi.
+
+    A temp view named like the table hides it, since SQLite looks for
+    unqualified names in temp first."""
+    conn = connect(db_file, cpi=cpi, read_only=True)
+    conn.execute('create temp view {} as select * from main.{} where rowid >= {:d} and rowid < {:d}'.format(
+        quote_name(table), quote_name(table), lo, hi
+    ))
+    return conn
+
+
+def _query_partition(job):
+    """Rows of the query for one rowid range (worker entry point)."""
+    db_file, sql, params, table, lo, hi, cpi = job
+    conn = _partition_conn(db_file, table, lo, hi, cpi)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def partitioned_query(db_file, sql, table, params=(), processes=None, partitions=None, cpi=None):
+    """Run a row-by-row query over table in rowid ranges in parallel.
+
+    Each range of table's rowids is queried on its own read-only
+    connection in a pool of processes (default is one per CPU), and the
+    rows come back in range order. That only equals the unsplit query if
+    the query works row by row on table: it must name table unqualified and
+    not use its rowid, and ORDER BY, GROUP BY, DISTINCT, LIMIT and
+    aggregates apply to each range separately. Joins to other tables are
+    fine. Returns (column names, row iterator) like XlsxImporter.get_data."""
+    processes = processes or os.cpu_count() or 1
+    partitions = partitions or processes * 8
+
+    with closing(_partition_conn(db_file, table, 0, 0, cpi)) as conn:
+        cols = [d[0] for d in conn.execute(sql, params).description]
+        lo, hi = conn.execute('select min(rowid), max(rowid) from main.{}'.format(quote_name(table))).fetchone()
+
+    jobs = []
+    if lo is not None:
+        step = max(1, -(-(hi - lo + 1) // partitions))
+        jobs = [(db_file, sql, params, table, start, start + step, cpi) for start in range(lo, hi + 1, step)]
+
+    def _rows():
+        if processes > 1 and len(jobs) > 1:
+            import multiprocessing
+            with multiprocessing.Pool(min(processes, len(jobs))) as pool:
+                for rows in pool.imap(_query_partition, jobs):
+                    yield from rows
+        else:
+            for job in jobs:
+                yield from _query_partition(job)
+
+    return cols, _rows()
+
+
 def main():
     """Entry point in command line mode."""
     args = sys.argv[1:]
@@ -1,6 +1,8 @@
 """Provide helpers for Excel files (using openpyxl)."""
 
 import glob
+import hashlib
+import json
 import os.path as pth
 import sys
 
@@ -9,17 +11,21 @@ from collections import ChainMap
 from contextlib import closing
 from datetime import datetime
 
-from openpyxl import load_workbook, Workbook
-from openpyxl.styles import NamedStyle, Font, PatternFill
-
-from .core import norm_ws, kv, read_config
-from .cli import log
+from .core import norm_ws, kv, read_config_file
+from .cli import log, ProgressMeter
+from . import profile
 
 
 # Luckily the functionality we want to already out there
 globmatch = glob.fnmatch.fnmatch
 
 
+def _str_val(v):
+    if v and v[0] == "'" and v.find("'", 1) < 0:
+        v = v[1:]  # starts with ' and doesn't have a match: old excel "force string" method
+    return norm_ws(v)
+
+
 def _val(cell):
     v = cell.value
     if v is None:
@@ -27,9 +33,7 @@ def _val(cell):
 
     t = type(v)
     if t is str:
-        if v and v[0] == "'" and v.find("'", 1) < 0:
-            v = v[1:]  # starts with ' and doesn't have a match: old excel "force string" method
-        return norm_ws(v)
+        return _str_val(v)
     elif t is int:
         return v
     elif t is float:
@@ -43,6 +47,7 @@ def _val(cell):
 # This is generally just for us, but some might find it useful
 def load_ro_workbook(xlsx_file):
     """Read a workbook opened read-only for fast access."""
+    from openpyxl import load_workbook
     return load_workbook(filename=xlsx_file, read_only=True, data_only=True)
 
 
@@ -58,9 +63,12 @@ def ws_scan_raw(xlsx_file, sheet_name, log_on_open=True):
     """Iterator for every row in sheet_name in xlsx_file."""
     if log_on_open:
         log('OPEN: [!c]{:s} => {:s}[!/c]', xlsx_file, sheet_name)
-    with closing(load_ro_workbook(xlsx_file)) as wb:
+    with profile.span('xl.ws_scan_raw.open'):
+        wb = load_ro_workbook(xlsx_file)
+    with closing(wb):
         ws = wb[sheet_name]
         for row in ws:
+            profile.count('xl.ws_scan_raw.rows')
             yield [_val(cell) for cell in row]
 
 
@@ -87,6 +95,8 @@ def add_named_style(
 
     Already named styles are ignored. See add_default_styles for example usage.
     """
+    from openpyxl.styles import NamedStyle, Font
+
     if name in wb.named_styles:
         return
     sty = NamedStyle(name=name)
@@ -100,6 +110,7 @@ def add_named_style(
 
 def add_default_styles(wb):
     """Add default styles we use in some tools"""
+    from openpyxl.styles import PatternFill
     add_named_style(wb, 'IMHeader', font_color='FFFFFFFF', fill=PatternFill('solid', fgColor='FF4F81BD'))
     add_named_style(wb, 'IMNormal')
     add_named_style(wb, 'IMInt', number_format='0')
@@ -110,12 +121,69 @@ def add_default_styles(wb):
     add_named_style(wb, 'IMDate', number_format='m/d/yy')
 
 
-def ics_report_params(xlsx_file, sheet_name='Cover'):
+# Custom property holding the --cache fingerprint for a sheet
+CACHE_PROPERTY = 'datasimple.build:{}'
+
+
+def autofit_width(max_length):
+    """Column width for a column whose longest value has max_length chars."""
+    return (max_length + 3.2) * 0.88  # calc is totally arbitrary
+
+
+def ics_cover_parms(xlsx_file, sheet_name='Cover'):
+    """Iterator of the Parms column of an ICS report cover sheet.
+
+    Only the cover sheet's part (and as much of the shared strings as it
+    needs) is read, straight from the zip, and we stop at the first empty
+    Parms cell."""
+    import zipfile
+    from .xlparts import Book, SharedStrings, iter_rows
+
+    with zipfile.ZipFile(xlsx_file) as zf:
+        book = Book(zf)
+        # An exact match, like openpyxl's wb[sheet_name] (see ws_scan)
+        part = next((p for sheet, p in book.sheets() if sheet.get('name') == sheet_name), None)
+        if part is None:
+            raise KeyError('Worksheet {0} does not exist.'.format(sheet_name))
+        strings = SharedStrings(zf, book)
+        try:
+            def _text(cell):
+                kind, raw = cell
+                if raw is None:
+                    return ''
+                return strings[int(raw)] if kind == 's' else raw
+
+            parms_col, prev = None, 0
+            for num, cells in iter_rows(zf, part):
+                if parms_col is None:
+                    found = [col for col, cell in cells.items() if _str_val(_text(cell)) == 'Parms']
+                    if not found:
+                        raise KeyError('Parms')
+                    parms_col, prev = found[0], num
+                    continue
+                cell = cells.get(parms_col)
+                val = _str_val(_text(cell)) if cell and num == prev + 1 else ''
+                if not val:
+                    break  # End of the column
+                prev = num
+                yield val
+        finally:
+            strings.close()
+
+
+def ics_report_params(xlsx_file, sheet_name='Cover', fast=True):
     """Return a dictionary of report parameters for an ICS batch system report.
-    If a parameter appears more than once, the values are returned as a list"""
+    If a parameter appears more than once, the values are returned as a list
+
+    By default the cover sheet is read with ics_cover_parms. With fast False
+    the whole workbook is loaded and every row of the sheet is checked."""
+    if fast:
+        vals = ics_cover_parms(xlsx_file, sheet_name)
+    else:
+        vals = (row['Parms'] for row in ws_scan(xlsx_file, sheet_name))
+
     parms = dict()
-    for vals in ws_scan(xlsx_file, sheet_name):
-        val = vals['Parms']
+    for val in vals:
         k, v = kv(val)
         if not k:
             continue  # invalid line
@@ -169,9 +237,7 @@ class ValueMapper(object):
 
         self.config_file = config_file
         if self.config_file:
-            with open(self.config_file) as inp:
-                cfg_text = str(inp.read()).strip()
-            self.config = read_config(cfg_text)
+            self.config = read_config_file(self.config_file)
         else:
             self.config = dict()
 
@@ -237,7 +303,7 @@ class ValueMapper(object):
             # Finally done
             return style_name, val
 
-        return m
+        return profile.timed('xl.ValueMapper.mapper')(m)
 
 
 class XlsxImporter(object):
@@ -247,6 +313,10 @@ class XlsxImporter(object):
     well. It should also be handy for custom spreadsheet creation.
     """
 
+    # Defaults for --save-profile and --inline-strings (see xlparts.save_workbook)
+    save_profile = 'default'
+    inline_strings = False
+
     def __init__(self):
         """Construction."""
         pass
@@ -273,12 +343,47 @@ class XlsxImporter(object):
         """
         raise NotImplementedError
 
+    def cache_key(self, args):
+        """Optional identity of the inputs get_data will read, for --cache.
+
+        Return anything JSON serializable (core.file_fingerprint of input
+        files is handy) or None if the inputs can't be identified, in which
+        case --cache always rebuilds."""
+        return None
+
+    def fingerprint(self, args, value_mapper):
+        """Fingerprint of everything that goes into our sheet (or None)."""
+        key = self.cache_key(args)
+        if key is None:
+            return None
+        ident = {
+            'importer': type(self).__qualname__,
+            'key': key,
+            'config': {name: dict(sect) for name, sect in value_mapper.config.items()},
+            'default_mapping': value_mapper.default_mapping,
+            'type_map': {t.__name__: sty for t, sty in value_mapper.type_map.items()},
+            'convert_map': sorted(value_mapper.convert_map),
+            'args': [args.sheetname, args.freeze, args.transpose],
+        }
+        return hashlib.sha1(json.dumps(ident, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
     def before_save(self, args, wb, sheet):
-        """Optional last chance at the sheet before save."""
+        """Optional last chance at the sheet before save.
+
+        With --surgical (and an existing book) wb only holds our sheet."""
         pass
 
     def main(self, cmdline_args=None):
         """Our main contribution: this is the logic that we provide."""
+        from .xlparts import (
+            SAVE_PROFILE_NAMES,
+            has_sheet,
+            read_custom_properties,
+            replace_sheet_from_workbook,
+            save_workbook,
+            set_custom_properties,
+        )
+
         # Our default arguments
         parser = ArgumentParser()
         parser.add_argument('-b', '--book',      type=str, required=True, help='Name of workbook to create/update')
@@ -286,6 +391,15 @@ class XlsxImporter(object):
         parser.add_argument('-m', '--mapper',    type=str, default='',    help='Mapper config file to use')
         parser.add_argument('-f', '--freeze',    type=str, default='',    help='Optional cell at which to perform a Freeze Panes (e.g. use A2 to freeze top row)')
         parser.add_argument('-t', '--transpose', action='store_true', default=False, help='If set, transpose result sheet')
+        parser.add_argument('-u', '--surgical',  action='store_true', default=False,
+                            help='If the book exists, only rewrite the parts for this sheet (other sheets are copied as-is)')
+        parser.add_argument('-z', '--save-profile', type=str, default=self.save_profile,
+                            choices=SAVE_PROFILE_NAMES,
+                            help='Compression for the saved book: store and fast trade file size for speed')
+        parser.add_argument('--inline-strings', action='store_true', default=self.inline_strings,
+                            help='Store strings in their cells instead of a shared strings table (always on with --surgical)')
+        parser.add_argument('-c', '--cache',     action='store_true', default=False,
+                            help='Skip the rebuild if the book has this sheet built from the same inputs, mapper and args')
 
         # Get any necessary arguments, parse everything, and then perform
         # init validation
@@ -302,13 +416,33 @@ class XlsxImporter(object):
         self.customize_val_mapper(mapper_src)
         mapper = mapper_src.create_mapper(args.sheetname)
 
+        # The fingerprint of a sheet's inputs is kept in the book's custom
+        # properties: if it matches, there's nothing to do
+        cache_prop = CACHE_PROPERTY.format(args.sheetname)
+        old_props = read_custom_properties(args.book) if pth.isfile(args.book) else {}
+        fingerprint = self.fingerprint(args, mapper_src) if args.cache else None
+        if args.cache:
+            if fingerprint is None:
+                log('[!y]Inputs have no cache key: rebuilding[!/y]')
+            elif old_props.get(cache_prop) == fingerprint and has_sheet(args.book, args.sheetname):
+                log('Sheet [!c]{:s}[!/c] is [!g]up to date[!/g]: skipping', args.sheetname)
+                return
+
         # Create or open workbook and get our worksheet ready
-        if pth.isfile(args.book):
-            log('Opening [!y]{:s}[!/y]', args.book)
-            wb = load_workbook(args.book)
-        else:
-            log('Creating [!y]{:s}[!/y]', args.book)
-            wb = Workbook()
+        # In surgical mode we build the sheet in an empty workbook and then
+        # splice it into the existing book (see xlparts)
+        from openpyxl import load_workbook, Workbook
+        surgical = args.surgical and pth.isfile(args.book)
+        with profile.span('xl.XlsxImporter.load'):
+            if surgical:
+                log('Updating sheet in [!y]{:s}[!/y]', args.book)
+                wb = Workbook()
+            elif pth.isfile(args.book):
+                log('Opening [!y]{:s}[!/y]', args.book)
+                wb = load_workbook(args.book)
+            else:
+                log('Creating [!y]{:s}[!/y]', args.book)
+                wb = Workbook()
 
         wb.guess_types = False
 
@@ -329,43 +463,45 @@ class XlsxImporter(object):
         add_default_styles(wb)
 
         # Now we need the data that we'll be writing
-        col_names, rows = self.get_data(args)
-
-        # simplify cell writing, and handle transpoition
-        def _write_cell(r, c, v, sty):
-            if args.transpose:
-                r, c = c, r
-            sheet.cell(row=r, column=c, value=v).style = sty
-
-        # Create header row
-        col_names = list(col_names)  # Go ahead and freeze column names
-        for idx, col in enumerate(col_names):
-            _write_cell(1, idx+1, col, 'IMHeader')
-
-        # Now create all rows
-        count = 0
-        for row in rows:
-            for idx, val in enumerate(row):
-                col = col_names[idx]
-                style, val = mapper(col, val)
-                _write_cell(count+2, idx+1, val, style)
-
-            count += 1
-            if count == 1:
-                log('[!g]First Record Written![!/g]')
-            elif count % 5000 == 0:
-                log('Records: [!g]{:,d}[!/g]', count)
+        with profile.span('xl.XlsxImporter.write'):
+            col_names, rows = self.get_data(args)
+
+            # simplify cell writing, and handle transpoition
+            def _write_cell(r, c, v, sty):
+                if args.transpose:
+                    r, c = c, r
+                sheet.cell(row=r, column=c, value=v).style = sty
+
+            # Create header row
+            col_names = list(col_names)  # Go ahead and freeze column names
+            for idx, col in enumerate(col_names):
+                _write_cell(1, idx+1, col, 'IMHeader')
+
+            # Now create all rows
+            count = 0
+            meter = ProgressMeter('Records')
+            for row in rows:
+                for idx, val in enumerate(row):
+                    col = col_names[idx]
+                    style, val = mapper(col, val)
+                    _write_cell(count+2, idx+1, val, style)
+
+                count += 1
+                if count == 1:
+                    log('[!g]First Record Written![!/g]')
+                meter.update()
+            meter.done()
 
         # Finalize sheet - we autofit cols, freeze if necessary, and save
-        for col in sheet.columns:
-            column = col[0].column   # need column name for below
-            max_length = 6
-            for cell in col:
-                v = cell.value
-                if v:
-                    max_length = max(max_length, len(str(cell.value)))
-            adjusted_width = (max_length + 3.2) * 0.88  # calc is totally arbitrary
-            sheet.column_dimensions[column].width = adjusted_width
+        with profile.span('xl.XlsxImporter.autofit'):
+            for col in sheet.columns:
+                column = col[0].column   # need column name for below
+                max_length = 6
+                for cell in col:
+                    v = cell.value
+                    if v:
+                        max_length = max(max_length, len(str(cell.value)))
+                sheet.column_dimensions[column].width = autofit_width(max_length)
 
         # Freeze if requests
         if args.freeze:
@@ -376,7 +512,21 @@ class XlsxImporter(object):
         self.before_save(args, wb, sheet)
 
         log('[!c]Saving[!/c]')
-        wb.save(args.book)
-        wb.close()
+        with profile.span('xl.XlsxImporter.save'):
+            if surgical:
+                replace_sheet_from_workbook(wb, args.book, args.sheetname, args.save_profile)
+            else:
+                save_workbook(wb, args.book, args.save_profile, args.inline_strings)
+            wb.close()
+
+            # Surgery keeps the old properties, but openpyxl drops them
+            if surgical:
+                props = {cache_prop: fingerprint} if fingerprint or cache_prop in old_props else {}
+            else:
+                props = {k: v for k, v in old_props.items() if k != cache_prop}
+                if fingerprint:
+                    props[cache_prop] = fingerprint
+            if props:
+                set_custom_properties(args.book, props, args.save_profile)
 
         log('[!br][!w]DONE[!/w][!/br] -> Rows: [!g]{:,d}[!/g]', count)
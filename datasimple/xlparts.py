@@ -0,0 +1,737 @@
+"""Zip level surgery on XLSX files.
+
+An xlsx file is a zip of XML parts. Replacing one sheet with openpyxl means
+loading every sheet of the book and writing them all back out. Here we only
+rewrite the parts that have to change (the sheet itself, the workbook part
+and its rels, [Content_Types].xml and styles.xml) and every other part is
+copied byte-for-byte, still compressed. So replacing a sheet costs time
+proportional to that sheet and not to the whole book.
+
+The new sheet comes from a second xlsx (usually a one sheet workbook written
+by openpyxl). Its cell formats are merged into the target's styles.xml and
+its shared strings become inline strings, so the target's sharedStrings.xml
+is never touched.
+"""
+
+import copy
+import io
+import os
+import os.path as pth
+import posixpath
+import re
+import struct
+import tempfile
+import zipfile
+
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+NS_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+NS_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+NS_PKG_REL = 'http://schemas.openxmlformats.org/package/2006/relationships'
+NS_CT = 'http://schemas.openxmlformats.org/package/2006/content-types'
+NS_CUSTOM = 'http://schemas.openxmlformats.org/officeDocument/2006/custom-properties'
+NS_VT = 'http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes'
+
+REL_OFFICE_DOC = NS_REL + '/officeDocument'
+REL_WORKSHEET = NS_REL + '/worksheet'
+REL_STYLES = NS_REL + '/styles'
+REL_SHARED_STRINGS = NS_REL + '/sharedStrings'
+REL_CALC_CHAIN = NS_REL + '/calcChain'
+REL_CUSTOM_PROPS = NS_REL + '/custom-properties'
+
+CT_WORKSHEET = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+CT_CUSTOM_PROPS = 'application/vnd.openxmlformats-officedocument.custom-properties+xml'
+
+CUSTOM_PROPS_PART = 'docProps/custom.xml'
+# Format ID Excel uses for user defined properties
+CUSTOM_PROPS_FMTID = '{D5CDD505-2E9C-101B-9397-08002B2CF9AE}'
+
+CONTENT_TYPES = '[Content_Types].xml'
+
+# Child order required in styles.xml
+STYLE_SECTIONS = (
+    'numFmts', 'fonts', 'fills', 'borders', 'cellStyleXfs', 'cellXfs',
+    'cellStyles', 'dxfs', 'tableStyles', 'colors', 'extLst',
+)
+
+# First numFmtId that isn't built in to Excel
+FIRST_CUSTOM_FMT = 164
+
+# Save profiles: name => (zip compression, compresslevel)
+SAVE_PROFILES = {
+    'store': (zipfile.ZIP_STORED, None),
+    'fast': (zipfile.ZIP_DEFLATED, 1),
+    'default': (zipfile.ZIP_DEFLATED, None),
+    'max': (zipfile.ZIP_DEFLATED, 9),
+}
+SAVE_PROFILE_NAMES = ('store', 'fast', 'default', 'max')
+
+# Where openpyxl puts things
+SHARED_STRINGS_PART = 'xl/sharedStrings.xml'
+_SHEET_PART_RE = re.compile(r'^xl/worksheets/[^/]+\.xml$')
+
+# A shared string cell as written by openpyxl
+_SHARED_CELL_RE = re.compile(br'<c([^>]*?) t="s"([^>]*)><v>(\d+)</v></c>')
+
+EMPTY_SST = ('<sst xmlns="%s" count="0" uniqueCount="0"/>' % NS_MAIN).encode('utf-8')
+
+_PARSER = etree.XMLParser(huge_tree=True)
+
+
+def _m(tag):
+    return '{%s}%s' % (NS_MAIN, tag)
+
+
+def _parse(data):
+    return etree.fromstring(data, _PARSER)
+
+
+def _tostring(root):
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)
+
+
+def _children(elem, tag):
+    return elem.findall(_m(tag)) if elem is not None else []
+
+
+def zip_options(save_profile):
+    """(compression, compresslevel) for a ZipFile using save_profile."""
+    try:
+        return SAVE_PROFILES[save_profile or 'default']
+    except KeyError:
+        raise ValueError('Unknown save profile {} (use one of {})'.format(
+            save_profile, ', '.join(SAVE_PROFILE_NAMES)))
+
+
+def rels_name(part):
+    """Name of the rels part for part."""
+    folder, name = posixpath.split(part)
+    return posixpath.join(folder, '_rels', name + '.rels')
+
+
+def resolve(source_part, target):
+    """Zip member name for a relationship target given by source_part."""
+    if target.startswith('/'):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source_part), target))
+
+
+class Book(object):
+    """The workbook part of an open xlsx zip and what it relates to."""
+
+    def __init__(self, zf):
+        """Read the workbook part and its rels from zf."""
+        self.zf = zf
+        self.part = None
+        for rel in _parse(zf.read('_rels/.rels')):
+            if rel.get('Type') == REL_OFFICE_DOC:
+                self.part = resolve('', rel.get('Target'))
+        if not self.part:
+            raise ValueError('No workbook part found in {}'.format(zf.filename))
+
+        self.root = _parse(zf.read(self.part))
+        self.rels_part = rels_name(self.part)
+        self.rels = _parse(zf.read(self.rels_part))
+
+    def related(self, rel_type):
+        """Rels entries of the given type as a list of (rel element, part)."""
+        return [
+            (rel, resolve(self.part, rel.get('Target')))
+            for rel in self.rels
+            if rel.get('Type') == rel_type
+        ]
+
+    def sheets(self):
+        """List of (sheet element, part) in book order."""
+        targets = {rel.get('Id'): part for rel, part in self.related(REL_WORKSHEET)}
+        rid = '{%s}id' % NS_REL
+        return [(s, targets.get(s.get(rid))) for s in _children(self.root.find(_m('sheets')), 'sheet')]
+
+    def find_sheet(self, sheet_name):
+        """(sheet element, part) for sheet_name (matched like Excel does) or (None, None)."""
+        for sheet, part in self.sheets():
+            if sheet.get('name').lower() == sheet_name.lower():
+                return sheet, part
+        return None, None
+
+    def date1904(self):
+        """True if the book uses the 1904 date system."""
+        pr = self.root.find(_m('workbookPr'))
+        return pr is not None and pr.get('date1904', '') in ('1', 'true')
+
+
+class StyleMerger(object):
+    """Copy cell formats from one styles.xml into another as they're used.
+
+    Identical fonts, fills, borders, number formats and cell formats already
+    in the destination are reused. Named styles are matched by name."""
+
+    def __init__(self, src, dst):
+        """Both src and dst are parsed styles.xml roots: dst is updated."""
+        self.src = src
+        self.dst = dst
+        self.changed = False
+        self._xfs = {}
+        self._named = {}
+        self._index = {}
+
+        self._src_fmts = {
+            nf.get('numFmtId'): nf.get('formatCode')
+            for nf in _children(src.find(_m('numFmts')), 'numFmt')
+        }
+        self._dst_fmts = {
+            nf.get('formatCode'): nf.get('numFmtId')
+            for nf in reversed(_children(dst.find(_m('numFmts')), 'numFmt'))
+        }
+
+    def _src_list(self, section):
+        return [c for c in self.src.find(_m(section)) if isinstance(c.tag, str)]
+
+    def _section(self, section):
+        sect = self.dst.find(_m(section))
+        if sect is None:
+            sect = etree.Element(_m(section))
+            before = STYLE_SECTIONS[:STYLE_SECTIONS.index(section)]
+            pos = 0
+            for idx, child in enumerate(self.dst):
+                if isinstance(child.tag, str) and etree.QName(child).localname in before:
+                    pos = idx + 1
+            self.dst.insert(pos, sect)
+        return sect
+
+    def _append(self, section, elem):
+        sect = self._section(section)
+        sect.append(elem)
+        size = sum(1 for c in sect if isinstance(c.tag, str))
+        sect.set('count', str(size))
+        self.changed = True
+        return size - 1
+
+    def _add(self, section, elem):
+        """Index in the dst section of a copy of elem, reusing identical entries."""
+        index = self._index.get(section)
+        if index is None:
+            entries = [c for c in self._section(section) if isinstance(c.tag, str)]
+            index = {}
+            for idx, c in enumerate(entries):
+                index.setdefault(etree.tostring(c, method='c14n'), idx)
+            self._index[section] = index
+
+        key = etree.tostring(elem, method='c14n')
+        pos = index.get(key)
+        if pos is None:
+            pos = index[key] = self._append(section, copy.deepcopy(elem))
+        return pos
+
+    def _num_fmt(self, fmt_id):
+        if int(fmt_id) < FIRST_CUSTOM_FMT:
+            return fmt_id  # Built in: same everywhere
+        code = self._src_fmts[fmt_id]
+        dst_id = self._dst_fmts.get(code)
+        if dst_id is None:
+            used = [int(i) for i in self._dst_fmts.values()]
+            dst_id = str(max(used + [FIRST_CUSTOM_FMT - 1]) + 1)
+            nf = etree.Element(_m('numFmt'), numFmtId=dst_id, formatCode=code)
+            self._append('numFmts', nf)
+            self._dst_fmts[code] = dst_id
+        return dst_id
+
+    def _xf(self, src_xf):
+        xf = copy.deepcopy(src_xf)
+        if xf.get('numFmtId') is not None:
+            xf.set('numFmtId', self._num_fmt(xf.get('numFmtId')))
+        for attr, section in (('fontId', 'fonts'), ('fillId', 'fills'), ('borderId', 'borders')):
+            val = xf.get(attr)
+            if val is not None:
+                xf.set(attr, str(self._add(section, self._src_list(section)[int(val)])))
+        return xf
+
+    def _named_style(self, xf_id):
+        """dst cellStyleXfs index for the src named style at xf_id."""
+        found = self._named.get(xf_id)
+        if found is not None:
+            return found
+
+        src_style = None
+        for cs in _children(self.src.find(_m('cellStyles')), 'cellStyle'):
+            if cs.get('xfId') == xf_id:
+                src_style = cs
+                break
+
+        found = None
+        if src_style is not None:
+            for cs in _children(self.dst.find(_m('cellStyles')), 'cellStyle'):
+                same_builtin = src_style.get('builtinId') is not None and cs.get('builtinId') == src_style.get('builtinId')
+                if cs.get('name') == src_style.get('name') or same_builtin:
+                    found = cs.get('xfId')
+                    break
+
+        if found is None:
+            # Named styles each get their own entry: never share them
+            xf = self._xf(self._src_list('cellStyleXfs')[int(xf_id)])
+            found = str(self._append('cellStyleXfs', xf))
+            if src_style is not None:
+                cs = copy.deepcopy(src_style)
+                cs.set('xfId', found)
+                self._append('cellStyles', cs)
+
+        self._named[xf_id] = found
+        return found
+
+    def cell_xf(self, s):
+        """dst cellXfs index (as a string) for the src cellXfs index s."""
+        found = self._xfs.get(s)
+        if found is None:
+            xf = self._xf(self._src_list('cellXfs')[int(s)])
+            if xf.get('xfId') is not None:
+                xf.set('xfId', self._named_style(xf.get('xfId')))
+            found = self._xfs[s] = str(self._add('cellXfs', xf))
+        return found
+
+
+def _shared_strings(zf, book):
+    found = book.related(REL_SHARED_STRINGS)
+    if not found:
+        return []
+    return _children(_parse(zf.read(found[0][1])), 'si')
+
+
+def sheet_xml(data, strings, styles):
+    """Sheet XML from data with inline strings and styles remapped.
+
+    strings is the list of shared string si elements for data, and styles is
+    a StyleMerger (or None to leave style indexes alone)."""
+    root = _parse(data)
+    if root.xpath('//@r:id|//m:cfRule', namespaces={'r': NS_REL, 'm': NS_MAIN}):
+        raise ValueError('Sheets with related parts or conditional formats are not supported')
+
+    # Don't leave the book with two selected tabs (Excel "groups" them)
+    for view in root.iter(_m('sheetView')):
+        view.attrib.pop('tabSelected', None)
+
+    if styles is not None:
+        for col in root.iter(_m('col')):
+            if col.get('style') is not None:
+                col.set('style', styles.cell_xf(col.get('style')))
+        for row in root.iter(_m('row')):
+            if row.get('s') is not None:
+                row.set('s', styles.cell_xf(row.get('s')))
+
+    tag_v, tag_is = _m('v'), _m('is')
+    for cell in root.iter(_m('c')):
+        s = cell.get('s')
+        if s is not None and styles is not None:
+            cell.set('s', styles.cell_xf(s))
+        if cell.get('t') == 's':
+            v = cell.find(tag_v)
+            if v is None or v.text is None:
+                # openpyxl writes '' as a shared string with no value
+                del cell.attrib['t']
+                if v is not None:
+                    cell.remove(v)
+                continue
+            cell.remove(v)
+            cell.set('t', 'inlineStr')
+            inline = etree.SubElement(cell, tag_is)
+            for child in strings[int(v.text)]:
+                inline.append(copy.deepcopy(child))
+
+    return _tostring(root)
+
+
+def copy_raw(zin, zout, info):
+    """Copy member info from zin to zout without decompressing it."""
+    fp = zin.fp
+    fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    raw = fp.read(info.compress_size)
+
+    out = copy.copy(info)
+    out.flag_bits &= ~0x08  # Sizes go in the local header: no data descriptor
+    out.extra = b''
+    out.header_offset = zout.fp.tell()
+    zout.fp.write(out.FileHeader())
+    zout.fp.write(raw)
+    zout.filelist.append(out)
+    zout.NameToInfo[out.filename] = out
+    zout.start_dir = zout.fp.tell()
+    zout._didModify = True
+
+
+def replace_sheet(book_file, src_file, sheet_name, src_sheet_name=None, save_profile='default'):
+    """Put sheet src_sheet_name of src_file into book_file as sheet_name.
+
+    An existing sheet named sheet_name is replaced where it is in the book,
+    otherwise the sheet is added at the end. src_file may be a file name or
+    a file-like object, and src_sheet_name defaults to sheet_name. Parts we
+    rewrite are compressed per save_profile. Returns the zip member name of
+    the sheet in book_file."""
+    src_sheet_name = src_sheet_name or sheet_name
+
+    with zipfile.ZipFile(src_file) as zsrc, zipfile.ZipFile(book_file) as zin:
+        src, book = Book(zsrc), Book(zin)
+        if src.date1904() != book.date1904():
+            raise ValueError('{} and the new sheet use different date systems'.format(book_file))
+
+        src_sheet, src_part = src.find_sheet(src_sheet_name)
+        if src_sheet is None:
+            raise ValueError('No sheet named {} in the source workbook'.format(src_sheet_name))
+        if rels_name(src_part) in zsrc.NameToInfo:
+            raise ValueError('Sheets with related parts are not supported')
+
+        styles_part = book.related(REL_STYLES)[0][1]
+        styles = StyleMerger(
+            _parse(zsrc.read(src.related(REL_STYLES)[0][1])),
+            _parse(zin.read(styles_part)),
+        )
+        new_sheet = sheet_xml(zsrc.read(src_part), _shared_strings(zsrc, src), styles)
+
+        changed, dropped = {}, set()
+        content_types = _parse(zin.read(CONTENT_TYPES))
+
+        sheet, part = book.find_sheet(sheet_name)
+        if sheet is not None:
+            # Replace in place: the old sheet's related parts (drawings,
+            # comments, etc) are simply no longer referenced
+            dropped.add(rels_name(part))
+            sheet.set('name', sheet_name)
+
+            # Formula results and the calc chain may point at the old sheet
+            for rel, calc_part in book.related(REL_CALC_CHAIN):
+                book.rels.remove(rel)
+                dropped.add(calc_part)
+                for ov in content_types.findall('{%s}Override' % NS_CT):
+                    if ov.get('PartName') == '/' + calc_part:
+                        content_types.remove(ov)
+                changed[book.rels_part] = _tostring(book.rels)
+                changed[CONTENT_TYPES] = _tostring(content_types)
+            calc = book.root.find(_m('calcPr'))
+            if calc is not None:
+                calc.set('fullCalcOnLoad', '1')
+                changed[book.part] = _tostring(book.root)
+        else:
+            part = _add_sheet(book, zin, content_types, sheet_name)
+            changed[book.part] = _tostring(book.root)
+            changed[book.rels_part] = _tostring(book.rels)
+            changed[CONTENT_TYPES] = _tostring(content_types)
+
+        changed[part] = new_sheet
+        if styles.changed:
+            changed[styles_part] = _tostring(styles.dst)
+
+        write_book(book_file, zin, changed, dropped, save_profile=save_profile)
+
+    return part
+
+
+def _add_sheet(book, zin, content_types, sheet_name):
+    """Add a new sheet entry to book and content_types: return its part name."""
+    sheets = book.root.find(_m('sheets'))
+    sheet_ids = [int(s.get('sheetId')) for s in _children(sheets, 'sheet')]
+    rel_ids = {rel.get('Id') for rel in book.rels}
+
+    folder = posixpath.join(posixpath.dirname(book.part), 'worksheets')
+    num = len(sheet_ids) + 1
+    while posixpath.join(folder, 'sheet{}.xml'.format(num)) in zin.NameToInfo:
+        num += 1
+    part = posixpath.join(folder, 'sheet{}.xml'.format(num))
+
+    num = len(rel_ids) + 1
+    while 'rId{}'.format(num) in rel_ids:
+        num += 1
+    rel_id = 'rId{}'.format(num)
+
+    etree.SubElement(book.rels, '{%s}Relationship' % NS_PKG_REL, {
+        'Id': rel_id,
+        'Type': REL_WORKSHEET,
+        'Target': posixpath.relpath(part, posixpath.dirname(book.part)),
+    })
+    etree.SubElement(sheets, _m('sheet'), {
+        'name': sheet_name,
+        'sheetId': str(max(sheet_ids + [0]) + 1),
+        '{%s}id' % NS_REL: rel_id,
+    })
+    etree.SubElement(content_types, '{%s}Override' % NS_CT, {
+        'PartName': '/' + part,
+        'ContentType': CT_WORKSHEET,
+    })
+    return part
+
+
+def write_book(book_file, zin, changed=None, dropped=(), copied=None, save_profile='default'):
+    """Write book_file from the open zip zin, replacing some parts.
+
+    changed maps part names to their new bytes, dropped parts are left out,
+    and copied maps part names to the name of a zip file holding that part
+    (which is copied still compressed). Everything else in zin is copied
+    as-is. Changed parts are compressed per save_profile, and book_file is
+    only replaced once it's completely written."""
+    changed, copied = dict(changed or {}), dict(copied or {})
+    compression, level = zip_options(save_profile)
+    folder = pth.dirname(pth.abspath(book_file))
+    fd, tmp_name = tempfile.mkstemp(prefix='.xlparts-', suffix='.xlsx', dir=folder)
+    try:
+        with io.open(fd, 'wb') as fh, zipfile.ZipFile(fh, 'w', compression, compresslevel=level) as zout:
+            def _put(name):
+                if name in changed:
+                    zout.writestr(name, changed.pop(name))
+                elif name in copied:
+                    with zipfile.ZipFile(copied.pop(name)) as zpart:
+                        copy_raw(zpart, zout, zpart.getinfo(name))
+
+            for info in zin.infolist():
+                name = info.filename
+                if name in dropped:
+                    continue
+                if name in changed or name in copied:
+                    _put(name)
+                else:
+                    copy_raw(zin, zout, info)
+            for name in list(changed) + list(copied):
+                _put(name)
+        os.replace(tmp_name, book_file)
+    except BaseException:
+        if pth.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def col_number(ref):
+    """Column number (1 based) of a cell reference like AB12."""
+    num = 0
+    for ch in ref:
+        if ch.isdigit():
+            break
+        num = num * 26 + ord(ch.upper()) - 64
+    return num
+
+
+def col_letter(num):
+    """Column letters for the (1 based) column number num: 28 gives AB."""
+    letters = ''
+    while num:
+        num, rem = divmod(num - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _text(elem):
+    """Text of a rich or plain string item (si or is), without phonetic runs."""
+    return ''.join(t.text or '' for t in elem.iter(_m('t')) if t.getparent().tag != _m('rPh'))
+
+
+class SharedStrings(object):
+    """A book's shared strings, parsed only as far as anyone has asked.
+
+    Use as a sequence: strings[idx]. Call close when done."""
+
+    def __init__(self, zf, book):
+        """Prepare to read the shared strings of book in the open zip zf."""
+        self._items = []
+        self._fh = None
+        self._parts = iter(())
+        found = book.related(REL_SHARED_STRINGS)
+        if found and found[0][1] in zf.NameToInfo:
+            self._fh = zf.open(found[0][1])
+            self._parts = etree.iterparse(self._fh, events=('end',), tag=_m('si'), huge_tree=True)
+
+    def __getitem__(self, idx):
+        while len(self._items) <= idx:
+            _, si = next(self._parts, (None, None))
+            if si is None:
+                raise IndexError('Shared string {} not found'.format(idx))
+            self._items.append(_text(si))
+            si.clear()
+        return self._items[idx]
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+def iter_rows(zf, part):
+    """Stream the rows of a sheet part as (row number, {col number: (type, raw)}).
+
+    raw is the text of the cell's value (None if it has none); for inline
+    strings it's the string itself. Shared strings ("s") are left as their
+    index: see SharedStrings."""
+    tag_c, tag_v, tag_is = _m('c'), _m('v'), _m('is')
+    with zf.open(part) as fh:
+        prev = 0
+        for _, row in etree.iterparse(fh, events=('end',), tag=_m('row'), huge_tree=True):
+            num = int(row.get('r') or prev + 1)
+            cells = {}
+            col = 0
+            for c in row.iterfind(tag_c):
+                ref = c.get('r')
+                col = col_number(ref) if ref else col + 1
+                kind = c.get('t', 'n')
+                if kind == 'inlineStr':
+                    inline = c.find(tag_is)
+                    raw = _text(inline) if inline is not None else None
+                else:
+                    v = c.find(tag_v)
+                    raw = v.text if v is not None else None
+                cells[col] = (kind, raw)
+            yield num, cells
+            prev = num
+
+            # Don't keep the rows we've already seen around
+            row.clear()
+            while row.getprevious() is not None:
+                del row.getparent()[0]
+
+
+def has_sheet(book_file, sheet_name):
+    """True if book_file has a sheet named sheet_name."""
+    with zipfile.ZipFile(book_file) as zf:
+        return Book(zf).find_sheet(sheet_name)[0] is not None
+
+
+def _package_rels(zf):
+    return _parse(zf.read('_rels/.rels'))
+
+
+def _custom_part(rels):
+    for rel in rels:
+        if rel.get('Type') == REL_CUSTOM_PROPS:
+            return rel, resolve('', rel.get('Target'))
+    return None, None
+
+
+def read_custom_properties(book_file):
+    """Return the book's custom document properties as a dict of strings."""
+    with zipfile.ZipFile(book_file) as zf:
+        part = _custom_part(_package_rels(zf))[1]
+        if not part or part not in zf.NameToInfo:
+            return {}
+        props = {}
+        for prop in _parse(zf.read(part)).iterfind('{%s}property' % NS_CUSTOM):
+            value = next(iter(prop), None)
+            props[prop.get('name')] = (value.text or '') if value is not None else ''
+        return props
+
+
+def set_custom_properties(book_file, props, save_profile='default'):
+    """Set (or add) the string custom document properties in props.
+
+    Properties with a value of None are removed. Only the properties part and
+    (the first time) the package rels and content types are rewritten."""
+    with zipfile.ZipFile(book_file) as zin:
+        changed = {}
+        rels = _package_rels(zin)
+        rel, part = _custom_part(rels)
+        if part and part in zin.NameToInfo:
+            root = _parse(zin.read(part))
+        else:
+            part = CUSTOM_PROPS_PART
+            root = etree.Element('{%s}Properties' % NS_CUSTOM, nsmap={None: NS_CUSTOM, 'vt': NS_VT})
+            if rel is None:
+                rel_ids = {r.get('Id') for r in rels}
+                num = len(rel_ids) + 1
+                while 'rId{}'.format(num) in rel_ids:
+                    num += 1
+                etree.SubElement(rels, '{%s}Relationship' % NS_PKG_REL, {
+                    'Id': 'rId{}'.format(num), 'Type': REL_CUSTOM_PROPS, 'Target': part,
+                })
+                changed['_rels/.rels'] = _tostring(rels)
+
+            content_types = _parse(zin.read(CONTENT_TYPES))
+            names = {ov.get('PartName') for ov in content_types.iterfind('{%s}Override' % NS_CT)}
+            if '/' + part not in names:
+                etree.SubElement(content_types, '{%s}Override' % NS_CT, {
+                    'PartName': '/' + part, 'ContentType': CT_CUSTOM_PROPS,
+                })
+                changed[CONTENT_TYPES] = _tostring(content_types)
+
+        existing = {p.get('name'): p for p in root.iterfind('{%s}property' % NS_CUSTOM)}
+        pids = [int(p.get('pid', 1)) for p in existing.values()]
+        next_pid = max(pids + [1]) + 1
+        for name, value in props.items():
+            prop = existing.get(name)
+            if value is None:
+                if prop is not None:
+                    root.remove(prop)
+                continue
+            if prop is None:
+                prop = etree.SubElement(root, '{%s}property' % NS_CUSTOM, {
+                    'fmtid': CUSTOM_PROPS_FMTID, 'pid': str(next_pid), 'name': name,
+                })
+                next_pid += 1
+            for child in list(prop):
+                prop.remove(child)
+            etree.SubElement(prop, '{%s}lpwstr' % NS_VT).text = str(value)
+        changed[part] = _tostring(root)
+
+        write_book(book_file, zin, changed, save_profile=save_profile)
+
+
+def replace_sheet_from_workbook(wb, book_file, sheet_name, save_profile='default'):
+    """Splice sheet_name from the openpyxl workbook wb into book_file."""
+    buf = io.BytesIO()
+    save_workbook(wb, buf, 'store')  # Only read back by us
+    buf.seek(0)
+    return replace_sheet(book_file, buf, sheet_name, save_profile=save_profile)
+
+
+def inline_shared_strings(data, strings):
+    """Sheet XML data (as written by openpyxl) with shared strings inlined."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    def _inline(match):
+        text = strings[int(match.group(3))]
+        space = b' xml:space="preserve"' if text != text.strip() else b''
+        return b'<c%s t="inlineStr"%s><is><t%s>%s</t></is></c>' % (
+            match.group(1), match.group(2), space, escape(text).encode('utf-8'))
+
+    return _SHARED_CELL_RE.sub(_inline, data)
+
+
+class _SaveArchive(zipfile.ZipFile):
+    """The zip openpyxl's ExcelWriter writes to: optionally inlines strings.
+
+    openpyxl writes every sheet before the shared strings table, so by the
+    time a sheet is written all of its strings are in wb.shared_strings.
+    Before 2.6 sheets are written with writestr, after that with write from
+    a temp file. (openpyxl 3.1 writes inline strings and no table itself.)"""
+
+    workbook = None
+
+    def writestr(self, zinfo_or_arcname, data, *args, **kwrds):
+        if self.workbook is not None:
+            name = getattr(zinfo_or_arcname, 'filename', zinfo_or_arcname)
+            if name == SHARED_STRINGS_PART:
+                data = EMPTY_SST
+            elif _SHEET_PART_RE.match(name):
+                data = inline_shared_strings(data, self.workbook.shared_strings)
+        return super().writestr(zinfo_or_arcname, data, *args, **kwrds)
+
+    def write(self, filename, arcname=None, *args, **kwrds):
+        if self.workbook is not None and arcname and _SHEET_PART_RE.match(arcname):
+            with open(filename, 'rb') as inp:
+                return self.writestr(arcname, inp.read(), *args, **kwrds)
+        return super().write(filename, arcname, *args, **kwrds)
+
+
+def save_workbook(wb, filename, save_profile='default', inline_strings=False):
+    """Save the openpyxl workbook wb (like wb.save) with a save profile.
+
+    store and fast trade file size for speed: handy for books that only
+    another step of a pipeline reads. With inline_strings, cells hold their
+    strings instead of pointing into a shared strings table. filename may
+    also be a file-like object."""
+    from openpyxl.writer.excel import ExcelWriter
+
+    compression, level = zip_options(save_profile)
+    archive = _SaveArchive(filename, 'w', compression, allowZip64=True, compresslevel=level)
+    if inline_strings:
+        archive.workbook = wb
+    # ExcelWriter.save takes a filename before openpyxl 2.6 and nothing after,
+    # but in both it's just these two
+    ExcelWriter(wb, archive).write_data()
+    archive.close()
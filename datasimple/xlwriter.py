@@ -0,0 +1,302 @@
+"""Write multi-sheet workbooks with a worker process per sheet.
+
+openpyxl builds every cell of every sheet in memory and then serializes the
+sheets one after another. write_workbook instead renders each sheet's XML
+straight from its rows in a worker process, compressed into a temporary zip.
+The final xlsx is assembled from a template saved by openpyxl (workbook,
+rels, content types and the styles from add_default_styles), and the worker
+parts are copied in without being recompressed.
+
+Cells are written the way XlsxImporter writes them: a header row in
+IMHeader, values styled by a ValueMapper and autofit column widths.
+"""
+
+import os
+import re
+import tempfile
+import zipfile
+
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from io import BytesIO
+from itertools import zip_longest
+from xml.sax.saxutils import escape
+
+from .cli import log
+from .xl import ValueMapper, add_default_styles, autofit_width
+from .xlparts import NS_MAIN, Book, col_letter, col_number, save_workbook, write_book, zip_options
+from . import profile
+
+# Same rules as openpyxl uses for cell values
+ILLEGAL_CHARACTERS_RE = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
+ERROR_CODES = ('#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A')
+MAX_STRING = 32767
+
+NUMERIC_TYPES = (int, float, Decimal)
+TIME_TYPES = (datetime, date, time, timedelta)
+
+# Rendered sheetData is kept in memory up to this size, then spills to disk
+SPOOL_BYTES = 32 * 1024 * 1024
+
+SHEET_TAIL = (
+    '</sheetData>'
+    '<pageMargins left="0.75" right="0.75" top="1" bottom="1" header="0.5" footer="0.5"/>'
+    '</worksheet>'
+)
+
+
+class SheetSource(object):
+    """One sheet for write_workbook.
+
+    get_data is called with no arguments in a worker process and returns
+    (cols, rows) just like XlsxImporter.get_data. It has to be picklable: a
+    module level function or a functools.partial of one is fine."""
+
+    def __init__(self, name, get_data, freeze='', transpose=False):
+        """Sheet name, data source, freeze panes cell and transposition."""
+        self.name = name
+        self.get_data = get_data
+        self.freeze = freeze
+        self.transpose = transpose
+
+
+def _number(v):
+    if v != v or v in (float('inf'), float('-inf')):
+        return ''
+    return '%.16g' % v
+
+
+def cell_xml(ref, s, v):
+    """XML for the cell at ref with style index s and value v."""
+    if v is None or v == '':
+        return '<c r="%s" s="%s"/>' % (ref, s)
+    if v is True or v is False:
+        return '<c r="%s" s="%s" t="b"><v>%d</v></c>' % (ref, s, v)
+    if isinstance(v, NUMERIC_TYPES):
+        return '<c r="%s" s="%s" t="n"><v>%s</v></c>' % (ref, s, _number(v))
+    if isinstance(v, TIME_TYPES):
+        from openpyxl.utils.datetime import to_excel
+        return '<c r="%s" s="%s" t="n"><v>%s</v></c>' % (ref, s, _number(to_excel(v)))
+    if not isinstance(v, str):
+        raise ValueError('Cannot convert {0!r} to Excel'.format(v))
+
+    v = v[:MAX_STRING]
+    if ILLEGAL_CHARACTERS_RE.search(v):
+        raise ValueError('Illegal character in cell {}: {!r}'.format(ref, v))
+    if len(v) > 1 and v[0] == '=':
+        return '<c r="%s" s="%s"><f>%s</f><v></v></c>' % (ref, s, escape(v[1:]))
+    if v in ERROR_CODES:
+        return '<c r="%s" s="%s" t="e"><v>%s</v></c>' % (ref, s, v)
+    space = ' xml:space="preserve"' if v != v.strip() else ''
+    return '<c r="%s" s="%s" t="inlineStr"><is><t%s>%s</t></is></c>' % (ref, s, space, escape(v))
+
+
+def pane_xml(freeze):
+    """sheetView content to freeze panes at the cell freeze (like A2)."""
+    match = re.match(r'^\$?([A-Za-z]{1,3})\$?(\d+)$', freeze or '')
+    if not match:
+        if freeze:
+            raise ValueError('Invalid freeze cell {}'.format(freeze))
+        return ''
+
+    col, row = col_number(match.group(1)), int(match.group(2))
+    if col == 1 and row == 1:
+        return ''
+    splits = ''
+    if col > 1:
+        splits += ' xSplit="%d"' % (col - 1)
+    if row > 1:
+        splits += ' ySplit="%d"' % (row - 1)
+    if col > 1 and row > 1:
+        active = 'bottomRight'
+    elif row > 1:
+        active = 'bottomLeft'
+    else:
+        active = 'topRight'
+
+    top_left = col_letter(col) + str(row)
+    return (
+        '<pane%s topLeftCell="%s" activePane="%s" state="frozen"/>'
+        '<selection pane="%s" activeCell="A1" sqref="A1"/>'
+    ) % (splits, top_left, active, active)
+
+
+def sheet_head(ncols, nrows, widths, freeze):
+    """Everything in the sheet XML before the rows."""
+    dimension = 'A1'
+    if ncols and nrows:
+        dimension = 'A1:' + col_letter(ncols) + str(nrows)
+    cols = ''
+    if widths:
+        cols = '<cols>' + ''.join(
+            '<col min="%d" max="%d" width="%r" customWidth="1"/>' % (idx, idx, w)
+            for idx, w in enumerate(widths, 1)
+        ) + '</cols>'
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<worksheet xmlns="%s">'
+        '<sheetPr><outlinePr summaryBelow="1" summaryRight="1"/><pageSetUpPr/></sheetPr>'
+        '<dimension ref="%s"/>'
+        '<sheetViews><sheetView workbookViewId="0">%s</sheetView></sheetViews>'
+        '<sheetFormatPr baseColWidth="8" defaultRowHeight="15"/>'
+        '%s<sheetData>'
+    ) % (NS_MAIN, dimension, pane_xml(freeze), cols)
+
+
+def _styled_rows(source, style_ids, mapper):
+    """Rows of (style index, value) for source, header first.
+
+    Transposed rows can have None for cells that short rows don't have."""
+    col_names, rows = source.get_data()
+    col_names = list(col_names)
+
+    def _sid(style_name):
+        try:
+            return style_ids[style_name]
+        except KeyError:
+            raise ValueError('Unknown style {}'.format(style_name))
+
+    def _rows():
+        header = _sid('IMHeader')
+        yield [(header, c) for c in col_names]
+        for row in rows:
+            cells = []
+            for idx, val in enumerate(row):
+                style, val = mapper(col_names[idx], val)
+                cells.append((_sid(style), val))
+            yield cells
+
+    if not source.transpose:
+        return _rows()
+    return (_trim(cells) for cells in zip_longest(*_rows()))
+
+
+def _trim(cells):
+    """A transposed row without its trailing gaps.
+
+    Short rows leave gaps (None) in the columns after them once transposed:
+    they are written as blank cells so later values stay in their columns."""
+    cells = list(cells)
+    while cells and cells[-1] is None:
+        cells.pop()
+    return cells
+
+
+def _write_sheet(job):
+    """Render one sheet into a temp zip (worker entry point)."""
+    source, part, style_ids, mapper_file, default_mapping, save_profile, folder = job
+
+    value_mapper = ValueMapper(mapper_file)
+    value_mapper.default_mapping.update(default_mapping or {})
+    mapper = value_mapper.create_mapper(source.name)
+
+    letters = []
+    lengths = []
+    nrows = 0
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES, mode='w+', encoding='utf-8') as data:
+        for nrows, cells in enumerate(_styled_rows(source, style_ids, mapper), 1):
+            while len(letters) < len(cells):
+                letters.append(col_letter(len(letters) + 1))
+                lengths.append(6)
+            rownum = str(nrows)
+            out = ['<row r="%s">' % rownum]
+            for idx, cell in enumerate(cells):
+                if cell is None:
+                    continue
+                s, v = cell
+                out.append(cell_xml(letters[idx] + rownum, s, v))
+                if v:
+                    size = len(str(v))
+                    if size > lengths[idx]:
+                        lengths[idx] = size
+            out.append('</row>')
+            data.write(''.join(out))
+
+        fd, part_file = tempfile.mkstemp(prefix='sheet-', suffix='.zip', dir=folder)
+        os.close(fd)
+        widths = [autofit_width(n) for n in lengths]
+        compression, level = zip_options(save_profile)
+        with zipfile.ZipFile(part_file, 'w', compression, compresslevel=level) as zf:
+            with zf.open(part, 'w', force_zip64=True) as outp:
+                outp.write(sheet_head(len(letters), nrows, widths, source.freeze).encode('utf-8'))
+                data.seek(0)
+                while True:
+                    chunk = data.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    outp.write(chunk.encode('utf-8'))
+                outp.write(SHEET_TAIL.encode('utf-8'))
+
+    return source.name, part_file, max(nrows - 1, 0)
+
+
+def _template(sheet_names, save_profile):
+    """Empty workbook with our sheets and styles: (zip bytes, style indexes)."""
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    add_default_styles(wb)
+    first = wb.active
+    first.title = sheet_names[0]
+    for name in sheet_names[1:]:
+        wb.create_sheet(name)
+
+    # Use every named style once so each gets a cell format we can find
+    style_names = list(wb.named_styles)
+    for idx, style_name in enumerate(style_names, 1):
+        first.cell(row=1, column=idx, value=0).style = style_name
+
+    buf = BytesIO()
+    save_workbook(wb, buf, save_profile)
+    with zipfile.ZipFile(buf) as zf:
+        from lxml import etree
+        root = etree.fromstring(zf.read(Book(zf).find_sheet(sheet_names[0])[1]))
+        found = [c.get('s', '0') for c in root.iter('{%s}c' % NS_MAIN)]
+    return buf, dict(zip(style_names, found))
+
+
+def write_workbook(book_file, sheets, mapper_file='', default_mapping=None, processes=None, save_profile='default'):
+    """Write a new book_file with a sheet for each SheetSource in sheets.
+
+    Sheets are rendered in up to processes worker processes (default is one
+    per CPU). mapper_file and default_mapping configure the ValueMapper used
+    for every sheet, and save_profile picks the compression (see
+    xlparts.SAVE_PROFILES). Returns a dict of sheet name => data rows
+    written."""
+    sheets = list(sheets)
+    if not sheets:
+        raise ValueError('No sheets to write')
+    names = [s.name for s in sheets]
+    if len({n.lower() for n in names}) != len(names):
+        raise ValueError('Duplicate sheet names: {}'.format(names))
+
+    processes = min(processes or os.cpu_count() or 1, len(sheets))
+    template, style_ids = _template(names, save_profile)
+
+    counts = {}
+    with zipfile.ZipFile(template) as ztpl, tempfile.TemporaryDirectory(prefix='xlwriter-') as folder:
+        book = Book(ztpl)
+        jobs = [
+            (s, book.find_sheet(s.name)[1], style_ids, mapper_file, default_mapping, save_profile, folder)
+            for s in sheets
+        ]
+        parts = {job[0].name: job[1] for job in jobs}
+
+        log('Writing [!c]{:,d}[!/c] sheets with [!c]{:,d}[!/c] processes', len(sheets), processes)
+        copied = {}
+        with profile.span('xl.write_workbook.sheets'):
+            if processes > 1:
+                import multiprocessing
+                with multiprocessing.Pool(processes) as pool:
+                    done = list(pool.imap_unordered(_write_sheet, jobs))
+            else:
+                done = [_write_sheet(job) for job in jobs]
+        for name, part_file, count in done:
+            log('Sheet [!y]{:s}[!/y] -> Rows: [!g]{:,d}[!/g]', name, count)
+            copied[parts[name]] = part_file
+            counts[name] = count
+
+        with profile.span('xl.write_workbook.assemble'):
+            write_book(book_file, ztpl, copied=copied)
+
+    return counts
@@ -1,3 +1,128 @@
 """Tests for CLI scripts."""
 
-# Currently no tests for the CLI helpers
+import io
+import sys
+
+from contextlib import contextmanager
+
+from nose.tools import eq_
+
+from datasimple import cli
+
+
+@contextmanager
+def _stderr(level='WARN'):
+    old_err, old_level = sys.stderr, cli.LOG_LEVEL
+    sys.stderr = io.StringIO()
+    cli.LOG_LEVEL = level
+    try:
+        yield sys.stderr
+    finally:
+        sys.stderr, cli.LOG_LEVEL = old_err, old_level
+
+
+def clrfmt_test():
+    green, end = str(cli.clr('x')).split('x')
+    assert green.startswith('\x1b[')
+    eq_(green + 'Hi 1,000' + end, cli.clrfmt('[!g]Hi {:,d}[!/g]', 1000))
+    eq_('plain {x}', cli.clrfmt('plain {x}'))
+    eq_('{lit} ' + green + 'z' + end, cli.clrfmt('{{lit}} [!g]{}[!/g]', 'z'))
+    eq_('{foo}x{/foo}', cli.clrfmt('[!foo]x[!/foo]'))
+    # Tags in formatted values are still colored
+    eq_('a ' + green + 'b' + end, cli.clrfmt('a {}', '[!g]b[!/g]'))
+
+
+def log_test():
+    with _stderr() as err:
+        cli.log('Hello {}', 'World', docolor=False)
+    assert err.getvalue().endswith('Hello World\n')
+
+    class Boom(object):
+        def __format__(self, spec):
+            raise AssertionError('Formatted a suppressed message')
+
+    with _stderr('NONE') as err:
+        assert not cli.log_enabled()
+        cli.log('Never {}', Boom())
+        cli.warn('Never {}', Boom())
+    eq_('', err.getvalue())
+
+
+def progress_log_test():
+    progress = cli.ProgressLog(interval=3600)
+    with _stderr() as err:
+        assert not progress.due()
+        assert not progress('Skipped {}', 1)
+        assert progress('Forced {}', 2, force=True, docolor=False)
+        progress.interval = 0
+        assert progress('Due {}', 3, docolor=False)
+    lines = err.getvalue().splitlines()
+    eq_(2, len(lines))
+    assert lines[0].endswith('Forced 2')
+    assert lines[1].endswith('Due 3')
+
+    with _stderr('NONE') as err:
+        assert not progress('Never')
+    eq_('', err.getvalue())
+
+
+def progress_meter_test():
+    meter = cli.ProgressMeter('Things', total_bytes=4096, interval=3600)
+    with _stderr() as err:
+        for _ in range(10):
+            meter.update(nbytes=1024)
+        eq_('', err.getvalue())  # Not due yet
+
+        meter.started -= 2.0
+        st = meter.stats()
+        eq_(10, st['rows'])
+        eq_(10240, st['bytes'])
+        eq_(0.0, st['eta'])  # We're past total_bytes
+        assert 4.0 < st['rows_per_sec'] <= 5.0
+        assert st['mb_per_sec'] > 0.0
+
+        meter.total_bytes = 20480
+        assert 1.9 < meter.stats()['eta'] < 2.2
+
+        meter._log.interval = 0
+        meter.update(0)
+        meter.done()
+    lines = err.getvalue().splitlines()
+    eq_(2, len(lines))
+    assert 'Things' in lines[0] and 'ETA' in lines[0]
+    assert 'Things' in lines[1] and 'ETA' not in lines[1]
+    assert 'Things' in meter.status()
+
+
+def log_table_test():
+    import terminaltables
+
+    rows = [
+        ['Name', 'Count', 'Note'],
+        ['[!g]Widgets[!/g]', '1,234', 'multi\nline'],
+        ['Gadgets', '5', ''],
+        ['日本語', '', 'é'],
+        [''],
+    ]
+    justify = {1: 'right', 2: 'center'}
+
+    expected_rows = [[cli.clrfmt(c) for c in row] for row in rows]
+    expected = terminaltables.AsciiTable(expected_rows)
+    expected.justify_columns.update(justify)
+
+    with _stderr('NONE') as err:
+        cli.log_table('Test', rows, inplace_color=True, justify_columns=justify)
+    eq_(expected.table + '\n', err.getvalue())
+
+    # Table is still the terminaltables class
+    from datasimple.cli import Table
+    assert Table is terminaltables.AsciiTable
+    assert isinstance(expected, cli.Table)
+    eq_('[!g]Widgets[!/g]', rows[1][0])  # No longer changed in place
+
+    with _stderr('NONE') as err:
+        cli.log_table('Test', [['Num']] + [[str(i)] for i in range(100)], max_rows=4)
+    lines = err.getvalue().splitlines()
+    eq_('| ... 96 more rows ... |', lines[5])
+    eq_(['0', '1', '98', '99'], [ln.strip('| ') for ln in lines[3:5] + lines[6:8]])
+    eq_(9, len(lines))
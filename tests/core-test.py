@@ -1,6 +1,16 @@
 """Tests for simple or fundamental helpers."""
 
-from datasimple.core import compact, first, first_in, kv, norm_ws
+import os
+import os.path as pth
+import subprocess
+import sys
+import tempfile
+
+from datetime import datetime
+
+from nose.tools import raises
+
+from datasimple.core import cache_dir, compact, file_fingerprint, first, first_in, kv, norm_ws, parse_date, read_config_file
 
 
 def core_test():
@@ -42,3 +52,74 @@ def norm_ws_test():
     assert '' == norm_ws(''), 'empty string'
     assert 'a b c' == norm_ws(' a b c '), 'simple trim'
     assert 'a b c' == norm_ws(' a \t b \r c \n '), 'multi spacing'
+
+
+def parse_date_test():
+    assert datetime(2017, 3, 4) == parse_date('03/04/2017 12:00:00'), 'm/d/y with time'
+    assert datetime(2017, 3, 1) == parse_date(' 3/17 '), 'm/y with y2k'
+    assert parse_date('2017-03-04') is None, 'not our format'
+
+    # rpt type inference uses this, and shouldn't have to load sqlite for it
+    code = 'import sys, datasimple.rpt; print("datasimple.sqlite" in sys.modules)'
+    assert b'False' == subprocess.check_output([sys.executable, '-c', code]).strip()
+
+
+@raises(ValueError)
+def parse_date_bad_test():
+    parse_date('13/45/2017')
+
+
+def read_config_file_test():
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = pth.join(tmp, 'test.cfg')
+        with open(fn, 'w') as outp:
+            outp.write('[DEFAULT]\nShared = IMInt\n[Sheet1]\nCol1 = IMNormal\n')
+
+        cfg = read_config_file(fn)
+        assert {'Shared': 'IMInt', 'Col1': 'IMNormal'} == dict(cfg['Sheet1']), 'defaults merged'
+        assert cfg is read_config_file(fn), 'cached'
+        try:
+            cfg['Sheet1']['Col1'] = 'IMComma'
+            assert False, 'config should be read-only'
+        except TypeError:
+            pass
+
+        with open(fn, 'a') as outp:
+            outp.write('Col2 = IMFloat\n')
+        st = os.stat(fn)
+        os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        cfg2 = read_config_file(fn)
+        assert cfg2 is not cfg, 'changed file re-read'
+        assert 'IMFloat' == cfg2['Sheet1']['Col2']
+
+
+def file_fingerprint_test():
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = pth.join(tmp, 'data.csv')
+        with open(fn, 'w') as outp:
+            outp.write('a,b\n1,2\n')
+        by_content, by_stat = file_fingerprint(fn), file_fingerprint(fn, content=False)
+
+        st = os.stat(fn)
+        os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        assert by_content == file_fingerprint(fn), 'touch keeps content fingerprint'
+        assert by_stat != file_fingerprint(fn, content=False), 'touch changes stat fingerprint'
+
+        with open(fn, 'a') as outp:
+            outp.write('3,4\n')
+        assert by_content != file_fingerprint(fn)
+
+
+def cache_dir_test():
+    old = os.environ.get('DS_CACHE_DIR')
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ['DS_CACHE_DIR'] = pth.join(tmp, 'cache')
+            folder = cache_dir('a', 'b')
+            assert folder == pth.join(tmp, 'cache', 'a', 'b')
+            assert pth.isdir(folder)
+    finally:
+        if old is None:
+            os.environ.pop('DS_CACHE_DIR', None)
+        else:
+            os.environ['DS_CACHE_DIR'] = old
@@ -0,0 +1,55 @@
+"""Tests for the ICS report parameter catalog."""
+
+import os
+import os.path as pth
+import tempfile
+
+from contextlib import closing
+
+from nose.tools import eq_
+from openpyxl import Workbook
+
+from datasimple.icscatalog import find_reports, open_catalog, report_params, update_catalog
+
+
+def _report(fn, parms, mtime=None):
+    wb = Workbook()
+    sheet = wb.active
+    sheet.title = 'Cover'
+    sheet.cell(row=1, column=2, value='Parms')
+    for idx, val in enumerate(parms, 2):
+        sheet.cell(row=idx, column=2, value=val)
+    wb.save(fn)
+    if mtime:
+        os.utime(fn, (mtime, mtime))
+
+
+def update_catalog_test():
+    with tempfile.TemporaryDirectory() as folder:
+        db = pth.join(folder, 'catalog.db')
+        reports = pth.join(folder, 'reports')
+        os.mkdir(reports)
+        one, two, bad = (pth.join(reports, n) for n in ('one.xlsx', 'two.xlsx', 'bad.xlsx'))
+        _report(one, ['Customer: ACME', 'Year: 2018', 'Part: A', 'Part: B'], 1000)
+        _report(two, ['Customer: Other', 'Year: 2018'], 1000)
+        with open(bad, 'w') as fp:
+            fp.write('not a workbook')
+
+        counts = update_catalog(db, reports, processes=2)
+        eq_((3, 1), (counts['added'], counts['failed']))
+        with closing(open_catalog(db)) as conn:
+            eq_([one, two], find_reports(conn, Year='2018'))
+            eq_([one], find_reports(conn, Customer='ACME', Part='B'))
+            eq_([], find_reports(conn, Customer='ACME', Part='C'))
+            eq_([one, two], find_reports(conn, Customer=None))
+            eq_({'Customer': 'ACME', 'Year': '2018', 'Part': ['A', 'B']}, report_params(conn, one))
+
+        # Only the changed report is read again and deleted reports are forgotten
+        _report(two, ['Customer: ACME', 'Year: 2019'], 2000)
+        os.remove(bad)
+        counts = update_catalog(db, reports, processes=1)
+        eq_({'added': 0, 'updated': 1, 'removed': 1, 'unchanged': 1, 'failed': 0}, counts)
+        with closing(open_catalog(db)) as conn:
+            eq_([one, two], find_reports(conn, Customer='ACME'))
+            eq_([two], find_reports(conn, Year='2019'))
+            eq_(0, list(conn.execute('select count(*) from ics_reports where path = ?', (bad,)))[0][0])
@@ -1,6 +1,16 @@
 """Tests for simple sqlite3 wrapper for ICS data."""
 
-from datasimple.sqlite import connect
+import os
+import os.path as pth
+import sqlite3
+import tempfile
+
+from datetime import datetime
+
+from nose.tools import eq_
+from openpyxl import Workbook
+
+from datasimple.sqlite import QueryCache, attach_xlsx, cached_query, connect, normalize_sql, partitioned_query
 
 
 def connect_test():
@@ -52,3 +62,172 @@ def connect_test():
     v('01', """select strftime('%d', ds_datetime('8/1/2017'))""")
     v('01', """select strftime('%d', ds_datetime('08/1/2017'))""")
     v('01', """select strftime('%d', ds_datetime('8/01/2017'))""")
+
+
+def cpi_functions_test():
+    from datasimple.period import Period
+
+    curr = Period.from_dt(datetime.now())
+    cpi_data = []
+    cpi = 100.0
+    for _ in range(13):
+        cpi_data.append({'Year': curr.year, 'Month': curr.month, 'CPI': cpi})
+        cpi *= 0.95
+        curr = curr.prev_period()
+    old = Period(cpi_data[-1]['Year'], cpi_data[-1]['Month'])
+
+    db = connect(':memory:', cpi=cpi_data)
+    with db:
+        db.execute("""create table so (yr, mth, price, so_type)""")
+        db.executemany(
+            """insert into so values (?, ?, ?, ?)""",
+            [(old.year, old.month, 100.0, 'SO'), (str(old.year), str(old.month), '50', 'ce'), (1900, 1, 10.0, 'SO')]
+        )
+
+    def v(sql):
+        return list(db.execute(sql))[0][0]
+
+    eq_(100.0, v("""select ds_cpi({}, {})""".format(Period.CURR_PERIOD.year, Period.CURR_PERIOD.month)))
+    eq_(None, v("""select ds_cpi(1900, 1)"""))
+    eq_(
+        [old.adj_price(100.0, 'SO'), old.adj_price(50.0, 'CE'), None],
+        [r[0] for r in db.execute("""select ds_adj_price(yr, mth, price, so_type) from so order by rowid""")]
+    )
+    eq_(old.adj_price(100.0, 'SO') + old.adj_price(50.0, 'CE'), v("""select ds_sum_adj_price(yr, mth, price, so_type) from so"""))
+    eq_(None, v("""select ds_sum_adj_price(yr, mth, price, so_type) from so where yr = 1900"""))
+
+    # Python before 3.8 doesn't know about deterministic functions
+    class _OldConnection(sqlite3.Connection):
+        def create_function(self, name, nargs, func, **kwargs):
+            if kwargs:
+                raise TypeError('create_function() takes at most 3 arguments')
+            return super().create_function(name, nargs, func)
+
+    from datasimple.sqlite import _register_cpi
+    old_db = sqlite3.connect(':memory:', factory=_OldConnection)
+    _register_cpi(old_db, None)
+    eq_(100.0, list(old_db.execute("""select ds_cpi(?, ?)""", Period.CURR_PERIOD))[0][0])
+
+
+def attach_xlsx_test():
+    old = os.environ.get('DS_CACHE_DIR')
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            os.environ['DS_CACHE_DIR'] = pth.join(folder, 'cache')
+            fn = pth.join(folder, 'book.xlsx')
+            wb = Workbook()
+            sheet = wb.active
+            sheet.title = 'Part List'
+            sheet.append(['Part', 'Qty', None, 'When'])
+            sheet.append(['the a-1', 2, 'ignored', datetime(2018, 1, 2)])
+            sheet.append(['B2', None])
+            wb.save(fn)
+
+            db = connect(':memory:')
+            eq_('Part_List', attach_xlsx(db, fn, 'Part List'))
+            eq_(
+                [('A1', 2, '2018-01-02 00:00:00'), ('B2', None, None)],
+                list(db.execute("""select comppart(Part), Qty, "When" from Part_List order by 1"""))
+            )
+
+            # Second attach (from a new connection) uses the cache
+            cached = os.listdir(pth.join(folder, 'cache', 'xlsx'))
+            mtime = os.stat(pth.join(folder, 'cache', 'xlsx', cached[0])).st_mtime_ns
+            db2 = connect(':memory:')
+            attach_xlsx(db2, fn, 'Part List', 'parts')
+            eq_(mtime, os.stat(pth.join(folder, 'cache', 'xlsx', cached[0])).st_mtime_ns)
+            eq_(2, list(db2.execute("""select count(*) from parts"""))[0][0])
+
+            # Changing the workbook rebuilds, and re-attaching replaces the table
+            sheet.append(['C3', 5])
+            wb.save(fn)
+            st = os.stat(fn)
+            os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+            attach_xlsx(db2, fn, 'Part List', 'parts')
+            eq_(7, list(db2.execute("""select sum(Qty) from parts"""))[0][0])
+            eq_(cached, os.listdir(pth.join(folder, 'cache', 'xlsx')))
+    finally:
+        if old is None:
+            os.environ.pop('DS_CACHE_DIR', None)
+        else:
+            os.environ['DS_CACHE_DIR'] = old
+
+
+def cached_query_test():
+    eq_('select a, \'x  y\' from "t  1"', normalize_sql("""select  a,\n  'x  y'  from "t  1" ;  """))
+
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'data.db')
+        db = connect(fn)
+        with db:
+            db.execute("""create table t (a, b)""")
+            db.executemany("""insert into t values (?, ?)""", [(i % 3, i) for i in range(100)])
+
+        sql = """select a, sum(b) from t where b > ? group by a order by a"""
+        expected = db.execute(sql, (10,)).fetchall()
+        eq_(expected, cached_query(db, sql, (10,)))
+        eq_(expected, cached_query(db, ' ' + sql + ';', (10,)))
+        eq_(expected[:1], cached_query(db, sql + ' limit 1', (10,)))
+        with QueryCache(fn + '.qcache.sqlite') as cache:
+            eq_((1, 2, 2), tuple(cache.stats()[k] for k in ('hits', 'misses', 'entries')))
+
+        # Changes to the data are never served from the cache
+        with db:
+            db.execute("""insert into t values (0, 1000)""")
+        st = os.stat(fn)
+        os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        eq_(db.execute(sql, (10,)).fetchall(), cached_query(db, sql, (10,)))
+        eq_(expected[0][1] + 1000, cached_query(db, sql, (10,))[0][1])
+        db.execute("""insert into t values (0, 100)""")  # Uncommitted
+        eq_(expected[0][1] + 1100, cached_query(db, sql, (10,))[0][1])
+        db.rollback()
+
+        # Even if a change leaves the size and mtime alone
+        before = cached_query(db, sql, (10,))
+        st = os.stat(fn)
+        with db:
+            db.execute("""update t set b = b + 1 where b = 50""")
+        os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns))
+        eq_(st.st_size, os.stat(fn).st_size)
+        eq_(before[2][1] + 1, cached_query(db, sql, (10,))[2][1])
+
+        # Least recently used results go first
+        small = pth.join(folder, 'small.qcache')
+        lru = """select ? || b from t limit 20"""
+        with QueryCache(small) as cache:
+            cache.query(db, lru, ('0',))
+            size = cache.stats()['bytes']
+        with QueryCache(small, max_bytes=size * 5 // 2) as cache:
+            for i in (1, 0, 2):
+                cache.query(db, lru, (str(i),))
+            stats = cache.stats()
+            eq_((1, 3, 2, 1), tuple(stats[k] for k in ('hits', 'misses', 'entries', 'evictions')))
+            cache.query(db, lru, ('1',))  # The one that went
+            eq_(4, cache.stats()['misses'])
+        db.close()
+
+
+def partitioned_query_test():
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'data.db')
+        db = connect(fn)
+        with db:
+            db.execute("""create table parts (part, qty)""")
+            db.executemany("""insert into parts values (?, ?)""", [('the p-{}'.format(i), i) for i in range(200)])
+            db.execute("""delete from parts where qty between 50 and 120""")  # A gap in the rowids
+            db.execute("""create table names (cp, name)""")
+            db.execute("""insert into names values ('P3', 'Three')""")
+            db.execute("""create table empty (part)""")
+
+        sql = """select comppart(p.part) as cp, p.qty * 2, n.name from parts p left join names n on n.cp = comppart(p.part)
+                 where p.qty % 3 = ?"""
+        cur = db.execute(sql, (0,))
+        cols, rows = partitioned_query(fn, sql, 'parts', params=(0,), processes=2, partitions=7)
+        eq_([d[0] for d in cur.description], cols)
+        expected = cur.fetchall()
+        eq_(expected, list(rows))
+        eq_(('P3', 6, 'Three'), expected[1])
+
+        cols, rows = partitioned_query(fn, """select comppart(part) as cp from empty""", 'empty', processes=2)
+        eq_((['cp'], []), (cols, list(rows)))
+        db.close()
@@ -0,0 +1,66 @@
+"""Import-time checks: keep the heavy dependencies off the import path."""
+
+import subprocess
+import sys
+
+from nose.tools import eq_
+
+# Only loaded when first used
+HEAVY = ('colorclass', 'terminaltables', 'openpyxl')
+
+# Slow standard library modules that only some code paths need
+SLOW_STDLIB = (
+    'configparser', 'hashlib', 'http.client', 'json', 'multiprocessing', 'pickle', 'tempfile', 'urllib.request',
+)
+
+
+def _import_times(stmt):
+    """Run stmt under python -X importtime and return {module: cumulative usec}."""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', stmt],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue  # Column header
+        times[parts[2].strip()] = int(parts[1])
+    return times
+
+
+def _heavy(times):
+    return sorted(m for m in times if m.split('.')[0] in HEAVY)
+
+
+def lazy_import_test():
+    for mod in ['cli', 'core', 'profile', 'sqlite', 'period', 'rpt', 'xl']:
+        times = _import_times('import datasimple.' + mod)
+        assert 'datasimple.' + mod in times
+        eq_([], _heavy(times), mod)
+
+
+def lazy_stdlib_test():
+    for mod in ['cli', 'core', 'profile', 'sqlite']:
+        times = _import_times('import datasimple.' + mod)
+        eq_([], sorted(m for m in times if m in SLOW_STDLIB), mod)
+
+    # Process pools are only for --jobs > 1 and the like
+    for mod in ['rpt', 'xlwriter', 'icscatalog', 'partgroup']:
+        times = _import_times('import datasimple.' + mod)
+        assert 'datasimple.' + mod in times
+        assert 'multiprocessing' not in times, mod
+
+
+def lazy_first_use_test():
+    times = _import_times('from datasimple.cli import clr; clr("x")')
+    assert 'colorclass' in times
+    assert 'terminaltables' not in times
+
+    times = _import_times('from datasimple.cli import Table')
+    assert 'terminaltables' in times
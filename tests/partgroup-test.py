@@ -0,0 +1,100 @@
+"""Tests for out-of-core grouping by compressed part number."""
+
+import csv
+import os.path as pth
+import tempfile
+
+from nose.tools import eq_, raises
+from openpyxl import Workbook
+
+from datasimple.core import comppart
+from datasimple.partgroup import group_parts, parse_aggs, read_source
+
+
+COLS = ['Part', 'Qty', 'Descr']
+
+
+class _Rows(list):
+    def writerow(self, row):
+        self.append(row)
+
+    def writerows(self, rows):
+        self.extend(rows)
+
+
+def _rows(count):
+    # Several spellings of each part, plus the odd blank part and blank Qty
+    for i in range(count):
+        part = ['the p-{}', 'P{}', ' p {} '][i % 3].format(i % 250)
+        if i % 97 == 0:
+            part = ' '
+        yield [part, '' if i % 11 == 0 else str(i % 7), 'Desc {}'.format(i)]
+
+
+def _expected(rows, key_func):
+    groups = {}
+    for row in rows:
+        cp = comppart(row[0])
+        if not cp:
+            continue
+        g = groups.setdefault(cp, [cp, 0, 0, None, None, row[2]])
+        qty = int(row[1]) if row[1] != '' else None
+        g[1] += 1
+        if qty is not None:
+            g[2] += qty
+            g[3] = qty if g[3] is None else min(g[3], qty)
+        g[4] = row[2]
+    return key_func(groups)
+
+
+def group_parts_test():
+    rows = list(_rows(3000))
+    expected = _expected(rows, lambda groups: list(groups.values()))
+    aggs = ['count', 'sum:Qty', 'min:Qty', 'last:Descr', 'first:Descr']
+
+    for processes, partitions in ((1, 1), (2, 7)):
+        out = _Rows()
+        # A tiny memory budget makes sure we spill more than once
+        counts = group_parts(COLS, iter(rows), 'Part', aggs, out, memory_mb=0, processes=processes, partitions=partitions)
+        eq_(['CompPart', 'count', 'sum(Qty)', 'min(Qty)', 'last(Descr)', 'first(Descr)'], out[0])
+        eq_(expected, out[1:])
+        eq_({'rows': 3000, 'blank': 31, 'groups': 250}, counts)
+
+
+def dedupe_test():
+    out = _Rows()
+    rows = [['the a-1', '1', 'x'], ['B', '2'], ['A1', '3', 'y'], ['', '4', 'z']]
+    group_parts(COLS, iter(rows), 'Part', [], out, processes=1)
+    eq_([['CompPart'] + COLS, ['A1', 'the a-1', '1', 'x'], ['B', 'B', '2', None]], out)
+
+
+@raises(ValueError)
+def bad_agg_test():
+    parse_aggs(['median:Qty'], COLS)
+
+
+def read_source_test():
+    rows = [['P1', 2, 'one'], ['P2', 3, 'two']]
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'parts.csv')
+        with open(fn, 'w', newline='') as outp:
+            csv.writer(outp).writerows([COLS] + rows)
+        cols, found = read_source(fn)
+        eq_((COLS, [['P1', '2', 'one'], ['P2', '3', 'two']]), (cols, list(found)))
+
+        fn = pth.join(folder, 'parts.rpt')
+        with open(fn, 'w') as outp:
+            outp.write('Part  Qty   Descr\n----- ----- -----\n')
+            for r in rows:
+                outp.write('{:<5} {:<5} {:<5}\n'.format(*r))
+        cols, found = read_source(fn)
+        eq_((COLS, [['P1', '2', 'one'], ['P2', '3', 'two']]), (cols, list(found)))
+
+        fn = pth.join(folder, 'parts.xlsx')
+        wb = Workbook()
+        wb.active.title = 'Parts'
+        for r in [COLS] + rows:
+            wb.active.append(r)
+        wb.save(fn)
+        cols, found = read_source(fn, 'Parts')
+        eq_((COLS, rows), (cols, list(found)))
@@ -1,10 +1,15 @@
 """Tests for helpers for time periods."""
 
+import json
+import os
+import os.path as pth
+import tempfile
+
 from datetime import datetime, timedelta
 
 from nose.tools import eq_  # ok_
 
-from datasimple.period import Period
+from datasimple.period import Period, CPI_CACHE_SUFFIX
 
 
 def eqf_(f1, f2):
@@ -50,3 +55,42 @@ def period_test():
     # from the past into today's dollars should increase that amount
     assert window[0].adj_price(100.0, 'SO') > window[-1].adj_price(100.0, 'SO')
     assert window[0].adj_price(100.0, 'CE') > window[-1].adj_price(100.0, 'CE')
+
+
+def cpi_file_test():
+    curr = Period.from_dt(datetime.now())
+    cpi_data = []
+    cpi = 100.0
+    for _ in range(24):
+        cpi_data.append({'Year': curr.year, 'Month': curr.month, 'CPI': cpi})
+        cpi *= 0.99
+        curr = curr.prev_period()
+    cpi_data.pop(5)  # Leave a hole in the middle
+    missing = Period(cpi_data[4]['Year'], cpi_data[4]['Month']).prev_period()
+
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'period.json')
+        with open(fn, 'w') as outp:
+            json.dump(cpi_data, outp)
+
+        Period.init_cpi_file(fn)
+        assert pth.isfile(fn + CPI_CACHE_SUFFIX), 'Cache not compiled'
+        for rec in cpi_data:
+            eqf_(rec['CPI'], Period(rec['Year'], rec['Month']).cpi())
+        assert missing not in Period.CPI_REF
+        assert Period(1900, 1) not in Period.CPI_REF
+        eq_(23, len(Period.CPI_REF))
+        eq_(dict((Period(r['Year'], r['Month']), r['CPI']) for r in cpi_data), dict(Period.CPI_REF.items()))
+        eqf_(1000.0, Period.CURR_PERIOD.adj_price(100.0, 'CE'))
+
+        # Second init should reuse the cache as-is
+        mtime = os.stat(fn + CPI_CACHE_SUFFIX).st_mtime_ns
+        Period.init_cpi_file(fn)
+        eq_(mtime, os.stat(fn + CPI_CACHE_SUFFIX).st_mtime_ns)
+
+        # Changing the source must invalidate the cache
+        cpi_data[0]['CPI'] = 250.25  # Different size as well as mtime
+        with open(fn, 'w') as outp:
+            json.dump(cpi_data, outp)
+        Period.init_cpi_file(fn)
+        eqf_(250.25, Period.CURR_PERIOD.cpi())
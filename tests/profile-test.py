@@ -0,0 +1,62 @@
+"""Tests for profiling spans and counters."""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from nose.tools import eq_
+
+from datasimple import profile
+
+
+def disabled_test():
+    def f(x):
+        return x + 1
+    if not profile.ENABLED:
+        assert profile.timed('f')(f) is f
+        assert profile.span('f') is profile._NULL_SPAN
+
+
+def spans_test():
+    was = profile.ENABLED
+    profile.ENABLED = True
+    profile.reset()
+    try:
+        @profile.timed('add')
+        def add(a, b):
+            return a + b
+
+        eq_(3, add(1, 2))
+        eq_(5, add(2, 3))
+        with profile.span('block'):
+            profile.count('things', 2)
+        profile.count('things')
+
+        smry = profile.summary()
+        spans = dict((s['name'], s) for s in smry['spans'])
+        eq_(2, spans['add']['calls'])
+        eq_(1, spans['block']['calls'])
+        assert spans['add']['max'] <= spans['add']['total']
+        eq_({'things': 3}, smry['counters'])
+    finally:
+        profile.ENABLED = was
+        profile.reset()
+
+
+def json_dump_test():
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, 'prof.json')
+        env = dict(os.environ, DS_PROFILE='JSON', DS_PROFILE_FILE=out)
+        subprocess.run([
+            sys.executable, '-c',
+            'from datasimple.period import Period\n'
+            'Period.CPI_REF = {Period(2015, 1): 200.0, Period(2016, 1): 250.0}\n'
+            'Period.CURR_PERIOD = Period(2016, 1)\n'
+            'print(Period(2015, 1).adj_price(10.0, "SO"))\n'
+        ], env=env, check=True, stdout=subprocess.PIPE)
+        with open(out) as fh:
+            smry = json.load(fh)
+    spans = dict((s['name'], s) for s in smry['spans'])
+    eq_(1, spans['period.Period.adj_price']['calls'])
@@ -0,0 +1,254 @@
+"""Tests for RPT file helpers."""
+
+import json
+import os.path as pth
+import struct
+import tempfile
+
+from contextlib import closing
+
+from nose.tools import eq_
+
+from datasimple.rpt import NpySink, ReportProcessor, RptReader, SqliteSink, infer_type, process_rpt
+from datasimple.sqlite import connect
+
+
+RPT_HDR = 'Part       Qty   Descr               \n'
+RPT_DELIM = '---------- ----- --------------------\n'
+
+
+def _rpt_lines(count):
+    for i in range(count):
+        yield 'P{:<9d} {:<5d} Desc {:<15d}\n'.format(i, i % 100, i)
+
+
+def _write_rpt(folder, count, encoding='utf-8-sig', newline=None):
+    fn = pth.join(folder, 'test.rpt')
+    with open(fn, 'w', encoding=encoding, newline=newline) as outp:
+        outp.write(RPT_HDR)
+        outp.write(RPT_DELIM)
+        for idx, line in enumerate(_rpt_lines(count)):
+            outp.write(line)
+            if idx == count // 2:
+                outp.write('\n')
+            if idx == count // 3:
+                outp.write('Pé{:<8d} 1     Ünïcödé Desc\n'.format(idx))
+            if idx == count // 4:
+                outp.write('Short      2     Trimmed\n')
+        outp.write('\n')
+        outp.write('({:,d} row(s) affected)\n'.format(count))
+    return fn
+
+
+class _Rows(list):
+    writerow = list.append
+    writerows = list.extend
+
+
+def processor_test():
+    rows = _Rows()
+    proc = ReportProcessor(RPT_HDR, RPT_DELIM, rows)
+    eq_([['Part', 'Qty', 'Descr']], rows)
+
+    proc.process('P1         2     Some Text           \n')
+    proc.process('(1 row(s) affected)\n')
+    proc.process('   \n')
+    eq_(['P1', '2', 'Some Text'], rows[1])
+    eq_(1, proc.count)
+    eq_(2, proc.rejected)
+
+
+def process_rpt_test():
+    with tempfile.TemporaryDirectory() as folder:
+        fn = _write_rpt(folder, 5000)
+
+        serial = _Rows()
+        proc = process_rpt(fn, serial, fast=False)
+        eq_(5003, len(serial))
+        eq_(['Part', 'Qty', 'Descr'], serial[0])
+        eq_(['P4999', '99', 'Desc 4999'], serial[-1])
+        eq_(['Pé1666', '1', 'Ünïcödé Desc'], serial[1669])
+        eq_(['Short', '2', 'Trimmed'], serial[1252])
+        eq_(5002, proc.count)
+        eq_(3, proc.rejected)
+
+        fast = _Rows()
+        proc = process_rpt(fn, fast)
+        eq_(serial, fast)
+        eq_(5002, proc.count)
+        eq_(3, proc.rejected)
+
+        # Tiny chunks so that we get lots of them
+        chunked = _Rows()
+        proc = process_rpt(fn, chunked, processes=3, chunk_bytes=4096)
+        eq_(serial, chunked)
+        eq_(5002, proc.count)
+        eq_(3, proc.rejected)
+
+        # The default encoding really does use the pool
+        reader = RptReader(fn, processes=3, chunk_bytes=4096)
+        eq_(serial, list(reader))
+        eq_(3, reader.processes)
+        assert reader.chunks > 10, reader.chunks
+
+
+def process_rpt_encodings_test():
+    with tempfile.TemporaryDirectory() as folder:
+        fn = _write_rpt(folder, 500, newline='\r\n')
+        serial = _Rows()
+        process_rpt(fn, serial, fast=False)
+        fast = _Rows()
+        process_rpt(fn, fast)
+        eq_(serial, fast)
+
+        # Not ASCII compatible, so we fall back to the text path
+        fn = _write_rpt(folder, 500, encoding='utf-16')
+        utf16 = _Rows()
+        proc = process_rpt(fn, utf16, encoding='utf-16', processes=2)
+        eq_(serial, utf16)
+        eq_(502, proc.count)
+
+
+def scan_bytes_test():
+    with tempfile.TemporaryDirectory() as folder:
+        fn = _write_rpt(folder, 2000)
+        serial = _Rows()
+        process_rpt(fn, serial, fast=False)
+
+        with open(fn, 'rb') as fh:
+            data = fh.read()
+        start = data.index(RPT_DELIM.encode('ascii')) + len(RPT_DELIM)
+
+        # Small blocks: most are pure ASCII and fixed width but some have the
+        # blank, short, non-ASCII and "rows affected" lines
+        rows = _Rows()
+        proc = ReportProcessor(RPT_HDR, RPT_DELIM, rows)
+        for batch in proc.scan_bytes(data, start, len(data), 'utf-8', block_bytes=512):
+            rows.extend(batch)
+        eq_(serial, rows)
+        eq_(3, proc.rejected)
+
+
+def scan_bytes_ragged_test():
+    hdr, delims = 'Part  Qty   Descr\n', '----- ----- -----\n'
+    # The two short lines together are exactly one full line long
+    lines = ['AAA   1     xyz  \n', 'AAA   1\n', 'BBB   2 x\n', 'CCC   3     xyz  \n']
+    expected = _Rows()
+    proc = ReportProcessor(hdr, delims, expected)
+    for line in lines:
+        proc.process(line)
+
+    rows = _Rows()
+    proc = ReportProcessor(hdr, delims, rows)
+    data = ''.join(lines).encode('ascii')
+    for batch in proc.scan_bytes(data, 0, len(data), 'utf-8'):
+        rows.extend(batch)
+    eq_(['AAA', '1', ''], expected[2])
+    eq_(expected, rows)
+
+
+def unterminated_last_line_test():
+    hdr = 'A     B  \n----- ---\n'
+    with tempfile.TemporaryDirectory() as folder:
+        for body, expected in (
+            ('cd    2  ', [['cd', '2']]),
+            ('ab    1  \n\ncd    2  ', [['ab', '1'], ['cd', '2']]),
+            ('ab    1  \n(1 row(s) affected)\ncd    2', [['ab', '1'], ['cd', '2']]),
+        ):
+            fn = pth.join(folder, 'test.rpt')
+            with open(fn, 'w') as outp:
+                outp.write(hdr + body)
+            for fast in (False, True):
+                rows = _Rows()
+                process_rpt(fn, rows, fast=fast)
+                eq_([['A', 'B']] + expected, rows)
+            eq_([['A', 'B']] + expected, list(RptReader(fn, processes=2, chunk_bytes=8)))
+
+
+def sinks_test():
+    with tempfile.TemporaryDirectory() as folder:
+        fn = _write_rpt(folder, 1000)
+        expected = _Rows()
+        process_rpt(fn, expected, fast=False)
+
+        reader = RptReader(fn)
+        cols, rows = reader.columns_and_rows()
+        eq_(expected[0], cols)
+        eq_(expected[1:], list(rows))
+        eq_(1002, reader.processor.count)
+
+        db = pth.join(folder, 'test.sqlite')
+        with closing(SqliteSink(db, 'rpt', batch_rows=100)) as sink:
+            process_rpt(fn, sink)
+        conn = connect(db)
+        eq_(expected[1:], [list(r) for r in conn.execute('select * from rpt order by rowid')])
+        eq_(expected[0], [d[0] for d in conn.execute('select * from rpt').description])
+
+
+def infer_type_test():
+    eq_('str', infer_type([]))
+    eq_('str', infer_type(['', '']))
+    eq_('int', infer_type(['1', '-2', '30']))
+    eq_('float', infer_type(['1', '-2', '', '30']))
+    eq_('float', infer_type(['1', '2.5']))
+    eq_('date', infer_type(['06/22/2017', '8/1/17', '2017-06-23']))
+    eq_('datetime', infer_type(['06/22/2017', '2017-06-23 10:11:12.000', '8/1/17 9:30']))
+    eq_('str', infer_type(['1', 'x']))
+
+    # The whole value has to parse
+    eq_('str', infer_type(['2020-01-01xyz']))
+    eq_('str', infer_type(['2020-01-01 12:34:56.000 junk']))
+    eq_('str', infer_type(['06/22/2017 noon']))
+
+    # Zero padded codes and underscores stay strings
+    eq_('str', infer_type(['00123', '1']))
+    eq_('str', infer_type(['0012.5']))
+    eq_('str', infer_type(['1_000']))
+    eq_('int', infer_type(['0', '-10']))
+    eq_('float', infer_type(['0.5', '-0.25']))
+
+
+def npy_sink_test():
+    def _npy(fn):
+        with open(fn, 'rb') as inp:
+            data = inp.read()
+        assert data.startswith(b'\x93NUMPY\x01\x00')
+        hdr_len = struct.unpack('<H', data[8:10])[0]
+        return data[10:10 + hdr_len].decode('ascii'), data[10 + hdr_len:]
+
+    with tempfile.TemporaryDirectory() as folder:
+        with closing(NpySink(folder, sample_rows=2)) as sink:
+            sink.writerows([['Part', 'Qty', 'Price', 'Dt', 'At']])
+            sink.writerows([
+                ['A', '1', '1.5', '06/22/2017', '2020-01-01 12:34:56.789'],
+                ['B', '2', '', '1/1/1970', '1970-01-01'],
+            ])
+            sink.writerow(['C', 'oops', '3', '1970-01-02 10:00:00.000', 'x'])
+
+        with open(pth.join(folder, 'schema.json')) as inp:
+            schema = json.load(inp)['columns']
+        eq_(['Part', 'Qty', 'Price', 'Dt', 'At'], [c['name'] for c in schema])
+        eq_(['str', 'int', 'float', 'date', 'datetime'], [c['type'] for c in schema])
+        eq_([3, 3, 3, 3, 3], [c['count'] for c in schema])
+        # A time in a date column isn't silently dropped
+        eq_([0, 1, 0, 1, 1], [c['failed'] for c in schema])
+
+        hdr, data = _npy(pth.join(folder, schema[0]['file']))
+        assert "'descr': '<U1'" in hdr and "'shape': (3,)" in hdr, hdr
+        eq_('ABC', data.decode('utf-32-le'))
+
+        hdr, data = _npy(pth.join(folder, schema[1]['file']))
+        eq_((1, 2, -2 ** 63), struct.unpack('<3q', data))
+
+        hdr, data = _npy(pth.join(folder, schema[2]['file']))
+        vals = struct.unpack('<3d', data)
+        eq_(1.5, vals[0])
+        assert vals[1] != vals[1], 'Expected NaN'
+
+        hdr, data = _npy(pth.join(folder, schema[3]['file']))
+        assert "'descr': '<M8[D]'" in hdr, hdr
+        eq_((17339, 0, -2 ** 63), struct.unpack('<3q', data))
+
+        hdr, data = _npy(pth.join(folder, schema[4]['file']))
+        assert "'descr': '<M8[ms]'" in hdr, hdr
+        eq_((1577882096789, 0, -2 ** 63), struct.unpack('<3q', data))
@@ -0,0 +1,147 @@
+"""Tests for the bin/sample.py line sampler."""
+
+import importlib.util
+import io
+import os.path as pth
+import random
+import subprocess
+import sys
+import tempfile
+
+from nose.tools import eq_
+
+SCRIPT = pth.join(pth.dirname(pth.dirname(pth.abspath(__file__))), 'bin', 'sample.py')
+
+_spec = importlib.util.spec_from_file_location('sample', SCRIPT)
+sample = importlib.util.module_from_spec(_spec)
+sys.modules['sample'] = sample  # So pool workers can be pickled
+_spec.loader.exec_module(sample)
+
+
+def _lines(count, newline=b'\n'):
+    return [b'line %d' % i + newline for i in range(count)]
+
+
+def _run(data, *args):
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'input.txt')
+        with open(fn, 'wb') as outp:
+            outp.write(data)
+        return subprocess.check_output([sys.executable, SCRIPT, '-i', fn] + list(args), stderr=subprocess.DEVNULL)
+
+
+def tail_start_test():
+    old_block = sample.TAIL_BLOCK
+    sample.TAIL_BLOCK = 7  # Lots of blocks
+    try:
+        for newline in (b'\n', b'\r\n'):
+            lines = _lines(50, newline)
+            for data in (b''.join(lines), b''.join(lines).rstrip(b'\r\n')):
+                fh = io.BytesIO(data)
+                for count in (0, 1, 3, 49, 50, 51):
+                    start = sample.tail_start(fh, count, size=len(data))
+                    eq_(b''.join(lines[50 - min(count, 50):]).rstrip(b'\r\n'), data[start:].rstrip(b'\r\n'))
+    finally:
+        sample.TAIL_BLOCK = old_block
+
+
+def head_tail_test():
+    lines = _lines(1000)
+    for data in (b''.join(lines), b''.join(lines).rstrip(b'\n')):
+        out = _run(data, '-h', '3', '-t', '2', '-k', '10', '-r', '42').splitlines(True)
+        eq_(15, len(out))
+        eq_(lines[:3], out[:3])
+        eq_(lines[-2:], [out[-2], out[-1] + (b'' if out[-1].endswith(b'\n') else b'\n')])
+        middle = [lines.index(ln) for ln in out[3:-2]]
+        eq_(sorted(middle), middle)
+        assert all(3 <= idx < 998 for idx in middle), middle
+
+        # Head and tail that overlap just give the file once
+        eq_(data, _run(data, '-h', '800', '-t', '800', '-s', '0.5'))
+
+    eq_(_run(b''.join(lines), '-s', '0.2', '-r', '7'), _run(b''.join(lines), '-s', '0.2', '-r', '7'))
+
+
+def sample_rate_test():
+    lines = _lines(20000)
+    data = b''.join(lines)
+    out = []
+    count = sample.sample_rate(io.BytesIO(data), len(data), 0.1, random.Random(1), out.append)
+    eq_(count, len(out))
+    # Binomial(20000, 0.1) has a standard deviation of about 42
+    assert 1800 < count < 2200, count
+    idxs = [lines.index(ln) for ln in out[:50]]
+    eq_(sorted(set(idxs)), idxs)
+
+
+def sample_count_test():
+    lines = _lines(50)
+    data = b''.join(lines)
+    eq_((50, lines), sample.sample_count(io.BytesIO(data), len(data), 80, random.Random(1)))
+
+    rng = random.Random(3)
+    seen = [0] * 50
+    for _ in range(2000):
+        count, picked = sample.sample_count(io.BytesIO(data), len(data), 5, rng)
+        eq_(50, count)
+        eq_(5, len(picked))
+        idxs = [lines.index(ln) for ln in picked]
+        eq_(sorted(set(idxs)), idxs)
+        for idx in idxs:
+            seen[idx] += 1
+    # Each line is expected 200 times, with a standard deviation of about 13
+    assert all(130 < n < 270 for n in seen), seen
+
+
+def line_reader_test():
+    old_block = sample.READ_BLOCK
+    sample.READ_BLOCK = 5  # Lines span blocks
+    try:
+        lines = _lines(100)
+        for data in (b''.join(lines), b''.join(lines).rstrip(b'\n')):
+            for skip in (0, 1, 2, 7, 99, 150):
+                fh = io.BytesIO(data)
+                fh.seek(len(lines[0]))
+                reader = sample._LineReader(fh, len(data))
+                got = []
+                line = reader.next_after(skip)
+                while line is not None:
+                    got.append(line.rstrip(b'\n'))
+                    line = reader.next_after(skip)
+                eq_([ln.rstrip(b'\n') for ln in lines[1 + skip::skip + 1]], got)
+                eq_(99, reader.lines)
+    finally:
+        sample.READ_BLOCK = old_block
+
+
+def parallel_sample_test():
+    lines = _lines(5000)
+    data = b''.join(lines)
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'input.txt')
+        with open(fn, 'wb') as outp:
+            outp.write(data)
+        with open(fn, 'rb') as fh:
+            ranges = sample.chunk_ranges(fh, 0, len(data), 4096)
+        assert len(ranges) > 5, ranges
+
+        # Each range is only read once, and the counts still cover every line
+        results = [sample._count_worker((fn, idx, st, end, 10, 5)) for idx, (st, end) in enumerate(ranges)]
+        eq_(len(lines), sum(n for n, _ in results))
+
+        out = []
+        sample.parallel_sample(fn, ranges, 2, 5, out.append, k=40)
+        eq_(40, len(out))
+        idxs = [lines.index(ln) for ln in out]
+        eq_(sorted(set(idxs)), idxs)
+
+        # Rate mode gives what sampling each range serially does
+        out = []
+        sample.parallel_sample(fn, ranges, 2, 5, out.append, rate=0.1)
+        serial = []
+        with open(fn, 'rb') as fh:
+            for idx, (st, end) in enumerate(ranges):
+                fh.seek(st)
+                sample.sample_rate(fh, end, 0.1, sample._chunk_rng(5, idx), serial.append)
+        eq_(b''.join(serial), b''.join(out))
+        assert 400 < len(serial) < 600, len(serial)
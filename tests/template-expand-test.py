@@ -0,0 +1,113 @@
+"""Tests for the bin/template-expand.py template expander."""
+
+import importlib.util
+import io
+import os
+import os.path as pth
+import subprocess
+import sys
+import tempfile
+
+from nose.tools import eq_, raises
+
+SCRIPT = pth.join(pth.dirname(pth.dirname(pth.abspath(__file__))), 'bin', 'template-expand.py')
+
+_spec = importlib.util.spec_from_file_location('template_expand', SCRIPT)
+template_expand = importlib.util.module_from_spec(_spec)
+sys.modules['template_expand'] = template_expand  # So pool workers can be pickled
+_spec.loader.exec_module(template_expand)
+
+
+def _expand(text, template_vars, chunk_chars):
+    out = []
+    template_expand.expand_stream(io.StringIO(text), template_vars, out.append, chunk_chars=chunk_chars)
+    return ''.join(out)
+
+
+def _run(args, stdin='', env=None):
+    return subprocess.run(
+        [sys.executable, SCRIPT] + args,
+        input=stdin, stdout=subprocess.PIPE, universal_newlines=True, env=env, check=True
+    ).stdout
+
+
+def expand_stream_test():
+    template_vars = {'A': 'Hello', 'B': 'World', 'W': 7, 'x\ny': 'odd'}
+    lines = ['{A} {B:>{W}} {{literal}}\n' for _ in range(20)]
+    # A fill char and a field name with newlines in them: the first chunk cut
+    # that lands inside one can't be parsed on its own
+    lines[5] = '{A:\n^9} {x\ny}\n'
+    lines.append('{B}')  # No final newline
+    text = ''.join(lines)
+    expected = text.format_map(template_vars)
+    for chunk_chars in (1, 3, 8, 40, len(text), len(text) + 1, 1024 * 1024):
+        eq_(expected, _expand(text, template_vars, chunk_chars), chunk_chars)
+
+    # One long line with no newline at all
+    text = '{A}' * 500
+    eq_('Hello' * 500, _expand(text, template_vars, 16))
+
+
+@raises(KeyError)
+def expand_stream_missing_test():
+    _expand('ok\n' * 10 + '{Missing}\n', {}, 4)
+
+
+@raises(ValueError)
+def expand_stream_malformed_test():
+    _expand('ok\n' * 10 + '{A\n', {'A': 1}, 4)
+
+
+def output_name_test():
+    eq_('report.html', template_expand.output_name('/x/report.html.tmpl'))
+    eq_('report.html', template_expand.output_name('report.html.TEMPLATE'))
+    eq_('report.html', template_expand.output_name('report.html'))
+    eq_('Makefile', template_expand.output_name('y/Makefile.tmpl'))
+
+
+def split_argv_test():
+    eq_(
+        (['A=1', '-h=2', '--x=y=z'], ['-j', '2', '--outdir=out', 't.tmpl']),
+        template_expand.split_argv(['A=1', '-j', '2', '-h=2', '--outdir=out', '--x=y=z', 't.tmpl'])
+    )
+    eq_({'A': '1', '-h': '2', '--x': 'y=z'}, dict(template_expand.parse_args(['A=1', '-h=2', '--x=y=z'])))
+
+
+def expand_files_test():
+    with tempfile.TemporaryDirectory() as folder:
+        templates = []
+        for i in range(6):
+            fn = pth.join(folder, 'part{}.txt.tmpl'.format(i))
+            with open(fn, 'w') as outp:
+                outp.write('{{A}} {} {{B}}\n'.format(i) * (i + 1))
+            templates.append(fn)
+        expected = ''.join('x {} y\n'.format(i) * (i + 1) for i in range(6))
+
+        # In the order given on stdout, with no temp files left behind
+        tmp = pth.join(folder, 'tmp')
+        os.mkdir(tmp)
+        env = dict(os.environ, TMPDIR=tmp, B='env')
+        for jobs in ('1', '3'):
+            eq_(expected, _run(['--jobs', jobs, 'A=x', 'B=y'] + templates, env=env))
+            eq_([], os.listdir(tmp))
+        eq_('x 0 env\n', _run(['A=x', templates[0]], env=env))
+
+        outdir = pth.join(folder, 'out')
+        template_expand.expand_files(templates, {'A': 'x', 'B': 'y'}, outdir, jobs=2)
+        eq_(['part{}.txt'.format(i) for i in range(6)], sorted(os.listdir(outdir)))
+        with open(pth.join(outdir, 'part2.txt')) as inp:
+            eq_('x 2 y\n' * 3, inp.read())
+
+
+@raises(ValueError)
+def expand_files_overwrite_test():
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'same.txt')
+        with open(fn, 'w') as outp:
+            outp.write('{A}')
+        template_expand.expand_files([fn], {'A': 1}, folder)
+
+
+def stdin_test():
+    env = dict(os.environ, A='Hello', B='World')
+    eq_('Hello You 1', _run(['B=You', '--x=1'], '{A:} {B:} {--x}', env=env))
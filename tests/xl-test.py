@@ -117,11 +117,19 @@ def ics_parms_test():
 
     with temp_xlsx_name() as tmpname:
         wb.save(tmpname)
-        read = ics_report_params(tmpname, sheet_name='CustomCover')
-        eq_('MISSING', read.get('ParmX', 'MISSING'))
-        eq_('First', read['Parm1'])
-        eq_('Last', read['Parm42'])
-        eq_(['A', 'B', 'C'], read['ParmMult'])
+        for fast in (True, False):
+            read = ics_report_params(tmpname, sheet_name='CustomCover', fast=fast)
+            eq_('MISSING', read.get('ParmX', 'MISSING'))
+            eq_('First', read['Parm1'])
+            eq_('Last', read['Parm42'])
+            eq_(['A', 'B', 'C'], read['ParmMult'])
+
+            # Both ways look sheets up by their exact name
+            try:
+                ics_report_params(tmpname, sheet_name='customcover', fast=fast)
+                assert False, 'Found customcover with fast={}'.format(fast)
+            except KeyError:
+                pass
 
 
 def mapper_config_test():
@@ -303,3 +311,43 @@ def importer_tranpose_tests():
         # Check twice - once for create and once for rewrite
         check_sheet()
         check_sheet()
+
+
+def importer_cache_tests():
+    class TestImporter(XlsxImporter):
+        key = 'v1'
+        calls = 0
+
+        def add_args(self, argparser):
+            pass
+
+        def validate_args(self, args):
+            pass
+
+        def cache_key(self, args):
+            return self.key
+
+        def get_data(self, args):
+            TestImporter.calls += 1
+            return ['Name', 'Key'], iter([['r1', self.key]])
+
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'cache_file.xlsx')
+
+        def run(*extra, key='v1'):
+            TestImporter.key = key
+            TestImporter().main(cmdline_args=['-b', fn, '-s', 'Cached', '--cache'] + list(extra))
+            return TestImporter.calls
+
+        eq_(1, run())
+        eq_(1, run())  # Skipped
+        eq_(2, run(key='v2'))  # New inputs
+        eq_(['r1', 'v2'], list(ws_scan_raw(fn, 'Cached'))[1])
+        eq_(3, run('-f', 'A2', key='v2'))  # New args
+        eq_(3, run('-f', 'A2', '-u', key='v2'))
+
+        # Building without --cache forgets the fingerprint
+        TestImporter().main(cmdline_args=['-b', fn, '-s', 'Cached', '-f', 'A2', '-u'])
+        eq_(4, TestImporter.calls)
+        eq_(5, run('-f', 'A2', '-u', key='v2'))
+        eq_(5, run('-f', 'A2', key='v2'))
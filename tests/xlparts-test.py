@@ -0,0 +1,158 @@
+"""Tests for zip level XLSX surgery."""
+
+import os.path as pth
+import re
+import tempfile
+import zipfile
+
+from lxml import etree
+from nose.tools import eq_
+from openpyxl import Workbook, load_workbook
+
+from datasimple.xl import XlsxImporter, add_default_styles, ws_scan_raw, ws_sheet_names
+from datasimple.xlparts import (
+    EMPTY_SST, SHARED_STRINGS_PART, Book, read_custom_properties, replace_sheet, save_workbook, set_custom_properties
+)
+
+
+class _Importer(XlsxImporter):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def add_args(self, argparser):
+        pass
+
+    def validate_args(self, args):
+        pass
+
+    def get_data(self, args):
+        return ['Name', 'Qty', 'ExtPrice'], iter(self.rows)
+
+
+def _make_book(fn):
+    wb = Workbook()
+    wb.active.title = 'First'
+    wb['First']['A1'] = 'Keep me'
+    wb['First']['B1'] = '=1+1'
+    wb.create_sheet('Target')['A1'] = 'Old data'
+    wb.create_sheet('Last')['A1'] = 'Me too'
+    add_default_styles(wb)
+    wb['Last']['A2'].style = 'IMHeader'
+    wb.save(fn)
+
+
+def _infos(fn):
+    with zipfile.ZipFile(fn) as zf:
+        return {i.filename: (i.CRC, i.compress_size) for i in zf.infolist()}
+
+
+def replace_in_place_test():
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'book.xlsx')
+        _make_book(fn)
+        before = _infos(fn)
+
+        for rows in ([['a', 1, 1.5], ['b', 2, 2.5]], [['c', 3, 3.5]]):
+            _Importer(rows).main(cmdline_args=['-b', fn, '-s', 'Target', '-f', 'A2', '--surgical'])
+            eq_(['First', 'Target', 'Last'], ws_sheet_names(fn))
+            eq_([['Name', 'Qty', 'ExtPrice']] + rows, list(ws_scan_raw(fn, 'Target')))
+
+        # Everything but the sheet, workbook and styles is untouched
+        after = _infos(fn)
+        with zipfile.ZipFile(fn) as zf:
+            book = Book(zf)
+            target = book.find_sheet('Target')[1]
+            changed = {target, book.part, 'xl/styles.xml'}
+        eq_(set(before), set(after))
+        for name, info in before.items():
+            if name not in changed:
+                eq_(info, after[name], name)
+
+        wb = load_workbook(fn)
+        eq_('Keep me', wb['First']['A1'].value)
+        eq_('=1+1', wb['First']['B1'].value)
+        eq_('IMHeader', wb['Last']['A2'].style)
+        sheet = wb['Target']
+        eq_('IMHeader', sheet['A1'].style)
+        eq_('IMComma', sheet['B2'].style)
+        eq_('IMCurrency', sheet['C2'].style)
+        eq_(3.5, sheet['C2'].value)
+        eq_('A2', sheet.freeze_panes)
+        # Styles were reused, not piled on for each replace
+        eq_(len(set(wb._named_styles.names)), len(wb._named_styles.names))
+
+
+def blank_cells_test():
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'book.xlsx')
+        _make_book(fn)
+        rows = [['a', '', None], ['', None, 2.5]]
+        _Importer(rows).main(cmdline_args=['-b', fn, '-s', 'Target', '--surgical'])
+        eq_([['Name', 'Qty', 'ExtPrice'], ['a', '', ''], ['', '', 2.5]], list(ws_scan_raw(fn, 'Target')))
+        sheet = load_workbook(fn)['Target']
+        eq_(None, sheet['B2'].value)
+        eq_(2.5, sheet['C3'].value)
+
+
+def add_sheet_test():
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'book.xlsx')
+        src = pth.join(folder, 'src.xlsx')
+        _make_book(fn)
+
+        wb = Workbook()
+        wb.active.title = 'Source'
+        wb.active['A1'] = 'New'
+        wb.active['B1'] = 42
+        wb.save(src)
+
+        part = replace_sheet(fn, src, 'Added', src_sheet_name='Source')
+        eq_(['First', 'Target', 'Last', 'Added'], ws_sheet_names(fn))
+        eq_([['New', 42]], list(ws_scan_raw(fn, 'Added')))
+        with zipfile.ZipFile(fn) as zf:
+            assert part not in ('xl/worksheets/sheet{}.xml'.format(i) for i in range(1, 4))
+            assert ('/' + part).encode() in zf.read('[Content_Types].xml')
+
+
+def save_profiles_test():
+    wb = Workbook()
+    wb.active.title = 'Data'
+    for i in range(200):
+        wb.active.append(['Row {}'.format(i % 7), ' padded ', i, 'a & b'])
+
+    with tempfile.TemporaryDirectory() as folder:
+        sizes = {}
+        for save_profile in ('store', 'fast', 'default', 'max'):
+            for inline in (False, True):
+                fn = pth.join(folder, '{}-{}.xlsx'.format(save_profile, inline))
+                save_workbook(wb, fn, save_profile, inline_strings=inline)
+                rows = list(ws_scan_raw(fn, 'Data'))
+                eq_(['Row 0', 'padded', 0, 'a & b'], rows[0])  # ws_scan_raw normalizes spaces
+                eq_(['Row 3', 'padded', 199, 'a & b'], rows[-1])
+                eq_(' padded ', load_workbook(fn)['Data']['B1'].value)
+                with zipfile.ZipFile(fn) as zf:
+                    sheet = zf.read('xl/worksheets/sheet1.xml')
+                    # openpyxl 3.1 and later always write inline strings
+                    if inline:
+                        assert b'inlineStr' in sheet and b't="s"' not in sheet
+                    # Every shared string cell points into the table
+                    sst = zf.read(SHARED_STRINGS_PART) if SHARED_STRINGS_PART in zf.namelist() else EMPTY_SST
+                    count = len(etree.fromstring(sst))
+                    assert all(int(i) < count for i in re.findall(br't="s"[^>]*><v>(\d+)<', sheet))
+                sizes[save_profile] = pth.getsize(fn)
+        assert sizes['store'] > sizes['fast'] >= sizes['max']
+
+
+def custom_properties_test():
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'book.xlsx')
+        _make_book(fn)
+        eq_({}, read_custom_properties(fn))
+
+        set_custom_properties(fn, {'a': '1', 'b': 'two'})
+        eq_({'a': '1', 'b': 'two'}, read_custom_properties(fn))
+        set_custom_properties(fn, {'a': None, 'c': '3'})
+        eq_({'b': 'two', 'c': '3'}, read_custom_properties(fn))
+
+        eq_(['First', 'Target', 'Last'], ws_sheet_names(fn))
+        eq_('Keep me', load_workbook(fn)['First']['A1'].value)
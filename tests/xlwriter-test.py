@@ -0,0 +1,79 @@
+"""Tests for the parallel workbook writer."""
+
+import os.path as pth
+import tempfile
+
+from datetime import date
+from functools import partial
+
+from nose.tools import eq_
+from openpyxl import load_workbook
+
+from datasimple.xl import ws_scan_raw, ws_sheet_names
+from datasimple.xlwriter import SheetSource, cell_xml, pane_xml, write_workbook
+
+
+def _data(count):
+    rows = [['r{}'.format(i), str(i), i + 0.5, date(2018, 1, 1)] for i in range(count)]
+    return ['Name', 'Qty', 'ExtPrice', 'When'], iter(rows)
+
+
+def cell_xml_test():
+    eq_('<c r="A1" s="3"/>', cell_xml('A1', '3', ''))
+    eq_('<c r="A1" s="3" t="b"><v>1</v></c>', cell_xml('A1', '3', True))
+    eq_('<c r="A1" s="3" t="n"><v>1.5</v></c>', cell_xml('A1', '3', 1.5))
+    eq_('<c r="A1" s="3" t="n"><v>43101</v></c>', cell_xml('A1', '3', date(2018, 1, 1)))
+    eq_('<c r="A1" s="3"><f>SUM(A2:A3)</f><v></v></c>', cell_xml('A1', '3', '=SUM(A2:A3)'))
+    eq_('<c r="A1" s="3" t="e"><v>#N/A</v></c>', cell_xml('A1', '3', '#N/A'))
+    eq_('<c r="A1" s="3" t="inlineStr"><is><t>a &amp; &lt;b&gt;</t></is></c>', cell_xml('A1', '3', 'a & <b>'))
+    eq_('<c r="A1" s="3" t="inlineStr"><is><t xml:space="preserve"> x</t></is></c>', cell_xml('A1', '3', ' x'))
+
+
+def pane_xml_test():
+    eq_('', pane_xml(''))
+    eq_('', pane_xml('A1'))
+    assert 'ySplit="1"' in pane_xml('A2') and 'xSplit' not in pane_xml('A2')
+    assert 'bottomRight' in pane_xml('$C$3')
+    assert 'topLeftCell="AB1"' in pane_xml('ab1')
+
+
+def write_workbook_test():
+    sheets = [
+        SheetSource('First', partial(_data, 50), freeze='A2'),
+        SheetSource('Second', partial(_data, 3), transpose=True),
+        SheetSource('Empty', partial(_data, 0)),
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'book.xlsx')
+        counts = write_workbook(fn, sheets, processes=2)
+        eq_({'First': 50, 'Second': 3, 'Empty': 0}, counts)
+        eq_(['First', 'Second', 'Empty'], ws_sheet_names(fn))
+
+        rows = list(ws_scan_raw(fn, 'First'))
+        eq_(51, len(rows))
+        eq_(['r49', 49, 49.5], rows[-1][:3])
+        eq_(['Name', 'r0', 'r1', 'r2'], list(ws_scan_raw(fn, 'Second'))[0])
+        eq_([['Name', 'Qty', 'ExtPrice', 'When']], list(ws_scan_raw(fn, 'Empty')))
+
+        wb = load_workbook(fn)
+        sheet = wb['First']
+        eq_('A2', sheet.freeze_panes)
+        eq_('IMHeader', sheet['A1'].style)
+        eq_('IMComma', sheet['B2'].style)
+        eq_('IMCurrency', sheet['C2'].style)
+        eq_((8 + 3.2) * 0.88, sheet.column_dimensions['C'].width)
+
+
+def transpose_ragged_test():
+    def _ragged():
+        return ['Name', 'Qty', 'ExtPrice'], iter([['a', '1', 1.5], ['b'], ['c', '3']])
+
+    with tempfile.TemporaryDirectory() as folder:
+        fn = pth.join(folder, 'book.xlsx')
+        write_workbook(fn, [SheetSource('T', _ragged, transpose=True)], processes=1)
+        sheet = load_workbook(fn)['T']
+        # Short rows leave blanks, they don't shift later values over
+        eq_(
+            [['Name', 'a', 'b', 'c'], ['Qty', 1, None, 3], ['ExtPrice', 1.5, None, None]],
+            [[c.value for c in row] for row in sheet.iter_rows()]
+        )